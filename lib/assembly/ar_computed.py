@@ -7,6 +7,7 @@ The Arast daemon runs on the control node.
 """
 import os
 import argparse
+import fcntl
 import sys
 import daemon
 import logging
@@ -17,7 +18,10 @@ import pika
 import requests
 
 from ConfigParser import SafeConfigParser
+import cache
 import consume
+import disk
+import scheduler
 import shock
 import client
 
@@ -28,6 +32,10 @@ import client
 mgr = multiprocessing.Manager()
 job_list = mgr.list()
 kill_list = mgr.list()
+pinned_list = mgr.list()
+reserved_dict = mgr.dict()
+allocation_dict = mgr.dict()
+kill_wakeups = [] # Write ends of the workers' kill wakeup pipes
 
 def start(arast_server, config, num_threads, queue):
 
@@ -93,15 +101,45 @@ def start(arast_server, config, num_threads, queue):
         raise Exception(' [.] Storage path -- {} : ERROR'.format(datapath))
 
     ## Start Monitor Thread
+    ## Kill requests wake each worker's running module through a pipe
+    kill_wakeups = [os.pipe() for i in range(int(num_threads))]
+    for fds in kill_wakeups:
+        for fd in fds:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
     kill_process = multiprocessing.Process(name='killd', target=start_kill_monitor,
-                                           args=(arasturl,))
+                                           args=(arasturl, [w for r, w in kill_wakeups]))
     kill_process.start()
 
+    ## Start Disk Eviction Service
+    min_free_space = float(cparser.get('compute', 'min_free_space'))
+    if cparser.has_option('compute', 'evict_interval'):
+        evict_interval = int(cparser.get('compute', 'evict_interval'))
+    else:
+        evict_interval = 60
+    evictor = disk.DiskEvictor(datapath, min_free_space, job_list, pinned_list,
+                               interval=evict_interval, reserved=reserved_dict,
+                               stores=[c for c in cache.open_caches(cparser, datapath) if c])
+    evict_process = multiprocessing.Process(name='evictd', target=evictor.start)
+    evict_process.start()
+
+    ## Node-wide module scheduler
+    if cparser.has_option('compute', 'cores'):
+        cores = int(cparser.get('compute', 'cores'))
+    else:
+        cores = multiprocessing.cpu_count()
+    if cparser.has_option('compute', 'memory_limit'): # MB
+        memory_limit = float(cparser.get('compute', 'memory_limit'))
+    else:
+        memory_limit = None
+    module_scheduler = scheduler.ResourceScheduler(cores, allocation_dict,
+                                                   memory_limit=memory_limit)
+
     workers = []
     for i in range(int(num_threads)):
         worker_name = "[Worker %s]:" % i
         compute = consume.ArastConsumer(shockurl, arasturl, config, num_threads, 
-                                        queue, kill_list, job_list, ctrl_conf)
+                                        queue, kill_list, job_list, ctrl_conf, evictor,
+                                        module_scheduler, kill_wakeups[i][0])
         logging.info("[Master]: Starting %s" % worker_name)
         p = multiprocessing.Process(name=worker_name, target=compute.start)
 
@@ -110,7 +148,9 @@ def start(arast_server, config, num_threads, queue):
 
     workers[0].join()
 
-def start_kill_monitor(arasturl):
+def start_kill_monitor(arasturl, wakeups=()):
+    global kill_wakeups
+    kill_wakeups = wakeups
     connection = pika.BlockingConnection(pika.ConnectionParameters(
             host = arasturl))
     channel = connection.channel()
@@ -135,6 +175,11 @@ def kill_callback(ch, method, properties, body):
             if kill_request['user'] == job_data['user'] and kill_request['job_id'] == str(job_data['job_id']):
                 print 'on this node'
                 kill_list.append(kill_request)
+                for fd in kill_wakeups:
+                    try:
+                        os.write(fd, 'k')
+                    except OSError: # Pipe full, worker already woken
+                        pass
 
 
 
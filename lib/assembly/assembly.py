@@ -16,6 +16,7 @@ import shutil
 import glob
 
 import metadata as meta
+import readstats
 
 from ConfigParser import SafeConfigParser
 
@@ -112,6 +113,8 @@ def rename_file_symlink(filepath, newname):
     """ Renames the file, keeping the file extension, symlinks to new file name"""
     f = '/' + newname + '.' + os.path.basename(filepath).rsplit('.', 1)[1]
     newfile =  os.path.split(filepath)[0] + f
+    if os.path.islink(newfile): # Left by an interrupted run
+        os.remove(newfile)
     os.symlink(filepath, newfile)
     return newfile
     
@@ -222,6 +225,9 @@ def run_bwa(data_dir, ref_name, read_files, prefix):
     return bam_out
 
 def get_qual_encoding(file):
+    stats = readstats.cached_stats(file)
+    if stats and stats.get('qual_encoding'):
+        return stats['qual_encoding']
     f = open(file, 'r')
     while True:
         bline = f.readline()
@@ -265,3 +271,27 @@ parser = SafeConfigParser()
 #basepath = get_default('basepath')
 #metadata = meta.MetadataConnection(parser.get('meta','mongo.remote.host'))
 
+
+def contig_stats(fasta_file):
+    """ Returns (N50, total length, number of contigs) of FASTA_FILE """
+    lengths = []
+    length = 0
+    with open(fasta_file) as f:
+        for line in f:
+            if line.startswith('>'):
+                if length:
+                    lengths.append(length)
+                length = 0
+            else:
+                length += len(line.strip())
+    if length:
+        lengths.append(length)
+    total = sum(lengths)
+    n50 = 0
+    running = 0
+    for l in sorted(lengths, reverse=True):
+        running += l
+        if running * 2 >= total:
+            n50 = l
+            break
+    return n50, total, len(lengths)
@@ -0,0 +1,203 @@
+"""
+Reading of BAM alignment files without samtools.
+
+A BAM file is a series of BGZF blocks, each a gzip member of at most 64 KB
+of data that records its own compressed size.  BamReader finds the blocks
+from their headers, inflates batches of them on a process pool while the
+records of earlier batches are decoded, and yields only the fields needed
+to summarize alignments:
+
+  for aln in BamReader('sorted.bam', processes=4):
+      aln.flag, aln.ref_id, aln.next_ref_id, aln.tlen, aln.cigar
+
+CIGARs are tuples of (operation, length) pairs, eg. (('M', 100),).
+"""
+
+import collections
+import logging
+import multiprocessing
+import struct
+import zlib
+
+BAM_MAGIC = 'BAM\1'
+GZIP_MAGIC = '\x1f\x8b'
+BGZF_HEADER = struct.Struct('<4BI2BH')
+BATCH_BLOCKS = 256 # About 16 MB of data per batch
+CIGAR_OPS = 'MIDNSHP=X'
+
+RECORD = struct.Struct('<iiBBHHHiiii')
+INT32 = struct.Struct('<i')
+UINT32 = struct.Struct('<I')
+
+Alignment = collections.namedtuple('Alignment',
+                                   ['ref_id', 'flag', 'next_ref_id', 'tlen', 'cigar'])
+
+class BGZFError(Exception):
+    pass
+
+
+def is_bam(filename):
+    """ True if FILENAME is a BGZF file holding BAM data """
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(BGZF_HEADER.size)
+            if not header.startswith(GZIP_MAGIC):
+                return False
+            f.seek(0)
+            offset, size = iter_blocks(f).next()
+            f.seek(offset)
+            return inflate_block(f.read(size)).startswith(BAM_MAGIC)
+    except (IOError, BGZFError, StopIteration, zlib.error):
+        return False
+
+def iter_blocks(f):
+    """ Yields (offset, size) of each BGZF block of file F """
+    offset = 0
+    while True:
+        f.seek(offset)
+        header = f.read(BGZF_HEADER.size)
+        if not header:
+            return
+        if len(header) < BGZF_HEADER.size:
+            raise BGZFError('Truncated block header at {}'.format(offset))
+        id1, id2, cm, flg, mtime, xfl, os_, xlen = BGZF_HEADER.unpack(header)
+        if (id1, id2, cm) != (0x1f, 0x8b, 8) or not flg & 4:
+            raise BGZFError('Not a BGZF block at {}'.format(offset))
+        extra = f.read(xlen)
+        size = None
+        i = 0
+        while i + 4 <= len(extra): # Find the BC subfield
+            si, slen = extra[i:i + 2], struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if si == 'BC' and slen == 2:
+                size = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+            i += 4 + slen
+        if size is None:
+            raise BGZFError('No block size at {}'.format(offset))
+        yield offset, size
+        offset += size
+
+def inflate_block(block):
+    """ Data of the BGZF block BLOCK """
+    xlen = struct.unpack('<H', block[10:12])[0]
+    try:
+        data = zlib.decompress(block[12 + xlen:-8], -15)
+    except zlib.error as e:
+        raise BGZFError('Corrupt or truncated block: {}'.format(e))
+    if len(data) != struct.unpack('<I', block[-4:])[0]:
+        raise BGZFError('Block size mismatch')
+    return data
+
+def inflate_range(args):
+    """ Data of the consecutive blocks of SIZES starting at byte START """
+    filename, start, sizes = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        raw = f.read(sum(sizes))
+    data = []
+    pos = 0
+    for size in sizes:
+        data.append(inflate_block(raw[pos:pos + size]))
+        pos += size
+    return ''.join(data)
+
+
+class BamReader:
+    def __init__(self, filename, processes=1, batch_blocks=BATCH_BLOCKS):
+        self.filename = filename
+        self.processes = processes
+        self.batch_blocks = batch_blocks
+        self.header = None
+        self.references = None # [(name, length)]
+
+    def iter_batches(self, f):
+        batch = []
+        for offset, size in iter_blocks(f):
+            if not batch:
+                start = offset
+            batch.append(size)
+            if len(batch) >= self.batch_blocks:
+                yield (self.filename, start, batch)
+                batch = []
+        if batch:
+            yield (self.filename, start, batch)
+
+    def iter_data(self):
+        """ Yields the inflated data of the file in order, batch by batch """
+        with open(self.filename, 'rb') as f:
+            batches = self.iter_batches(f)
+            if self.processes <= 1:
+                for batch in batches:
+                    yield inflate_range(batch)
+                return
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                pending = collections.deque()
+                for batch in batches:
+                    pending.append(pool.apply_async(inflate_range, [batch]))
+                    if len(pending) >= 2 * self.processes: # Bound memory use
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+    def __iter__(self):
+        data = self.iter_data()
+        self.buf, self.pos = '', 0
+        if self.take(data, 4) != BAM_MAGIC:
+            raise BGZFError('Not a BAM file: {}'.format(self.filename))
+        self.header = self.take(data, self.take_int(data)).rstrip('\0')
+        self.references = []
+        for i in range(self.take_int(data)):
+            name = self.take(data, self.take_int(data)).rstrip('\0')
+            self.references.append((name, self.take_int(data)))
+        logging.debug('{}: {} references'.format(self.filename, len(self.references)))
+
+        unpack_record = RECORD.unpack_from
+        record_size = RECORD.size
+        buf, pos = self.buf, self.pos
+        while True:
+            end = len(buf)
+            if end - pos < 4 or end - pos < 4 + INT32.unpack_from(buf, pos)[0]:
+                self.buf, self.pos = buf, pos
+                if not self.need(data, 4):
+                    return
+                self.need(data, 4 + INT32.unpack_from(self.buf, self.pos)[0], True)
+                buf, pos = self.buf, self.pos
+            size = INT32.unpack_from(buf, pos)[0]
+            (ref_id, _, l_read_name, _, _, n_cigar_op, flag, _,
+             next_ref_id, _, tlen) = unpack_record(buf, pos + 4)
+            if n_cigar_op == 1: # Most reads, decoded without a format string
+                v = UINT32.unpack_from(buf, pos + 4 + record_size + l_read_name)[0]
+                cigar = ((CIGAR_OPS[v & 0xf], v >> 4),)
+            else:
+                cigar = tuple([(CIGAR_OPS[v & 0xf], v >> 4) for v in
+                               struct.unpack_from('<{}I'.format(n_cigar_op), buf,
+                                                  pos + 4 + record_size + l_read_name)])
+            pos += 4 + size
+            yield Alignment(ref_id, flag, next_ref_id, tlen, cigar)
+
+    def need(self, data, n, required=False):
+        """ Makes N bytes of DATA available at the position """
+        while len(self.buf) - self.pos < n:
+            try:
+                chunk = data.next()
+            except StopIteration:
+                if required or self.pos < len(self.buf):
+                    raise BGZFError('Truncated BAM file: {}'.format(self.filename))
+                return False
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        return True
+
+    def take(self, data, n):
+        self.need(data, n, True)
+        self.pos += n
+        return self.buf[self.pos - n:self.pos]
+
+    def take_int(self, data):
+        return INT32.unpack(self.take(data, 4))[0]
@@ -0,0 +1,365 @@
+"""
+Node-local caches of Shock data and of module outputs.
+
+ShockCache entries are keyed by Shock node id and cross-referenced by MD5,
+so the same reads submitted under a new data_id, or by another user, are
+fetched once per host.  ModuleCache entries hold the output directory of a
+module run, keyed by the module, its version and settings, and the content
+of its inputs.  Files are hardlinked into job directories, so removing a
+job directory frees no space while its data is cached; the DiskEvictor
+therefore also evicts cache entries on the same filesystem.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from shock import file_md5
+
+META_FILE = 'entry.json'
+OUTDIR = '$OUTDIR' # Placeholder for the output directory in stored outputs
+
+class EntryStore:
+    """ Directory of size-capped entries, evicted least recently used """
+    def __init__(self, cachepath, max_size):
+        self.cachepath = cachepath
+        self.max_size = max_size
+        makedirs(cachepath)
+
+    def entries(self):
+        """ (last used, entry directory, meta) of every entry """
+        entries = []
+        for name in os.listdir(self.cachepath):
+            entry_dir = os.path.join(self.cachepath, name)
+            meta = self._read_meta(entry_dir)
+            if meta is None:
+                continue
+            entries.append((os.path.getmtime(entry_dir), entry_dir, meta))
+        return entries
+
+    def evict(self):
+        """ Remove least recently used entries until under the size cap """
+        entries = self.entries()
+        total = sum([meta['size'] for mtime, entry_dir, meta in entries])
+        for mtime, entry_dir, meta in sorted(entries):
+            if total <= self.max_size:
+                break
+            if self.remove(entry_dir, meta):
+                total -= meta['size']
+
+    def remove(self, entry_dir, meta):
+        """ Remove an entry unless it is in use """
+        lock = EntryLock(entry_dir, blocking=False)
+        if not lock.acquire(): # In use
+            return False
+        try:
+            logging.info('Evicting cache entry: {}'.format(entry_dir))
+            self._evicted(meta)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        finally:
+            lock.release()
+        return True
+
+    def _evicted(self, meta):
+        pass
+
+    def _read_meta(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, META_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self, entry_dir, meta):
+        tmp = os.path.join(entry_dir, META_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, os.path.join(entry_dir, META_FILE))
+
+
+class ShockCache(EntryStore):
+    def __init__(self, cachepath, max_size):
+        EntryStore.__init__(self, cachepath, max_size)
+        self.md5path = os.path.join(cachepath, 'md5')
+        makedirs(self.md5path)
+
+    def fetch(self, sclient, node_id, outdir, extractor=None):
+        """ Return a path in OUTDIR holding the data of NODE_ID.
+        Concurrent fetches of the same node on this host wait on a
+        per-node lock, so only one of them downloads (single-flight).
+        On a miss, EXTRACTOR(path) may return a sink that decompresses
+        into OUTDIR while the data is downloaded.  If OUTDIR is None the
+        node is only brought into the cache.
+        """
+        entry_dir = os.path.join(self.cachepath, node_id)
+        with EntryLock(entry_dir):
+            meta = self._read_meta(entry_dir)
+            if meta is None:
+                node = sclient.get_node(node_id)
+                same = self._lookup_md5(node)
+                if same is not None:
+                    logging.info('Cache hit by checksum: {} -> {}'.format(
+                            node_id, same['shock_id']))
+                    same_dir = os.path.join(self.cachepath, same['shock_id'])
+                    filename = node['file']['name'].split('/')[-1]
+                    with EntryLock(same_dir):
+                        local_file = self._link(same_dir, same, outdir, filename)
+                    return local_file
+                logging.info('Cache miss: {}'.format(node_id))
+                sink = None
+                if extractor and outdir:
+                    filename = node['file']['name'].split('/')[-1]
+                    sink = extractor(os.path.join(outdir, filename))
+                cached = sclient.download_file(node_id, outdir=entry_dir, sink=sink)
+                meta = {'shock_id': node_id,
+                        'filename': os.path.basename(cached),
+                        'size': os.path.getsize(cached),
+                        'md5': node['file'].get('checksum', {}).get('md5')}
+                self._write_meta(entry_dir, meta)
+            else:
+                logging.info('Cache hit: {}'.format(node_id))
+            local_file = self._link(entry_dir, meta, outdir)
+        self.evict()
+        return local_file
+
+    def prefetch(self, sclient, node_id):
+        return self.fetch(sclient, node_id, None)
+
+    def _link(self, entry_dir, meta, outdir, filename=None):
+        """ Link the file of an entry into OUTDIR, as FILENAME if given """
+        os.utime(entry_dir, None) # LRU timestamp
+        if outdir is None:
+            return os.path.join(entry_dir, meta['filename'])
+        return link_file(os.path.join(entry_dir, meta['filename']),
+                         os.path.join(outdir, filename or meta['filename']))
+
+    def _lookup_md5(self, node):
+        try:
+            md5 = node['file']['checksum']['md5']
+            with open(os.path.join(self.md5path, md5)) as f:
+                shock_id = f.read().strip()
+        except (KeyError, TypeError, IOError):
+            return None
+        meta = self._read_meta(os.path.join(self.cachepath, shock_id))
+        if meta and meta.get('md5') == md5:
+            return meta
+        return None
+
+    def _evicted(self, meta):
+        if meta.get('md5'):
+            try:
+                os.remove(os.path.join(self.md5path, meta['md5']))
+            except OSError:
+                pass
+
+    def _read_meta(self, entry_dir):
+        meta = EntryStore._read_meta(self, entry_dir)
+        if meta is None or not os.path.exists(os.path.join(entry_dir, meta['filename'])):
+            return None
+        return meta
+
+    def _write_meta(self, entry_dir, meta):
+        EntryStore._write_meta(self, entry_dir, meta)
+        if meta.get('md5'):
+            with open(os.path.join(self.md5path, meta['md5']), 'w') as f:
+                f.write(meta['shock_id'])
+
+
+class ModuleCache(EntryStore):
+    """
+    Output directories of module runs.  Callers hold lock(KEY) while
+    running a module, so concurrent runs of the same key on hosts sharing
+    the cache compute it once.
+    """
+    def __init__(self, cachepath, max_size):
+        EntryStore.__init__(self, cachepath, max_size)
+        self.digestpath = os.path.join(cachepath, 'digests')
+        makedirs(self.digestpath)
+
+    def key(self, description):
+        """ Entry key for DESCRIPTION, a JSON-serializable dict """
+        return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+    def lock(self, key):
+        return EntryLock(os.path.join(self.cachepath, key))
+
+    def lookup(self, key):
+        return self._read_meta(os.path.join(self.cachepath, key))
+
+    def restore(self, key, meta, outdir):
+        """ Link the files of entry KEY into OUTDIR.  Returns the module
+        output, log and list of files, relocated to OUTDIR. """
+        entry_dir = os.path.join(self.cachepath, key)
+        os.utime(entry_dir, None) # LRU timestamp
+        outdir = os.path.abspath(outdir)
+        files = [link_file(os.path.join(entry_dir, 'files', f), os.path.join(outdir, f))
+                 for f in meta['files']]
+        output = relocate(meta['output'], OUTDIR, outdir)
+        if meta['tuple']:
+            output = tuple(output)
+        return output, os.path.join(outdir, meta['log']), files
+
+    def put(self, key, outpath, output, log):
+        """ Store the output directory OUTPATH of a module run as KEY.
+        Runs whose output refers to files outside OUTPATH are not stored. """
+        outpath = os.path.abspath(outpath)
+        for s in iter_strings(output):
+            if os.path.isabs(s) and os.path.exists(s) and not is_under(s, outpath):
+                logging.info('Not caching {}: {} is outside {}'.format(key, s, outpath))
+                return False
+        entry_dir = os.path.join(self.cachepath, key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        files = []
+        size = 0
+        for root, dirs, names in os.walk(outpath):
+            for name in names:
+                src = os.path.join(root, name)
+                if os.path.islink(src):
+                    logging.info('Not caching {}: {} is a symlink'.format(key, src))
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    return False
+                rel = os.path.relpath(src, outpath)
+                link_file(src, os.path.join(entry_dir, 'files', rel))
+                files.append(rel)
+                size += os.path.getsize(src)
+        meta = {'key': key,
+                'files': files,
+                'size': size,
+                'log': os.path.relpath(os.path.abspath(log), outpath),
+                'tuple': type(output) is tuple,
+                'output': relocate(output, outpath, OUTDIR)}
+        self._write_meta(entry_dir, meta)
+        logging.info('Cached module output {} ({} bytes)'.format(key, size))
+        self.evict()
+        return True
+
+    def digest(self, filename):
+        """ MD5 of FILENAME, remembered by inode so that hardlinked
+        copies are only read once """
+        st = os.stat(filename)
+        ref = os.path.join(self.digestpath, '{}_{}_{}_{}'.format(
+                st.st_dev, st.st_ino, st.st_size, int(st.st_mtime)))
+        try:
+            with open(ref) as f:
+                return f.read().strip()
+        except IOError:
+            pass
+        md5 = file_md5(filename)
+        with open(ref, 'w') as f:
+            f.write(md5)
+        return md5
+
+
+class EntryLock:
+    """ Host-wide lock on a cache entry (flock on a sibling .lock file) """
+    def __init__(self, entry_dir, blocking=True):
+        self.lockfile = entry_dir.rstrip('/') + '.lock'
+        self.blocking = blocking
+        self.fd = None
+
+    def acquire(self):
+        self.fd = open(self.lockfile, 'a')
+        flags = fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fd, flags)
+        except IOError:
+            self.fd.close()
+            self.fd = None
+            return False
+        return True
+
+    def release(self):
+        if self.fd:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.fd.close()
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def open_caches(parser, datapath):
+    """ ShockCache and ModuleCache (None if disabled) configured in the
+    [compute] section of PARSER """
+    if parser.has_option('compute', 'cachepath'):
+        cachepath = parser.get('compute', 'cachepath')
+    else:
+        cachepath = os.path.join(datapath, '_cache')
+    if parser.has_option('compute', 'cache_size'):
+        cache_size = float(parser.get('compute', 'cache_size'))
+    else:
+        cache_size = 100000000000
+    shock_cache = ShockCache(cachepath, cache_size)
+    if parser.has_option('compute', 'module_cachepath'): # May be shared
+        module_cachepath = parser.get('compute', 'module_cachepath')
+    else:
+        module_cachepath = os.path.join(cachepath, 'modules')
+    if parser.has_option('compute', 'module_cache_size'):
+        module_cache_size = float(parser.get('compute', 'module_cache_size'))
+    else:
+        module_cache_size = 50000000000
+    module_cache = None
+    if module_cache_size > 0:
+        module_cache = ModuleCache(module_cachepath, module_cache_size)
+    return shock_cache, module_cache
+
+def link_file(src, dst):
+    """ Hardlink SRC to DST, copying if they are on different devices """
+    if os.path.exists(dst):
+        return dst
+    try:
+        os.makedirs(os.path.dirname(dst))
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy(src, dst)
+    return dst
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def is_under(path, directory):
+    return os.path.abspath(path).startswith(directory.rstrip('/') + '/')
+
+def iter_strings(obj):
+    """ Strings nested in lists, tuples and dicts of OBJ """
+    if isinstance(obj, basestring):
+        yield obj
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            for s in iter_strings(o):
+                yield s
+    elif isinstance(obj, dict):
+        for o in obj.values():
+            for s in iter_strings(o):
+                yield s
+
+def relocate(obj, old, new):
+    """ Copy of OBJ with paths under directory OLD moved to NEW """
+    if isinstance(obj, basestring):
+        if obj == old or obj.startswith(old.rstrip('/') + '/'):
+            return new + obj[len(old.rstrip('/')):]
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [relocate(o, old, new) for o in obj]
+    if isinstance(obj, dict):
+        return dict([(k, relocate(v, old, new)) for k, v in obj.items()])
+    return obj
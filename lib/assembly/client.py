@@ -5,7 +5,7 @@ import subprocess
 import os
 
 
-from shock import Shock
+from shock import Shock, http_session
 
 #Debug
 import sys
@@ -54,7 +54,7 @@ format from html??
 """
 
 
-class Client:
+class Client(object):
     def __init__(self, url, user, token):
         self.port = 8000 ## change
         if url.find(':') == -1: # Port not included
@@ -66,15 +66,28 @@ class Client:
         self.headers = {'Authorization': '{}'.format(self.token),
                         'Content-type': 'application/json', 
                         'Accept': 'text/plain'}
-        shockres = requests.get('http://{}/shock'.format(self.url), headers=self.headers).text
-        self.shockurl = 'http://{}/'.format(json.loads(shockres)['shockurl'])
-        self.shock = Shock(self.shockurl, self.user, self.token)
+        self._shockurl = None
+        self._shock = None
+
+    @property
+    def shockurl(self):
+        """ Looked up on first use, most commands never touch Shock """
+        if not self._shockurl:
+            shockres = http_session().get('http://{}/shock'.format(self.url), headers=self.headers).text
+            self._shockurl = 'http://{}/'.format(json.loads(shockres)['shockurl'])
+        return self._shockurl
+
+    @property
+    def shock(self):
+        if not self._shock:
+            self._shock = Shock(self.shockurl, self.user, self.token)
+        return self._shock
 
     def get_job_data(self, job_id=None, outdir=None):
         if not job_id:
             raise NotImplementedError('Job id required')
         # Get node id
-        res = requests.get('http://{}/user/{}/job/{}/shock_node'.format(
+        res = http_session().get('http://{}/user/{}/job/{}/shock_node'.format(
                 self.url, self.user, job_id), headers=self.headers)
         # Download files
         try:
@@ -91,7 +104,7 @@ class Client:
         if not job_id:
             raise NotImplementedError('Job id required')
         # Get node id
-        res = requests.get('http://{}/user/{}/job/{}/assembly'.format(
+        res = http_session().get('http://{}/user/{}/job/{}/assembly'.format(
                 self.url, self.user, job_id), headers=self.headers)
 
         # Download files
@@ -128,12 +141,12 @@ class Client:
 
     def submit_job(self, data):
         url = 'http://{}/user/{}/job/new'.format(self.url, self.user)
-        r = requests.post(url, data=data, headers=self.headers)
+        r = http_session().post(url, data=data, headers=self.headers)
         return r.content
 
     def submit_data(self, data):
         url = 'http://{}/user/{}/data/new'.format(self.url, self.user)
-        r = requests.post(url, data=data, headers=self.headers)
+        r = http_session().post(url, data=data, headers=self.headers)
         return r.content
 
     def get_job_status(self, stat_n, job_id=None):
@@ -142,12 +155,12 @@ class Client:
         else:
             url = 'http://{}/user/{}/job/status?records={}'.format(
                 self.url, self.user, stat_n)
-        r = requests.get(url, headers=self.headers)
+        r = http_session().get(url, headers=self.headers)
         return r.content
 
     def get_available_modules(self):
         url = 'http://{}/module/all/avail/'.format(self.url, self.user)
-        r = requests.get(url, headers=self.headers)
+        r = http_session().get(url, headers=self.headers)
         return r.content
 
     def kill_jobs(self, job_id=None):
@@ -156,11 +169,11 @@ class Client:
         else:
             url = 'http://{}/user/{}/job/all/kill'.format(
                 self.url, self.user)
-        r = requests.get(url, headers=self.headers)
+        r = http_session().get(url, headers=self.headers)
         return r.content
 
     def get_config(self):
-        return requests.get('http://{}/admin/system/config'.format(self.url)).content
+        return http_session().get('http://{}/admin/system/config'.format(self.url)).content
 
 
 ##### ARAST JSON SPEC METHODS #####
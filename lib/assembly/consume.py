@@ -3,6 +3,7 @@ Consumes a job from the queue
 """
 
 import copy
+import hashlib
 import logging
 import pika
 import sys
@@ -14,30 +15,48 @@ import time
 import datetime 
 import socket
 import multiprocessing
+import Queue
 import re
 import threading
 import tarfile
+import signal
 import subprocess
+import tempfile
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 #from yapsy.PluginManager import PluginManager
-from plugins import ModuleManager
+from plugins import ModuleManager, new_rusage, add_rusage
 from job import ArastJob
 from multiprocessing import current_process as proc
 from traceback import format_tb, format_exc
 
 import assembly as asm
+import pipe as phelper
+import readstats
 import metadata as meta
 import shock 
+from cache import open_caches, is_under, iter_strings
+from extract import extract_file, stream_extractor
 from kbase import typespec_to_assembly_data as kb_to_asm
+from tracing import Tracer
 
 from ConfigParser import SafeConfigParser
 
+READ_STATS_FILE = 'read_stats.json'
+STAGE_POLL_INTERVAL = 5 # Seconds between checks on forked stages
+
 class ArastConsumer:
-    def __init__(self, shockurl, arasturl, config, threads, queue, kill_queue, job_list, ctrl_conf):
+    def __init__(self, shockurl, arasturl, config, threads, queue, kill_queue, job_list, ctrl_conf,
+                 evictor, scheduler=None, kill_wakeup=None):
         self.parser = SafeConfigParser()
         self.parser.read(config)
         self.job_list = job_list
         # Load plugins
         self.pmanager = ModuleManager(threads, kill_queue, job_list)
+        self.pmanager.scheduler = scheduler
+        self.pmanager.on_memory_wait = self.memory_wait
+        self.pmanager.kill_wakeup = kill_wakeup
+        self.tracer = Tracer() # Timeline of the running job
 
     # Set up environment
         self.shockurl = shockurl
@@ -49,38 +68,44 @@ class ArastConsumer:
         else:
             self.queue = self.parser.get('rabbitmq','default_routing_key')
         self.min_free_space = float(self.parser.get('compute','min_free_space'))
+        if self.parser.has_option('compute', 'download_threads'):
+            self.download_threads = int(self.parser.get('compute', 'download_threads'))
+        else:
+            self.download_threads = 1
+        if self.parser.has_option('compute', 'upload_threads'):
+            self.upload_threads = int(self.parser.get('compute', 'upload_threads'))
+        else:
+            self.upload_threads = 1
+        self.cache, self.pmanager.module_cache = open_caches(self.parser, self.datapath)
+        self.prefetch = (self.parser.has_option('compute', 'prefetch') and
+                         self.parser.getboolean('compute', 'prefetch'))
+        self.prefetch_space_factor = 3 # Room for extracted data
+        self.prefetch_thread = None
+        self.fork_guard = ForkGuard()
+        if self.parser.has_option('compute', 'pipeline_concurrency'):
+            self.pipeline_concurrency = int(self.parser.get('compute', 'pipeline_concurrency'))
+        else:
+            self.pipeline_concurrency = 1
+        if self.parser.has_option('compute', 'sweep_budget'):
+            self.sweep_budget = int(self.parser.get('compute', 'sweep_budget'))
+        else:
+            self.sweep_budget = 16
+        if self.parser.has_option('compute', 'max_pipelines'):
+            self.pmanager.max_pipelines = int(self.parser.get('compute', 'max_pipelines'))
+        if self.parser.has_option('compute', 'pipeline_cores'):
+            self.pipeline_cores = int(self.parser.get('compute', 'pipeline_cores'))
+        else:
+            self.pipeline_cores = multiprocessing.cpu_count() / max(1, int(threads))
         m = ctrl_conf['meta']        
         a = ctrl_conf['assembly']
         
-        self.metadata = meta.MetadataConnection(arasturl, int(a['mongo_port']), m['mongo.db'],
-                                                m['mongo.collection'], m['mongo.collection.auth'])
-        self.gc_lock = multiprocessing.Lock()
-
-    def garbage_collect(self, datapath, user, required_space):
-        """ Monitor space of disk containing DATAPATH and delete files if necessary."""
-        self.gc_lock.acquire()
-        s = os.statvfs(datapath)
-        free_space = float(s.f_bsize * s.f_bavail)
-        logging.debug("Free space in bytes: %s" % free_space)
-        logging.debug("Required space in bytes: %s" % required_space)
-        while ((free_space - self.min_free_space) < required_space):
-            #Delete old data
-            dirs = os.listdir(os.path.join(datapath, user))
-            times = []
-            for dir in dirs:
-                times.append(os.path.getmtime(os.path.join(datapath, user, dir)))
-            if len(dirs) > 0:
-                old_dir = os.path.join(datapath, user, dirs[times.index(min(times))])
-                shutil.rmtree(old_dir, ignore_errors=True)
-            else:
-                logging.error("No more directories to remove")
-                break
-            logging.info("Space required.  %s removed." % old_dir)
-            s = os.statvfs(datapath)
-            free_space = float(s.f_bsize * s.f_bavail)
-            logging.debug("Free space in bytes: %s" % free_space)
-        self.gc_lock.release()
+        self.metadata_args = (arasturl, int(a['mongo_port']), m['mongo.db'],
+                              m['mongo.collection'], m['mongo.collection.auth'])
+        self.metadata = self.connect_metadata()
+        self.evictor = evictor
 
+    def connect_metadata(self):
+        return meta.MetadataConnection(*self.metadata_args)
 
     def get_data(self, body):
         """Get data from cache or Shock server."""
@@ -103,36 +128,127 @@ class ArastConsumer:
         uid = params['_id']
 
         ##### Get data from ID #####
-        data_doc = self.metadata.get_doc_by_data_id(params['data_id'], params['ARASTUSER'])
-        if not data_doc:
-            raise Exception('Invalid Data ID: {}'.format(params['data_id']))
-
-        if 'kbase_assembly_input' in data_doc:
-            params['assembly_data'] = kb_to_asm(data_doc['kbase_assembly_input'])
-        elif 'assembly_data' in data_doc:
-            params['assembly_data'] = data_doc['assembly_data']
+        params['assembly_data'] = self.get_assembly_data(params)
 
         ##### Get data from assembly_data #####
         self.metadata.update_job(uid, 'status', 'Data transfer')
         try:os.makedirs(filepath)
         except:pass
-            
-          ### TODO Garbage collect ###
+        self.evictor.pin(datapath)
+
         download_url = 'http://{}'.format(self.shockurl)
         file_sets = params['assembly_data']['file_sets']
+        file_infos = []
         for file_set in file_sets:
             file_set['files'] = [] #legacy
+            file_infos += file_set['file_infos']
+        req_space = sum([f.get('filesize') or 0 for f in file_infos
+                         if not os.path.exists(os.path.join(filepath, f['filename']))])
+        try:
+            self.evictor.make_space(req_space)
+            self.fetch_file_infos(uid, file_infos, download_url, user, token, filepath)
+        except:
+            self.evictor.unpin(datapath)
+            raise
+        for file_set in file_sets:
             for file_info in file_set['file_infos']:
-                local_file = os.path.join(filepath, file_info['filename'])
-                if os.path.exists(local_file):
-                    logging.info("Requested data exists on node: {}".format(local_file))
-                else:
-                    local_file = self.download(download_url, user, token, 
-                                               file_info['shock_id'], filepath)
-                file_info['local_file'] = local_file
-                file_set['files'].append(local_file) #legacy
+                file_set['files'] += file_info['local_files'] #legacy
             all_files.append(file_set)
-        return datapath, all_files                    
+        return datapath, all_files
+
+    def get_assembly_data(self, params):
+        """ Returns the assembly_data record for the job's data_id """
+        data_doc = self.metadata.get_doc_by_data_id(params['data_id'], params['ARASTUSER'])
+        if not data_doc:
+            raise Exception('Invalid Data ID: {}'.format(params['data_id']))
+
+        if 'kbase_assembly_input' in data_doc:
+            return kb_to_asm(data_doc['kbase_assembly_input'])
+        elif 'assembly_data' in data_doc:
+            return data_doc['assembly_data']
+
+    def prefetch_data(self, body):
+        """ Download the data of queued job BODY into the node cache.
+        Returns False if there is not enough free disk space. """
+        params = json.loads(body)
+        if not 'assembly_data' in params:
+            return True # Legacy data format, fetched when the job runs
+        try:
+            assembly_data = self.get_assembly_data(params)
+        except: # Reported when the job runs
+            logging.exception('Could not prefetch job {}'.format(params['job_id']))
+            return True
+        file_infos = []
+        for file_set in assembly_data['file_sets']:
+            file_infos += file_set['file_infos']
+        req_space = sum([f.get('filesize') or 0 for f in file_infos])
+        if self.evictor.free_space() - self.min_free_space < req_space * self.prefetch_space_factor:
+            logging.info('Not enough space to prefetch job {}'.format(params['job_id']))
+            return False
+
+        ## Hold the space found until the data has landed
+        entries = [os.path.join(self.cache.cachepath, f['shock_id']) for f in file_infos]
+        for file_info, entry_dir in zip(file_infos, entries):
+            self.evictor.pin(entry_dir, (file_info.get('filesize') or 0) *
+                             self.prefetch_space_factor)
+
+        def prefetch():
+            url = 'http://{}'.format(self.shockurl)
+            sclient = shock.Shock(url, params['ARASTUSER'], params['oauth_token'])
+            for file_info, entry_dir in zip(file_infos, entries):
+                try:
+                    self.cache.prefetch(sclient, file_info['shock_id'])
+                except:
+                    logging.exception('Prefetch failed: {}'.format(file_info['shock_id']))
+                finally:
+                    self.evictor.unpin(entry_dir)
+
+        self.wait_prefetch()
+        self.prefetch_thread = threading.Thread(target=prefetch)
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+        print proc().name, ' [*] Prefetching data for job {}'.format(params['job_id'])
+        return True
+
+    def wait_prefetch(self):
+        """ Wait for a background prefetch to finish.  Called before
+        forking, as a child forked while the prefetch thread holds the
+        logging or connection pool locks could deadlock (the timer and
+        uploader threads are held off by self.fork_guard instead). """
+        if self.prefetch_thread is not None:
+            if self.prefetch_thread.is_alive():
+                logging.info('Waiting for prefetch to finish')
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+
+    def fetch_file_infos(self, uid, file_infos, url, user, token, filepath):
+        """ Download all FILE_INFOS concurrently, setting file_info['local_file'].
+        Per-file progress is recorded in the job's 'data_transfer' field. """
+        progress = TransferProgress(self.metadata, uid, file_infos)
+
+        def fetch(file_info):
+            local_file = os.path.join(filepath, file_info['filename'])
+            if os.path.exists(local_file):
+                logging.info("Requested data exists on node: {}".format(local_file))
+                with self.tracer.span(file_info['filename'], 'decompress'):
+                    local_files = extract_file(local_file)
+            else:
+                progress.update(file_info, 'Downloading')
+                local_files = self.download(url, user, token,
+                                            file_info['shock_id'], filepath)
+            file_info['local_file'] = local_files[0]
+            file_info['local_files'] = local_files # Archives may hold several
+            progress.update(file_info, 'Complete')
+            return local_files
+
+        num_threads = max(1, min(self.download_threads, len(file_infos)))
+        pool = ThreadPool(num_threads)
+        try:
+            for _ in pool.imap_unordered(fetch, file_infos):
+                pass
+        finally:
+            pool.close()
+            pool.join()
 
     def _get_data_old(self, body):
         params = json.loads(body)
@@ -172,8 +288,8 @@ class ArastConsumer:
                     for word in l:
                         if is_filename(word):
                             baseword = os.path.basename(word)
-                            filedict['files'].append(
-                                extract_file(os.path.join(filepath,  baseword)))
+                            filedict['files'] += extract_file(
+                                os.path.join(filepath,  baseword))
                         else:
                             kv = word.split('=')
                             filedict[kv[0]] = kv[1]
@@ -187,8 +303,8 @@ class ArastConsumer:
                         filedict = {'type':'single', 'files':[]}    
                         if is_filename(wordpath):
                             baseword = os.path.basename(wordpath)
-                            filedict['files'].append(
-                                extract_file(os.path.join(filepath, baseword)))
+                            filedict['files'] += extract_file(
+                                os.path.join(filepath, baseword))
                         else:
                             kv = word.split('=')
                             filedict[kv[0]] = kv[1]
@@ -203,8 +319,8 @@ class ArastConsumer:
                         filedict = {'type':'reference', 'files':[]}    
                         if is_filename(wordpath):
                             baseword = os.path.basename(wordpath)
-                            filedict['files'].append(
-                                extract_file(os.path.join(filepath, baseword)))
+                            filedict['files'] += extract_file(
+                                os.path.join(filepath, baseword))
                         else:
                             kv = word.split('=')
                             filedict[kv[0]] = kv[1]
@@ -226,7 +342,7 @@ class ArastConsumer:
                 req_space = 0
                 for file_size in data_doc['file_sizes']:
                     req_space += file_size
-                self.garbage_collect(self.datapath, user, req_space)
+                self.evictor.make_space(req_space)
             except:
                 pass 
             url = "http://%s" % (self.shockurl)
@@ -240,15 +356,15 @@ class ArastConsumer:
                             baseword = os.path.basename(word)
                             dl = self.download(url, user, token, 
                                                ids[files.index(baseword)], filepath)
-                            if shock.parse_handle(dl): #Shock handle, get real data
+                            if shock.parse_handle(dl[0]): #Shock handle, get real data
                                 logging.info('Found shock handle, getting real data...')
-                                s_addr, s_id = shock.parse_handle(dl)
+                                s_addr, s_id = shock.parse_handle(dl[0])
                                 s_url = 'http://{}'.format(s_addr)
                                 real_file = self.download(s_url, user, token, 
                                                           s_id, filepath)
-                                filedict['files'].append(real_file)
+                                filedict['files'] += real_file
                             else:
-                                filedict['files'].append(dl)
+                                filedict['files'] += dl
                         elif re.search('=', word):
                             kv = word.split('=')
                             filedict[kv[0]] = kv[1]
@@ -273,15 +389,15 @@ class ArastConsumer:
                             baseword = os.path.basename(word)
                             dl = self.download(url, user, token, 
                                                ids[files.index(baseword)], filepath)
-                            if shock.parse_handle(dl): #Shock handle, get real data
+                            if shock.parse_handle(dl[0]): #Shock handle, get real data
                                 logging.info('Found shock handle, getting real data...')
-                                s_addr, s_id = shock.parse_handle(dl)
+                                s_addr, s_id = shock.parse_handle(dl[0])
                                 s_url = 'http://{}'.format(s_addr)
                                 real_file = self.download(s_url, user, token, 
                                                           s_id, filepath)
-                                filedict['files'].append(real_file)
+                                filedict['files'] += real_file
                             else:
-                                filedict['files'].append(dl)
+                                filedict['files'] += dl
                         elif re.search('=', word):
                             kv = word.split('=')
                             filedict[kv[0]] = kv[1]
@@ -306,15 +422,15 @@ class ArastConsumer:
                             baseword = os.path.basename(word)
                             dl = self.download(url, user, token, 
                                                ids[files.index(baseword)], filepath)
-                            if shock.parse_handle(dl): #Shock handle, get real data
+                            if shock.parse_handle(dl[0]): #Shock handle, get real data
                                 logging.info('Found shock handle, getting real data...')
-                                s_addr, s_id = shock.parse_handle(dl)
+                                s_addr, s_id = shock.parse_handle(dl[0])
                                 s_url = 'http://{}'.format(s_addr)
                                 real_file = self.download(s_url, user, token, 
                                                           s_id, filepath)
-                                filedict['files'].append(real_file)
+                                filedict['files'] += real_file
                             else:
-                                filedict['files'].append(dl)
+                                filedict['files'] += dl
                         elif re.search('=', word):
                             kv = word.split('=')
                             filedict[kv[0]] = kv[1]
@@ -331,10 +447,12 @@ class ArastConsumer:
         error = False
         params = json.loads(body)
         job_id = params['job_id']
-        uid = params['_id']
         user = params['ARASTUSER']
-        token = params['oauth_token']
         pipelines = params['pipeline']
+        fd, trace_log = tempfile.mkstemp(suffix='.trace')
+        os.close(fd)
+        self.tracer = Tracer(trace_log, name='Job {}'.format(job_id))
+        self.pmanager.tracer = self.tracer
 
         #support legacy arast client
         if len(pipelines) > 0:
@@ -342,13 +460,32 @@ class ArastConsumer:
                 pipelines = [pipelines]
                 
         ### Download files (if necessary)
-        datapath, all_files = self.get_data(body)
+        with self.tracer.span('Data transfer', 'fetch'):
+            datapath, all_files = self.get_data(body)
+        try:
+            self.run_job(params, pipelines, datapath, all_files)
+        finally: # Release the data for eviction, even if the job failed
+            for i, job in enumerate(self.job_list):
+                if job['user'] == user and job['job_id'] == job_id:
+                    self.job_list.pop(i)
+            self.evictor.unpin(datapath)
+            self.evictor.touch(datapath)
+
+    def run_job(self, params, pipelines, datapath, all_files):
+        """ Runs the PIPELINES of the job with PARAMS on ALL_FILES, the
+        file sets fetched to DATAPATH, and uploads the results """
+        job_id = params['job_id']
+        uid = params['_id']
+        user = params['ARASTUSER']
+        token = params['oauth_token']
         rawpath = datapath + '/raw/'
         jobpath = os.path.join(datapath, str(job_id))
         try:
             os.makedirs(jobpath)
-        except:
-            raise Exception ('Data Error')
+        except OSError:
+            if not os.path.isdir(jobpath):
+                raise Exception ('Data Error')
+            logging.info('Job directory {} exists, resuming'.format(jobpath))
 
         ### Create job log
         self.out_report_name = '{}/{}_report.txt'.format(jobpath, str(job_id))
@@ -380,18 +517,24 @@ class ArastConsumer:
                     'out_report' : self.out_report,
                     'logfiles': []})
 
+        try:
+            job_data['read_stats'] = self.index_read_stats(params, datapath, reads)
+        except:
+            logging.warning('Read statistics failed: {}'.format(sys.exc_info()[1]))
+            job_data['read_stats'] = {}
+
         self.out_report.write("Arast Pipeline: Job {}\n".format(job_id))
         self.job_list.append(job_data)
         self.start_time = time.time()
         self.done_flag = threading.Event()
-        timer_thread = UpdateTimer(self.metadata, 29, time.time(), uid, self.done_flag)
+        timer_thread = UpdateTimer(self.metadata, 29, time.time(), uid, self.done_flag,
+                                   self.fork_guard)
         timer_thread.start()
         
-        download_ids = {}
-        contig_ids = {}
-
         url = "http://%s" % (self.shockurl)
 #        url += '/node'
+        uploader = ResultUploader(self, url, user, token, uid, self.upload_threads,
+                                  self.fork_guard)
         try:
             include_all_data = params['all_data']
         except:
@@ -410,17 +553,21 @@ class ArastConsumer:
                 for p in pipelines:
                     self.pmanager.validate_pipe(p)
 
-                result_files, summary, contig_files, exceptions = self.run_pipeline(pipelines, job_data, contigs_only=contigs)
+                # Upload each pipeline's assemblies as soon as it completes
+                def upload_contigs(contig_data):
+                    for data in contig_data:
+                        for f in data['files']:
+                            uploader.submit_contigs(os.path.realpath(f))
+
+                result_files, summary, contig_files, exceptions = self.run_pipeline(
+                    pipelines, job_data, contigs_only=contigs, on_pipeline_done=upload_contigs,
+                    sweep=params.get('sweep', 'full'), sweep_budget=params.get('sweep_budget'))
                 for i, f in enumerate(result_files):
                     #fname = os.path.basename(f).split('.')[0]
-                    fname = str(i)
-                    res = self.upload(url, user, token, f)
-                    download_ids[fname] = res['data']['id']
-                    
+                    uploader.submit('result_data', str(i), f)
                 for c in contig_files:
-                    fname = os.path.basename(c).split('.')[0]
-                    res = self.upload(url, user, token, c, filetype='contigs')
-                    contig_ids[fname] = res['data']['id']
+                    uploader.submit_contigs(c)
+                uploader.wait()
 
                 # Check if job completed with no errors
                 if exceptions:
@@ -438,9 +585,6 @@ class ArastConsumer:
                                       format(format_tb(sys.exc_info()[2])))
 
         # Format report
-        for i, job in enumerate(self.job_list):
-            if job['user'] == job_data['user'] and job['job_id'] == job_data['job_id']:
-                self.job_list.pop(i)
         self.done_flag.set()
         new_report = open('{}.tmp'.format(self.out_report_name), 'w')
 
@@ -461,25 +605,100 @@ class ArastConsumer:
         new_report.close()
         os.remove(self.out_report_name)
         shutil.move(new_report.name, self.out_report_name)
-        res = self.upload(url, user, token, self.out_report_name)
-        download_ids['report'] = res['data']['id']
+        uploader.submit('result_data', 'report', self.out_report_name)
+        errors = uploader.wait(raise_errors=False) # Upload spans end up in the trace
+        trace_file = self.tracer.export(os.path.join(jobpath, '{}_trace.json'.format(job_id)))
+        uploader.submit('result_data', 'trace', trace_file)
+        for e in errors + uploader.wait(raise_errors=False):
+            logging.error('Upload failed: {}'.format(e))
+        uploader.close()
 
         # Get location
-        self.metadata.update_job(uid, 'result_data', download_ids)
-        self.metadata.update_job(uid, 'contig_ids', contig_ids)
+        self.metadata.update_job(uid, 'result_data', uploader.ids['result_data'])
+        self.metadata.update_job(uid, 'contig_ids', uploader.ids['contig_ids'])
+        self.metadata.update_job(uid, 'pipelines', job_data.export())
+        self.metadata.update_job(uid, 'pipeline_rusage', job_data.get('pipeline_rusage'))
+        self.metadata.update_job(uid, 'analysis_rusage', job_data.get('analysis_rusage'))
         self.metadata.update_job(uid, 'status', status)
+        self.end_trace()
 
         print '=========== JOB COMPLETE ============'
 
+    def end_trace(self):
+        self.tracer.close(remove=True)
+        self.tracer = Tracer()
+        self.pmanager.tracer = self.tracer
+
+    def index_read_stats(self, params, datapath, reads):
+        """
+        Read statistics of each file in READS (see readstats.read_profile),
+        keyed by path.  They are computed once per data_id and kept in a
+        sidecar file in DATAPATH and in the data's document, so later jobs
+        on any node reuse them.
+        """
+        sidecar = os.path.join(datapath, READ_STATS_FILE)
+        known = {}
+        try:
+            with open(sidecar) as f:
+                for entry in json.load(f):
+                    known[(entry['file'], entry['size'])] = entry
+        except (IOError, ValueError):
+            pass
+        data_doc = self.metadata.get_doc_by_data_id(params['data_id'], params['ARASTUSER'])
+        if data_doc:
+            for entry in data_doc.get('read_stats', []):
+                known.setdefault((entry['file'], entry['size']), entry)
+        entries = []
+        stats = {}
+        changed = False
+        for lib in reads:
+            for f in lib['files']:
+                key = (os.path.basename(f), os.path.getsize(f))
+                entry = known.get(key)
+                if entry is None:
+                    with self.tracer.span(key[0], 'read_stats'):
+                        entry = readstats.read_profile(f)
+                    entry['file'], entry['size'] = key
+                    changed = True
+                else:
+                    readstats.remember(f, entry)
+                entries.append(entry)
+                stats[f] = entry
+        if changed or not os.path.exists(sidecar):
+            with open(sidecar + '.tmp', 'w') as f:
+                json.dump(entries, f)
+            os.rename(sidecar + '.tmp', sidecar)
+            if data_doc:
+                self.metadata.update_job(data_doc['_id'], 'read_stats', entries)
+        return stats
+
     def update_time_record(self):
         elapsed_time = time.time() - self.start_time
         ftime = str(datetime.timedelta(seconds=int(elapsed_time)))
         self.metadata.update_job(uid, 'computation_time', ftime)
 
-    def run_pipeline(self, pipes, job_data, contigs_only=True):
+    def memory_wait(self, job_data, module, memory, committed):
+        """ Record in the job status that MODULE waits for memory """
+        status = 'Waiting for memory:[{}|{:.0f}MB|{:.0f}MB in use]'.format(
+            module, memory, committed)
+        self.metadata.update_job(job_data['uid'], 'status', status)
+
+    def run_pipeline(self, pipes, job_data, contigs_only=True, on_pipeline_done=None,
+                     sweep='full', sweep_budget=None):
         """
         Runs all pipelines in list PIPES
+        Pipelines are compiled into a prefix tree of stages, so a stage
+        shared by several pipelines runs once and its outputs fan out.
+        With SWEEP 'adaptive', parameter ranges are searched in rounds
+        scored by N50 (see pipe.AdaptiveSweep), running at most
+        SWEEP_BUDGET pipelines.
+        ON_PIPELINE_DONE is called with the final contig data of each
+        pipeline as soon as it completes.
         """
+        num_pipes = sum([phelper.count_branches(p) for p in pipes])
+        if self.pmanager.max_pipelines and num_pipes > self.pmanager.max_pipelines:
+            raise phelper.PipelineLimitError('Job expands to {} pipelines, limit is {}'.format(
+                    num_pipes, self.pmanager.max_pipelines))
         all_pipes = []
         for p in pipes:
             all_pipes += self.pmanager.parse_input(p)
@@ -488,254 +707,93 @@ class ArastConsumer:
             print '->'.join(p)
         #include_reads = self.pmanager.output_type(pipeline[-1]) == 'reads'
         include_reads = False
-        pipeline_num = 1
         all_files = []
-        pipe_outputs = []
         logfiles = []
         ale_reports = {}
         final_contigs = []
         final_scaffolds = []
         output_types = []
         exceptions = []
-        num_pipes = len(all_pipes)
-        for pipe in all_pipes:
-            try:
-                #job_data = copy.deepcopy(job_data_global)
-                #job_data['out_report'] = job_data_global['out_report'] 
+
+        search = None
+        if sweep == 'adaptive':
+            search = phelper.AdaptiveSweep(all_pipes, int(sweep_budget or self.sweep_budget))
+            batch = search.next_round()
+        else:
+            batch = all_pipes
+
+        run_pipes = [] # Pipelines in the order they were run
+        results = {}
+        leaves = {}
+        def collect(node):
+            """ Assemble the pipelines that end at NODE """
+            for pipeline_num, pipe in enumerate(run_pipes, 1):
+                if leaves[pipeline_num] is not node or pipeline_num in results:
+                    continue
+                result = self.pipeline_result(pipe, pipeline_num, node, job_data)
+                results[pipeline_num] = result
+                if on_pipeline_done and not result['exception']:
+                    on_pipeline_done(result['final_contigs'] + result['final_scaffolds'])
+
+        root = None
+        sweep_round = 1
+        while batch:
+            plans = []
+            for pipe in batch:
+                run_pipes.append(pipe)
+                pipeline_num = len(run_pipes)
                 pipeline, overrides = self.pmanager.parse_pipe(pipe)
                 job_data.add_pipeline(pipeline_num, pipeline)
-                num_stages = len(pipeline)
-                pipeline_stage = 1
-                pipeline_results = []
-                cur_outputs = []
-
-                # Reset job data 
-                job_data['reads'] = copy.deepcopy(job_data['raw_reads'])
-                job_data['processed_reads'] = []
-                print job_data
-
-                self.out_report.write('\n{0} Pipeline {1}: {2} {0}\n'.format('='*15, pipeline_num, pipe))
-                pipe_suffix = '' # filename code for indiv pipes
-                pipe_start_time = time.time()
-                pipe_alive = True
-
-                # Store data record for pipeline
-
-                for module_name in pipeline:
-                    if not pipe_alive:
-                        self.out_report.write('\n{0} Module Failure, Killing Pipe {0}'.format(
-                                'X'*10))
-                        break
-                    module_code = '' # unique code for data reuse
-                    print '\n\n{0} Running module: {1} {2}'.format(
-                        '='*20, module_name, '='*(35-len(module_name)))
-                    self.garbage_collect(self.datapath, job_data['user'], 2147483648) # 2GB
-
-                    ## PROGRESS CALCULATION
-                    pipes_complete = (pipeline_num - 1) / float(num_pipes)
-                    stage_complete = (pipeline_stage - 1) / float(num_stages)
-                    pct_segment = 1.0 / num_pipes
-                    stage_complete *= pct_segment
-                    total_complete = pipes_complete + stage_complete
-                    cur_state = 'Running:[{}%|P:{}/{}|S:{}/{}|{}]'.format(
-                        int(total_complete * 100), pipeline_num, num_pipes,
-                        pipeline_stage, num_stages, module_name)
-                    self.metadata.update_job(job_data['uid'], 'status', cur_state)
-
-                    ## LOG REPORT For now, module code is 1st and last letter
-                    short_name = self.pmanager.get_short_name(module_name)
-                    if short_name:
-                        #pipe_suffix += short_name.capitalize()
-                        module_code += short_name.capitalize()
-                    else:
-                        #pipe_suffix += module_name[0].upper() + module_name[-1]
-                        module_code += module_name[0].upper() + module_name[-1]
-                    mod_overrides =  overrides[pipeline_stage - 1]
-                    for k in mod_overrides.keys():
-                                #pipe_suffix += '_{}{}'.format(k[0], par[k])
-                        module_code += '_{}{}'.format(k[0], mod_overrides[k])
-                    pipe_suffix += module_code
-                    self.out_report.write('PIPELINE {} -- STAGE {}: {}\n'.format(
-                            pipeline_num, pipeline_stage, module_name))
-                    logging.debug('New job_data for stage {}: {}'.format(
-                            pipeline_stage, job_data))
-                    job_data['params'] = overrides[pipeline_stage-1].items()
-                    module_start_time = time.time()
-                    ## RUN MODULE
-                    # Check if output data exists
-                    reuse_data = False
-                    enable_reuse = True # KILL SWITCH
-                    if enable_reuse:
-                        for k, pipe in enumerate(pipe_outputs):
-                            if reuse_data:
-                                break
-                            if not pipe:
-                                continue
-                            # Check that all previous pipes match
-                            for i in range(pipeline_stage):
-                                try:
-                                    if not pipe[i][0] == cur_outputs[i][0]:
-                                        break
-                                except:
-                                    pass
-                                try:
-                                    if (pipe[i][0] == module_code and i == pipeline_stage - 1):
-                                        #and overrides[i].items() == job_data['params']): #copy!
-                                        print('Found previously computed data, reusing {}.'.format(
-                                                module_code))
-                                        output = [] + pipe[i][1]
-                                        pfix = (k+1, i+1)
-                                        alldata = [] + pipe[i][2]
-                                        reuse_data = True
-                                        job_data.get_pipeline(pipeline_num).get_module(
-                                            pipeline_stage)['elapsed_time'] = time.time(
-                                            job_data.get_pipeline(i).get_module(
-                                                    pipeline_stage)['elapsed_time'])
-
-                                        break
-                                except: # Previous pipes may be shorter
-                                    pass
-
-                    output_type = self.pmanager.output_type(module_name)
-
-                    if not reuse_data:
-                        output, alldata, mod_log = self.pmanager.run_module(
-                            module_name, job_data, all_data=True, reads=include_reads)
-
-                        ##### Module produced no output, attach log and proceed to next #####
-                        if not output:
-                            pipe_alive = False
-                            try:
-                                print mod_log
-                                logfiles.append(mod_log)
-                            except:
-                                print 'error attaching ', mod_log
-                            break
-
-
-                        ##### Prefix outfiles with pipe stage (only assembler modules) #####
-                        alldata = [asm.prefix_file_move(
-                                file, "P{}_S{}_{}".format(pipeline_num, pipeline_stage, module_name)) 
-                                    for file in alldata]
-                        module_elapsed_time = time.time() - module_start_time
-                        job_data.get_pipeline(pipeline_num).get_module(
-                            pipeline_stage)['elapsed_time'] = module_elapsed_time
-
-
-                        if alldata: #If log was renamed
-                            mod_log = asm.prefix_file(mod_log, "P{}_S{}_{}".format(
-                                    pipeline_num, pipeline_stage, module_name))
-
-                    if output_type == 'contigs' or output_type == 'scaffolds': #Assume assembly contigs
-                        if reuse_data:
-                            p_num, p_stage = pfix
-                        else:
-                            p_num, p_stage = pipeline_num, pipeline_stage
-
-                        # If plugin returned scaffolds
-                        if type(output) is tuple and len(output) == 2:
-                            out_contigs = output[0]
-                            out_scaffolds = output[1]
-                            cur_scaffolds = [asm.prefix_file(
-                                    file, "P{}_S{}_{}".format(p_num, p_stage, module_name)) 
-                                        for file in out_scaffolds]
-                        else:
-                            out_contigs = output
-                        cur_contigs = [asm.prefix_file(
-                                file, "P{}_S{}_{}".format(p_num, p_stage, module_name)) 
-                                    for file in out_contigs]
-
-                        #job_data['reads'] = asm.arast_reads(alldata)
-                        job_data['contigs'] = cur_contigs
-
-                    elif output_type == 'reads': #Assume preprocessing
-                        if include_reads and reuse_data: # data was prefixed and moved
-                            for d in output:
-                                files = [asm.prefix_file(f, "P{}_S{}_{}".format(
-                                            pipeline_num, pipeline_stage, module_name)) for f in d['files']]
-                                d['files'] = files
-                                d['short_reads'] = [] + files
-                        job_data['reads'] = output
-                        job_data['processed_reads'] = list(job_data['reads'])
-                        
-                    else: # Generic return, don't use in further stages
-                        pipeline_results += output
-                        logging.info('Generic plugin output: {}'.format(output))
-   
-
-                    if pipeline_stage == num_stages: # Last stage, add contig for assessment
-                        if output and (output_type == 'contigs' or output_type == 'scaffolds'): #If a contig was produced
-                            fcontigs = cur_contigs
-                            rcontigs = [asm.rename_file_symlink(f, 'P{}_{}'.format(
-                                        pipeline_num, pipe_suffix)) for f in fcontigs]
-                            try:
-                                rscaffolds = [asm.rename_file_symlink(f, 'P{}_{}_{}'.format(
-                                            pipeline_num, pipe_suffix, 'scaff')) for f in cur_scaffolds]
-                                if rscaffolds:
-                                    scaffold_data = {'files': rscaffolds, 'name': pipe_suffix}
-                                    final_scaffolds.append(scaffold_data)
-                                    output_types.append(output_type)
-                            except:
-                                pass
-                            if rcontigs:
-                                contig_data = {'files': rcontigs, 'name': pipe_suffix, 'alignment_bam': []}
-                                final_contigs.append(contig_data)
-                                output_types.append(output_type)
-                    try:
-                        logfiles.append(mod_log)
-                    except:
-                        print 'error attaching ', mod_log
-                    pipeline_stage += 1
-                    cur_contigs = []
-                    cur_scaffolds = []
-
-                    cur_outputs.append([module_code, output, alldata])
-                pipe_elapsed_time = time.time() - pipe_start_time
-                pipe_ftime = str(datetime.timedelta(seconds=int(pipe_elapsed_time)))
-                job_data.get_pipeline(pipeline_num)['elapsed_time'] = pipe_elapsed_time
-
-
-
-                if not output:
-                    self.out_report.write('ERROR: No contigs produced. See module log\n')
-                else:
-
-                    ## Assessment
-                    #self.pmanager.run_module('reapr', job_data)
-                    #print job_data
-                    # TODO reapr break may be diff from final reapr align!
-                    # ale_out, _, _ = self.pmanager.run_module('ale', job_data)
-                    # if ale_out:
-                    #     job_data.get_pipeline(pipeline_num).import_ale(ale_out)
-                    #     ale_reports[pipe_suffix] = ale_out
-                    pipeline_datapath = '{}/{}/pipeline{}/'.format(job_data['datapath'], 
-                                                                   job_data['job_id'],
-                                                                   pipeline_num)
-                    try:
-                        os.makedirs(pipeline_datapath)
-                    except:
-                        logging.info("{} exists, skipping mkdir".format(pipeline_datapath))
-
-                    # all_files.append(asm.tar_list(pipeline_datapath, pipeline_results, 
-                    #                     'pipe{}_{}.tar.gz'.format(pipeline_num, pipe_suffix)))
-
-                    all_files += pipeline_results
-
-                self.out_report.write('Pipeline {} total time: {}\n\n'.format(pipeline_num, pipe_ftime))
-                job_data.get_pipeline(pipeline_num)['name'] = pipe_suffix
-                pipe_outputs.append(cur_outputs)
-                pipeline_num += 1
-
-            except:
-                print "ERROR: Pipeline #{} Failed".format(pipeline_num)
-                print format_exc(sys.exc_info())
-                e = str(sys.exc_info()[1])
-                if e.find('Terminated') != -1:
-                    raise Exception(e)
-                exceptions.append(module_name + ':\n' + str(sys.exc_info()[1]))
-                pipeline_num += 1
+                plans.append((pipeline_num, pipeline, overrides))
+            root, batch_leaves = phelper.build_stage_tree(plans, root)
+            leaves.update(batch_leaves)
+            logging.info('{} pipelines, {} module runs'.format(
+                    len(run_pipes), len(list(phelper.iter_stages(root)))))
+            for pipeline_num, leaf in batch_leaves.items():
+                if leaf is root: # Empty pipeline
+                    results[pipeline_num] = new_pipeline_result(pipeline_num)
+            if search:
+                self.out_report.write('\n{0} Adaptive sweep round {1}: {2} pipelines {0}\n'.format(
+                        '='*15, sweep_round, len(batch)))
+            self.run_stage_tree(root, job_data, include_reads=include_reads,
+                                on_node_done=collect)
+            for leaf in batch_leaves.values():
+                if leaf.result is not None: # Ended at a stage of an earlier round
+                    collect(leaf)
+            if not search:
+                break
+            for pipeline_num, _, _ in plans:
+                search.report(run_pipes[pipeline_num - 1],
+                              self.score_pipeline(job_data, results[pipeline_num]))
+            batch = search.next_round()
+            sweep_round += 1
+
+        if search:
+            best, score = search.best()
+            self.out_report.write('Adaptive sweep: ran {} of {} pipelines, best {} (N50, length: {})\n'.format(
+                    search.count(), len(all_pipes), best, score))
+
+        for pipeline_num in sorted(results.keys()):
+            result = results[pipeline_num]
+            all_files += result['files']
+            logfiles += result['logfiles']
+            final_contigs += result['final_contigs']
+            final_scaffolds += result['final_scaffolds']
+            output_types += result['output_types']
+            if result['exception']:
+                exceptions.append(result['exception'])
+
+        # Job totals count a stage shared by several pipelines once
+        job_data['pipeline_rusage'] = new_rusage()
+        if root is not None:
+            for node in phelper.iter_stages(root):
+                if node.result and node.result['rusage']:
+                    add_rusage(job_data['pipeline_rusage'], node.result['rusage'])
 
         ## ANALYSIS: Quast
+        # Assessment is charged to the job, not to the last stage run
+        self.pmanager.rusage = new_rusage()
+        job_data['analysis_rusage'] = self.pmanager.rusage
         job_data['final_contigs'] = final_contigs
         job_data['final_scaffolds'] = final_scaffolds
         job_data['params'] = [] #clear overrides from last stage
@@ -744,8 +802,9 @@ class ArastConsumer:
         try: #Try to assess, otherwise report pipeline errors
             if job_data['final_contigs']:
                     job_data['contig_type'] = 'contigs'
-                    quast_report, quast_tar, z1, q_log = self.pmanager.run_module('quast', job_data, 
-                                                                                  tar=True, meta=True)
+                    with self.tracer.span('quast', 'quast', contig_type='contigs'):
+                        quast_report, quast_tar, z1, q_log = self.pmanager.run_module(
+                            'quast', job_data, tar=True, meta=True)
                     if quast_report:
                         summary.append(quast_report[0])
                     with open(q_log) as infile:
@@ -757,8 +816,9 @@ class ArastConsumer:
                 scaff_data = dict(job_data)
                 scaff_data['final_contigs'] = job_data['final_scaffolds']
                 scaff_data['contig_type'] = 'scaffolds'
-                scaff_report, scaff_tar, _, scaff_log = self.pmanager.run_module('quast', scaff_data, 
-                                                                          tar=True, meta=True)
+                with self.tracer.span('quast', 'quast', contig_type='scaffolds'):
+                    scaff_report, scaff_tar, _, scaff_log = self.pmanager.run_module(
+                        'quast', scaff_data, tar=True, meta=True)
                 scaffold_quast = True
                 if scaff_report:
                     summary.append(scaff_report[0])
@@ -824,14 +884,389 @@ class ArastConsumer:
             #     raise Exception(exceptions[0])
 
         if contig_files:
-            return_files.append(asm.tar_list('{}/{}'.format(job_data['datapath'], job_data['job_id']),
-                                             contig_files, '{}_assemblies.tar.gz'.format(
-                        job_data['job_id'])))
+            with self.tracer.span('{}_assemblies.tar.gz'.format(job_data['job_id']), 'tar'):
+                return_files.append(asm.tar_list('{}/{}'.format(job_data['datapath'], job_data['job_id']),
+                                                 contig_files, '{}_assemblies.tar.gz'.format(
+                            job_data['job_id'])))
         print "return files: {}".format(return_files)
 
         return return_files, summary, contig_files, exceptions
 
 
+    def score_pipeline(self, job_data, result):
+        """ Returns (N50, total length) of a pipeline's contigs, or None """
+        if result['exception'] or not result['final_contigs']:
+            return None
+        try:
+            n50, total, num_contigs = asm.contig_stats(result['final_contigs'][0]['files'][0])
+        except (IOError, IndexError):
+            return None
+        stats = job_data.get_pipeline(result['number'])['stats']
+        stats['N50'] = n50
+        stats['total_length'] = total
+        stats['num_contigs'] = num_contigs
+        return n50, total
+
+    def run_stage_tree(self, root, job_data, include_reads=False, on_node_done=None):
+        """
+        Runs every stage in the prefix tree ROOT once, after its parent.
+        Stages that ran in an earlier call are not run again, and stages
+        with a valid checkpoint from an interrupted run are restored.
+        Stages on different branches run in forked processes, at most
+        self.pipeline_concurrency at a time, each with an equal share of
+        the node's core budget.  ON_NODE_DONE is called for each stage
+        once it is complete, failed or skipped.
+        """
+        nodes = [n for n in phelper.iter_stages(root) if n.result is None]
+        num_nodes = len(nodes)
+        num_pipes = len(root.pipelines)
+        num_branches = len([n for n in nodes if not n.children])
+        concurrency = max(1, min(self.pipeline_concurrency, num_branches))
+        if concurrency > 1:
+            self.wait_prefetch() # Stages are forked
+            if not self.pmanager.scheduler:
+                self.pmanager.thread_budget = max(1, self.pipeline_cores / concurrency)
+        jobpath = os.path.join(job_data['datapath'], str(job_data['job_id']))
+        queue = multiprocessing.Queue()
+        ready = list(root.children)
+        running = {}
+        done = set([n.number for n in phelper.iter_stages(root) if n.result is not None])
+        checkpoints = self.metadata.get_checkpoints(job_data['uid'])
+        nodes_done = 0
+        try:
+            while ready or running:
+                if ready and len(running) < concurrency:
+                    node = ready.pop(0)
+                    if node.result is not None: # Ran in an earlier call
+                        if node.result['status'] == 'complete':
+                            ready = node.children + ready
+                            continue
+                    else:
+                        node.result = self.restore_checkpoint(node, job_data, checkpoints)
+                    if node.result is None:
+                        ## PROGRESS CALCULATION
+                        cur_state = 'Running:[{}%|P:{}/{}|S:{}/{}|{}]'.format(
+                            int(100 * nodes_done / float(num_nodes)), node.pipelines[0], num_pipes,
+                            nodes_done + 1, num_nodes, node.module)
+                        self.metadata.update_job(job_data['uid'], 'status', cur_state)
+                        if concurrency > 1:
+                            report = os.path.join(jobpath, 'stage{}_report.txt'.format(node.number))
+                            p = multiprocessing.Process(
+                                target=self._run_stage_branch,
+                                args=(queue, node, job_data, include_reads, report))
+                            with self.fork_guard.forking():
+                                p.start()
+                            running[node.number] = (node, p)
+                            continue
+                        node.result = self.run_stage(node, job_data,
+                                                     include_reads=include_reads)
+                else:
+                    number, result = self.wait_stage(queue, running)
+                    node, p = running.pop(number)
+                    p.join()
+                    node.result = result
+                    report = os.path.join(jobpath, 'stage{}_report.txt'.format(number))
+                    try:
+                        with open(report) as f:
+                            self.out_report.write(f.read())
+                        os.remove(report)
+                    except (IOError, OSError):
+                        pass
+                if node.number not in done:
+                    done.add(node.number)
+                    nodes_done += 1
+                    if node.result['terminated']:
+                        raise Exception(node.result['exception'])
+                    if node.result['status'] == 'complete' and not node.result['restored']:
+                        self.save_checkpoint(node, job_data)
+                    if on_node_done:
+                        on_node_done(node)
+                if node.result['status'] == 'complete':
+                    ready = node.children + ready # Depth first
+                    continue
+                for skipped in phelper.iter_stages(node):
+                    if skipped.result is not None:
+                        continue
+                    skipped.result = new_stage_result('skipped')
+                    nodes_done += 1
+                    if on_node_done:
+                        on_node_done(skipped)
+        finally:
+            for node, p in running.values():
+                try:
+                    os.killpg(p.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            self.pmanager.thread_budget = None
+
+    def wait_stage(self, queue, running):
+        """ Wait for one of the RUNNING forked stages to finish, returns its
+        number and result.  A child that died without a result (killed for
+        memory, crashed) is returned as a failed stage. """
+        while True:
+            try:
+                return queue.get(timeout=STAGE_POLL_INTERVAL)
+            except Queue.Empty:
+                pass
+            for number, (node, p) in running.items():
+                if p.is_alive():
+                    continue
+                try: # Its result may have arrived since
+                    return queue.get(timeout=1)
+                except Queue.Empty:
+                    pass
+                result = new_stage_result('failed')
+                result['exception'] = '{}:\nStage process exited with code {}'.format(
+                    node.module, p.exitcode)
+                return number, result
+
+    def checkpoint_key(self, node):
+        return hashlib.sha1(json.dumps(node.key)).hexdigest()
+
+    def file_digest(self, filename):
+        if self.pmanager.module_cache: # Remembers digests by inode
+            return self.pmanager.module_cache.digest(filename)
+        return shock.file_md5(filename)
+
+    def save_checkpoint(self, node, job_data):
+        """ Record the result of completed stage NODE in the job document,
+        with the checksums of the files it produced in the job directory """
+        jobpath = os.path.join(job_data['datapath'], str(job_data['job_id']))
+        files = []
+        try:
+            for f in sorted(set(iter_strings(node.result))):
+                if os.path.isabs(f) and os.path.isfile(f) and is_under(f, jobpath):
+                    files.append([f, os.path.getsize(f), self.file_digest(f)])
+            record = {'module': node.module,
+                      'params': node.params,
+                      'host': socket.gethostname(),
+                      'files': files,
+                      'result': node.result}
+            self.metadata.update_job(job_data['uid'],
+                                     'checkpoints.' + self.checkpoint_key(node), record)
+        except:
+            logging.warning('Could not checkpoint stage {}: {}'.format(
+                    node.module, sys.exc_info()[1]))
+
+    def restore_checkpoint(self, node, job_data, checkpoints):
+        """ Result of stage NODE from an interrupted run of the job, or
+        None if it has no checkpoint or its files are missing or changed """
+        record = checkpoints.get(self.checkpoint_key(node))
+        if not record:
+            return None
+        for filename, size, md5 in record['files']:
+            if (not os.path.isfile(filename) or os.path.getsize(filename) != size or
+                self.file_digest(filename) != md5):
+                logging.info('Checkpoint of stage {} is stale: {}'.format(node.module, filename))
+                return None
+        logging.info('Restoring stage {} from checkpoint'.format(node.module))
+        self.out_report.write('PIPELINE {} -- STAGE {}: {} (restored from checkpoint)\n'.format(
+                ','.join([str(n) for n in node.pipelines]), node.depth, node.module))
+        result = new_stage_result()
+        result.update(record['result'])
+        result['restored'] = True
+        return result
+
+    def run_stage(self, node, job_data, include_reads=False):
+        """
+        Runs the module of stage NODE on the data its parent stage produced.
+        Returns a dict of the outputs and of the reads and contigs passed
+        on to child stages.
+        """
+        pipeline_num = node.pipelines[0] # Outputs are named after the first pipeline
+        pipeline_stage = node.depth
+        module_name = node.module
+        prefix = "P{}_S{}_{}".format(pipeline_num, pipeline_stage, module_name)
+        result = new_stage_result()
+        if node.parent.result is None: # First stage
+            result['reads'] = copy.deepcopy(job_data['raw_reads'])
+        else:
+            parent = node.parent.result
+            result['reads'] = copy.deepcopy(parent['reads'])
+            result['processed_reads'] = copy.deepcopy(parent['processed_reads'])
+            result['contigs'] = list(parent['contigs'])
+        print '\n\n{0} Running module: {1} {2}'.format(
+            '='*20, module_name, '='*(35-len(module_name)))
+        self.out_report.write('PIPELINE {} -- STAGE {}: {}\n'.format(
+                ','.join([str(n) for n in node.pipelines]), pipeline_stage, module_name))
+        job_data['reads'] = result['reads']
+        job_data['processed_reads'] = result['processed_reads']
+        job_data['contigs'] = result['contigs']
+        job_data['params'] = node.params.items()
+        logging.debug('New job_data for stage {}: {}'.format(pipeline_stage, job_data))
+        module_start_time = time.time()
+        try:
+            ## RUN MODULE
+            self.pmanager.rusage = new_rusage()
+            result['rusage'] = self.pmanager.rusage
+            output, alldata, mod_log = self.pmanager.run_module(
+                module_name, job_data, all_data=True, reads=include_reads)
+            result['log'] = mod_log
+
+            ##### Module produced no output, attach log and proceed to next #####
+            if not output:
+                result['status'] = 'no output'
+                return result
+
+            ##### Prefix outfiles with pipe stage #####
+            alldata = [asm.prefix_file_move(file, prefix) for file in alldata]
+            if alldata: #If log was renamed
+                result['log'] = asm.prefix_file(mod_log, prefix)
+
+            output_type = self.pmanager.output_type(module_name)
+            result['output_type'] = output_type
+            if output_type == 'contigs' or output_type == 'scaffolds': #Assume assembly contigs
+                # If plugin returned scaffolds
+                if type(output) is tuple and len(output) == 2:
+                    out_contigs = output[0]
+                    result['scaffolds'] = [asm.prefix_file(file, prefix)
+                                           for file in output[1]]
+                else:
+                    out_contigs = output
+                result['contigs'] = [asm.prefix_file(file, prefix) for file in out_contigs]
+
+            elif output_type == 'reads': #Assume preprocessing
+                if include_reads: # data was prefixed and moved
+                    for d in output:
+                        d['files'] = [asm.prefix_file(f, prefix) for f in d['files']]
+                        d['short_reads'] = [] + d['files']
+                result['reads'] = output
+                result['processed_reads'] = list(output)
+
+            else: # Generic return, don't use in further stages
+                result['generic'] = output
+                logging.info('Generic plugin output: {}'.format(output))
+            result['output'] = output
+            result['status'] = 'complete'
+        except:
+            print "ERROR: Stage {} Failed".format(prefix)
+            print format_exc(sys.exc_info())
+            e = str(sys.exc_info()[1])
+            if e.find('Terminated') != -1:
+                result['terminated'] = True
+            result['exception'] = module_name + ':\n' + e
+            result['status'] = 'failed'
+        result['start_time'] = module_start_time
+        result['elapsed_time'] = time.time() - module_start_time
+        self.tracer.complete(module_name, 'module', module_start_time, time.time(),
+                             stage=pipeline_stage, pipelines=node.pipelines,
+                             params=node.params, status=result['status'])
+        return result
+
+    def _run_stage_branch(self, queue, node, job_data, include_reads, report):
+        """ Forked child of run_stage_tree """
+        os.setpgid(0, 0)
+        self.fork_guard = ForkGuard()
+        def terminate(signum, frame):
+            self.pmanager.kill_active()
+            os._exit(1)
+        signal.signal(signal.SIGTERM, terminate)
+        self.metadata = self.connect_metadata() # Mongo connections are not fork-safe
+        self.out_report = open(report, 'w')
+        job_data['out_report'] = self.out_report
+        try:
+            result = self.run_stage(node, job_data, include_reads=include_reads)
+        except:
+            result = new_stage_result('failed')
+            result['exception'] = node.module + ':\n' + str(sys.exc_info()[1])
+        self.out_report.close()
+        queue.put((node.number, result))
+
+    def pipeline_result(self, pipe, pipeline_num, leaf, job_data):
+        """
+        Collects the stage results along the path to LEAF into the
+        results of pipeline PIPELINE_NUM.
+        """
+        result = new_pipeline_result(pipeline_num)
+        record = job_data.get_pipeline(pipeline_num)
+        self.out_report.write('\n{0} Pipeline {1}: {2} {0}\n'.format('='*15, pipeline_num, pipe))
+        pipe_suffix = '' # filename code for indiv pipes
+        pipe_elapsed_time = 0
+        pipe_rusage = new_rusage()
+        pipe_span = [] # Start and end times of the stages run for this job
+        output = None
+        stage = None
+        try:
+            for node in leaf.path():
+                stage = node.result
+                pipe_suffix += self.module_code(node.module, node.params)
+                if stage['status'] == 'skipped':
+                    break
+                if node.pipelines[0] == pipeline_num:
+                    if stage['log']:
+                        result['logfiles'].append(stage['log'])
+                else:
+                    self.out_report.write('Stage {}: reusing {} from pipeline {}\n'.format(
+                            node.depth, node.module, node.pipelines[0]))
+                    record.get_module(node.depth)['reused_from'] = node.pipelines[0]
+                if stage['rusage']:
+                    record.get_module(node.depth)['rusage'] = stage['rusage']
+                    add_rusage(pipe_rusage, stage['rusage'])
+                if stage['status'] == 'failed':
+                    result['exception'] = stage['exception']
+                    break
+                if stage['status'] != 'complete':
+                    output = None
+                    break
+                record.get_module(node.depth)['elapsed_time'] = stage['elapsed_time']
+                record.get_module(node.depth)['checkpoint'] = self.checkpoint_key(node)
+                pipe_elapsed_time += stage['elapsed_time']
+                if not stage['restored']:
+                    pipe_span += [stage['start_time'], stage['start_time'] + stage['elapsed_time']]
+                output = stage['output']
+                result['files'] += stage['generic']
+            record['elapsed_time'] = pipe_elapsed_time
+            record['rusage'] = pipe_rusage
+            if pipe_span:
+                self.tracer.complete('Pipeline {}'.format(pipeline_num), 'pipeline',
+                                     min(pipe_span), max(pipe_span), pipe=pipe)
+            pipe_ftime = str(datetime.timedelta(seconds=int(pipe_elapsed_time)))
+
+            if not output:
+                result['files'] = []
+                self.out_report.write('ERROR: No contigs produced. See module log\n')
+            else:
+                output_type = stage['output_type']
+                if output_type == 'contigs' or output_type == 'scaffolds': # Add contig for assessment
+                    rcontigs = [asm.rename_file_symlink(f, 'P{}_{}'.format(
+                                pipeline_num, pipe_suffix)) for f in stage['contigs']]
+                    rscaffolds = [asm.rename_file_symlink(f, 'P{}_{}_{}'.format(
+                                pipeline_num, pipe_suffix, 'scaff')) for f in stage['scaffolds']]
+                    if rscaffolds:
+                        scaffold_data = {'files': rscaffolds, 'name': pipe_suffix}
+                        result['final_scaffolds'].append(scaffold_data)
+                        result['output_types'].append(output_type)
+                    if rcontigs:
+                        contig_data = {'files': rcontigs, 'name': pipe_suffix, 'alignment_bam': []}
+                        result['final_contigs'].append(contig_data)
+                        result['output_types'].append(output_type)
+                pipeline_datapath = '{}/{}/pipeline{}/'.format(job_data['datapath'], 
+                                                               job_data['job_id'],
+                                                               pipeline_num)
+                try:
+                    os.makedirs(pipeline_datapath)
+                except:
+                    logging.info("{} exists, skipping mkdir".format(pipeline_datapath))
+
+            self.out_report.write('Pipeline {} total time: {}\n\n'.format(pipeline_num, pipe_ftime))
+            record['name'] = pipe_suffix
+        except:
+            print "ERROR: Pipeline #{} Failed".format(pipeline_num)
+            print format_exc(sys.exc_info())
+            result['exception'] = str(sys.exc_info()[1])
+        return result
+
+    def module_code(self, module_name, overrides):
+        """ Short code naming a stage in pipeline output filenames """
+        short_name = self.pmanager.get_short_name(module_name)
+        if short_name:
+            module_code = short_name.capitalize()
+        else:
+            module_code = module_name[0].upper() + module_name[-1]
+        for k in overrides.keys():
+            module_code += '_{}{}'.format(k[0], overrides[k])
+        return module_code
+
     def upload(self, url, user, token, file, filetype='default'):
         files = {}
         files["file"] = (os.path.basename(file), open(file, 'rb'))
@@ -844,9 +1279,14 @@ class ArastConsumer:
         return res
 
     def download(self, url, user, token, node_id, outdir):
+        """ Fetch NODE_ID into OUTDIR, returns list of extracted files.
+        Compressed data is decompressed while it downloads. """
         sclient = shock.Shock(url, user, token)
-        downloaded = sclient.curl_download_file(node_id, outdir=outdir)
-        return extract_file(downloaded)
+        with self.tracer.span(node_id, 'fetch', streaming_extraction=True):
+            downloaded = self.cache.fetch(sclient, node_id, outdir,
+                                          extractor=stream_extractor)
+        with self.tracer.span(os.path.basename(downloaded), 'decompress'):
+            return extract_file(downloaded)
 
     def fetch_job(self):
         connection = pika.BlockingConnection(pika.ConnectionParameters(
@@ -861,6 +1301,10 @@ class ArastConsumer:
         logging.basicConfig(format=("%(asctime)s %s %(levelname)-8s %(message)s",proc().name))
         print proc().name, ' [*] Fetching job...'
 
+        if self.prefetch:
+            self.consume_with_prefetch(channel)
+            return
+
         channel.basic_qos(prefetch_count=1)
         channel.basic_consume(self.callback,
                               queue=self.queue)
@@ -868,6 +1312,31 @@ class ArastConsumer:
 
         channel.start_consuming()
 
+    def consume_with_prefetch(self, channel):
+        """ Reserve the next job while the current one computes and fetch
+        its data into the cache in the background.  The reserved message
+        stays unacked, so RabbitMQ requeues it if this worker dies. """
+        current = None
+        while True:
+            if current is None:
+                method, properties, body = channel.basic_get(queue=self.queue)
+                if method is None:
+                    time.sleep(2)
+                    continue
+                current = (method, properties, body)
+
+            method, properties, body = channel.basic_get(queue=self.queue)
+            reserved = None
+            if method is not None:
+                if self.prefetch_data(body):
+                    reserved = (method, properties, body)
+                else: # Let another node take it
+                    channel.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
+
+            method, properties, body = current
+            self.callback(channel, method, properties, body)
+            current = reserved
+
     def callback(self, ch, method, properties, body):
         print " [*] %r:%r" % (method.routing_key, body)
         params = json.loads(body)
@@ -884,6 +1353,7 @@ class ArastConsumer:
                 status = "[FAIL] {}".format(format_tb(sys.exc_info()[2]))
                 print logging.error(status)
                 self.metadata.update_job(uid, 'status', status)
+                self.end_trace()
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
     def start(self):
@@ -903,27 +1373,31 @@ def touch(path):
         open(path, "w").close()
         os.utime(path, (now, now))
     
-def extract_file(filename):
-    """ Decompress files if necessary """
-    filepath = os.path.dirname(filename)
-    supported = ['tar.gz', 'tar.bz2', 'bz2', 'gz', 'lz', 
-                 'rar', 'tar', 'tgz','zip']
-    for ext in supported:
-        if filename.endswith(ext):
-            extracted_file = filename[:filename.index(ext)-1]
-            if os.path.exists(extracted_file): # Check extracted already
-                return extracted_file
-            logging.debug("Extracting %s" % filename)
-            p = subprocess.Popen(['unp', filename], 
-                                 cwd=filepath, stderr=subprocess.STDOUT)
-            p.wait()
-            if os.path.exists(extracted_file):
-                return extracted_file
-            else:
-                print "{} does not exist!".format(extracted_file)
-                raise Exception('Archive structure error')
-    logging.debug("Could not extract %s" % filename)
-    return filename            
+def new_pipeline_result(pipeline_num):
+    return {'number': pipeline_num,
+            'final_contigs': [],
+            'final_scaffolds': [],
+            'output_types': [],
+            'files': [],
+            'logfiles': [],
+            'exception': None}
+
+def new_stage_result(status=None):
+    return {'status': status,
+            'output': None,
+            'output_type': None,
+            'log': None,
+            'reads': [],
+            'processed_reads': [],
+            'contigs': [],
+            'scaffolds': [],
+            'generic': [],
+            'start_time': None,
+            'elapsed_time': 0,
+            'exception': None,
+            'terminated': False,
+            'restored': False,
+            'rusage': None}
 
 def is_filename(word):
     return word.find('.') != -1 and word.find('=') == -1
@@ -936,10 +1410,123 @@ def list_io_basenames(job_data):
             basenames.append(os.path.basename(f))
     return basenames
 
+class ForkGuard:
+    """ Keeps the worker's threads out of the way while it forks stages.
+    A child forked while another thread holds a lock (logging, a Mongo or
+    HTTP connection pool) inherits it held, and deadlocks when it takes it.
+    Threads do their work in busy(); forking() waits for that work to
+    finish and holds off new work until the child has started. """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.active = 0
+        self.forks = 0
+
+    @contextmanager
+    def busy(self):
+        with self.cond:
+            while self.forks:
+                self.cond.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    @contextmanager
+    def forking(self):
+        with self.cond:
+            self.forks += 1
+            while self.active:
+                self.cond.wait()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.forks -= 1
+                self.cond.notify_all()
+
+class ResultUploader:
+    """ Uploads job results to Shock on a bounded thread pool.  Each node id
+    is recorded on the job ('result_data' or 'contig_ids') as soon as its
+    upload completes. """
+    def __init__(self, consumer, url, user, token, uid, num_threads, guard=None):
+        self.consumer = consumer
+        self.guard = guard or ForkGuard()
+        self.url = url
+        self.user = user
+        self.token = token
+        self.uid = uid
+        self.pool = ThreadPool(max(1, num_threads))
+        self.lock = threading.Lock()
+        self.ids = {'result_data': {}, 'contig_ids': {}}
+        self.submitted = set()
+        self.pending = []
+
+    def submit(self, field, name, filename, filetype='default'):
+        if filename in self.submitted:
+            return
+        self.submitted.add(filename)
+        self.pending.append(self.pool.apply_async(
+                self._upload, (field, name, filename, filetype)))
+
+    def submit_contigs(self, filename):
+        name = os.path.basename(filename).split('.')[0]
+        self.submit('contig_ids', name, filename, filetype='contigs')
+
+    def wait(self, raise_errors=True):
+        """ Wait for all submitted uploads, returns list of errors.
+        With RAISE_ERRORS, the first error is raised once all are done. """
+        errors = []
+        pending, self.pending = self.pending, []
+        for p in pending:
+            try:
+                p.get()
+            except Exception as e:
+                errors.append(e)
+        if errors and raise_errors:
+            raise errors[0]
+        return errors
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def _upload(self, field, name, filename, filetype):
+        with self.guard.busy():
+            with self.consumer.tracer.span(os.path.basename(filename), 'upload', field=field):
+                res = self.consumer.upload(self.url, self.user, self.token, filename,
+                                           filetype=filetype)
+            with self.lock:
+                self.ids[field][name] = res['data']['id']
+                self.consumer.metadata.update_job(self.uid, field, dict(self.ids[field]))
+
+class TransferProgress:
+    """ Tracks per-file download state and mirrors it to the job record
+    as a list of {'filename', 'state'} records, in input order (filenames
+    hold dots, which MongoDB does not allow in keys, and may repeat). """
+    def __init__(self, meta_obj, uid, file_infos):
+        self.meta = meta_obj
+        self.uid = uid
+        self.lock = threading.Lock()
+        self.files = [{'filename': f['filename'], 'state': 'Queued'} for f in file_infos]
+        self.index = dict([(id(f), i) for i, f in enumerate(file_infos)])
+        self.total = len(file_infos)
+
+    def update(self, file_info, state):
+        with self.lock:
+            self.files[self.index[id(file_info)]]['state'] = state
+            done = len([f for f in self.files if f['state'] == 'Complete'])
+            self.meta.update_job(self.uid, 'data_transfer', [dict(f) for f in self.files])
+            self.meta.update_job(self.uid, 'status', 'Data transfer [{}/{} files]'.format(
+                    done, self.total))
+
 class UpdateTimer(threading.Thread):
     """ Thread for updating time in the mongodb record (for arast stat). """
-    def __init__(self, meta_obj, update_interval, start_time, uid, done_flag):
+    def __init__(self, meta_obj, update_interval, start_time, uid, done_flag, guard=None):
         self.meta = meta_obj
+        self.guard = guard or ForkGuard()
         self.interval = update_interval
         self.uid = uid
         self.start_time = start_time
@@ -953,7 +1540,8 @@ class UpdateTimer(threading.Thread):
                 return
             elapsed_time = time.time() - self.start_time
             ftime = str(datetime.timedelta(seconds=int(elapsed_time)))
-            self.meta.update_job(self.uid, 'computation_time', ftime)
+            with self.guard.busy():
+                self.meta.update_job(self.uid, 'computation_time', ftime)
             time.sleep(self.interval)
 
 
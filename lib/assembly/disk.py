@@ -0,0 +1,197 @@
+"""
+Node-wide disk space management for the compute data path.
+
+A single DiskEvictor is shared by all workers on a node.  It keeps a
+persistent usage index of DATAPATH/<user>/<data_id> directories and
+removes the least recently used ones, across users, to keep a free space
+watermark.  Directories used by running jobs are never removed.  Entries
+of the data caches on the same filesystem (cache.EntryStore) compete in
+the same least recently used order, as job directories hardlink them.
+The cache directories themselves, wherever they are configured, are
+never indexed as user data.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+
+INDEX_FILE = '.usage_index.json'
+
+class DiskEvictor:
+    def __init__(self, datapath, min_free_space, job_list, pinned,
+                 interval=60, excluded=(), stores=(), reserved=None):
+        self.datapath = datapath
+        self.min_free_space = min_free_space
+        self.job_list = job_list # Running jobs
+        self.pinned = pinned     # Paths in use by jobs not yet running
+        if reserved is None:
+            reserved = {}
+        self.reserved = reserved # Path -> bytes still to be written there
+        self.interval = interval
+        # Paths that are not user data: EXCLUDED and the cache directories
+        self.excluded = [os.path.abspath(os.path.join(datapath, p)) for p in excluded]
+        self.excluded += [os.path.abspath(s.cachepath) for s in stores]
+        dev = os.stat(datapath).st_dev
+        self.stores = [s for s in stores if os.stat(s.cachepath).st_dev == dev]
+        self.index_file = os.path.join(datapath, INDEX_FILE)
+        self.lock = multiprocessing.Lock()
+
+    def start(self):
+        """ Background loop: refresh the index and keep the watermark """
+        print ' [*] Disk evictor watching {}'.format(self.datapath)
+        while True:
+            try:
+                with self.lock:
+                    index = self.update_index(rescan=True)
+                    self._evict(index, 0)
+                    self.save_index(index)
+            except:
+                logging.exception('Disk eviction pass failed')
+            time.sleep(self.interval)
+
+    def make_space(self, required_space):
+        """ Evict least recently used data until REQUIRED_SPACE bytes are
+        available above the watermark.  Returns False, without waiting,
+        if not enough can be removed. """
+        with self.lock:
+            index = self.update_index()
+            ok = self._evict(index, required_space)
+            self.save_index(index)
+        if not ok:
+            logging.error('Could not free {} bytes in {}'.format(
+                    required_space, self.datapath))
+        return ok
+
+    def touch(self, path):
+        """ Record use of data directory PATH """
+        key = self._key(path)
+        if key is None:
+            return
+        with self.lock:
+            index = self.load_index()
+            entry = index.setdefault(key, {'size': dir_size(path)})
+            entry['last_used'] = time.time()
+            self.save_index(index)
+
+    def pin(self, path, reserve=0):
+        """ Protect PATH from eviction, and hold RESERVE bytes of free
+        space for data still to be written there """
+        path = os.path.abspath(path)
+        self.pinned.append(path)
+        if reserve:
+            self.reserved[path] = self.reserved.get(path, 0) + reserve
+
+    def unpin(self, path):
+        path = os.path.abspath(path)
+        try:
+            self.pinned.remove(path)
+        except ValueError:
+            pass
+        self.reserved.pop(path, None)
+
+    def free_space(self):
+        """ Free bytes, less those reserved by pin() """
+        s = os.statvfs(self.datapath)
+        return float(s.f_bsize * s.f_bavail) - sum(self.reserved.values())
+
+    def load_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp, self.index_file)
+
+    def update_index(self, rescan=False):
+        """ Add new data directories to the index and drop removed ones.
+        Sizes of known directories are only re-measured on RESCAN. """
+        index = self.load_index()
+        found = set()
+        for user in os.listdir(self.datapath):
+            userpath = os.path.join(self.datapath, user)
+            if not os.path.isdir(userpath) or self.is_excluded(userpath):
+                continue
+            for data_id in os.listdir(userpath):
+                path = os.path.join(userpath, data_id)
+                if self.is_excluded(path) or self.holds_excluded(path):
+                    continue
+                key = self._key(path)
+                found.add(key)
+                if key not in index:
+                    index[key] = {'size': dir_size(path),
+                                  'last_used': os.path.getmtime(path)}
+                elif rescan:
+                    index[key]['size'] = dir_size(path)
+        for key in index.keys():
+            if key not in found:
+                del index[key]
+        return index
+
+    def is_excluded(self, path):
+        """ True if PATH is, or is inside, an excluded directory """
+        path = os.path.abspath(path)
+        return any([path == e or path.startswith(e + os.sep) for e in self.excluded])
+
+    def holds_excluded(self, path):
+        path = os.path.abspath(path)
+        return any([e.startswith(path + os.sep) for e in self.excluded])
+
+    def running_paths(self):
+        paths = set(self.pinned)
+        for job in self.job_list:
+            try:
+                paths.add(os.path.abspath(job['datapath']))
+            except KeyError:
+                pass
+        return paths
+
+    def _evict(self, index, required_space):
+        free_space = self.free_space()
+        if free_space - self.min_free_space >= required_space:
+            return True
+        running = self.running_paths()
+        lru = [(entry['last_used'], key, None, None) for key, entry in index.items()]
+        for store in self.stores:
+            lru += [(mtime, entry_dir, store, meta)
+                    for mtime, entry_dir, meta in store.entries()]
+        for last_used, key, store, meta in sorted(lru):
+            if store is not None: # Cache entry
+                if os.path.abspath(key) in running or not store.remove(key, meta):
+                    continue
+            else:
+                path = os.path.join(self.datapath, key)
+                if os.path.abspath(path) in running:
+                    continue
+                logging.info("Space required.  {} removed.".format(path))
+                shutil.rmtree(path, ignore_errors=True)
+                del index[key]
+            free_space = self.free_space()
+            if free_space - self.min_free_space >= required_space:
+                return True
+        logging.error("No more directories to remove")
+        return False
+
+    def _key(self, path):
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(self.datapath))
+        if rel.startswith('..') or len(rel.split(os.sep)) != 2:
+            return None
+        return rel
+
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
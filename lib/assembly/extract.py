@@ -0,0 +1,184 @@
+"""
+Decompression of input data.
+
+Archives are decompressed through a pipe into gzip/bzip2/tar, so
+extraction can run concurrently with a download by feeding a
+StreamExtractor as data arrives.  pbzip2 is used for bzip2 data when
+installed, and decompresses on several cores.  pigz is used for gzip data
+when installed, but gzip decompression is inherently serial: pigz only
+moves reading, writing and checksumming to separate threads.  Tarballs may
+contain several read files.  Output is only moved into place once
+extraction succeeds, so an aborted extraction leaves nothing behind.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+MANIFEST_SUFFIX = '.extracted'
+
+def which(program):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        exe = os.path.join(path, program)
+        if os.path.isfile(exe) and os.access(exe, os.X_OK):
+            return exe
+    return None
+
+def archive_type(filename):
+    """ Returns (type, extension) for FILENAME, type is one of
+    'tar', 'gz', 'bz2', 'other' or None """
+    for ext in ['tar.gz', 'tgz', 'tar.bz2', 'tar']:
+        if filename.endswith('.' + ext):
+            return 'tar', ext
+    for ext in ['gz', 'bz2']:
+        if filename.endswith('.' + ext):
+            return ext, ext
+    for ext in ['lz', 'rar', 'zip']:
+        if filename.endswith('.' + ext):
+            return 'other', ext
+    return None, None
+
+def decompressor(ext):
+    """ Returns the command that decompresses EXT from stdin to stdout """
+    if ext in ('gz', 'tgz', 'tar.gz'):
+        if which('pigz'):
+            return ['pigz', '-dc']
+        return ['gzip', '-dc']
+    if ext in ('bz2', 'tar.bz2'):
+        if which('pbzip2'):
+            return ['pbzip2', '-dc']
+        return ['bzip2', '-dc']
+    return None
+
+def read_manifest(filename):
+    """ Returns the files previously extracted from FILENAME, or None """
+    try:
+        with open(filename + MANIFEST_SUFFIX) as f:
+            files = [l.strip() for l in f if l.strip()]
+    except IOError:
+        return None
+    if files and all([os.path.exists(f) for f in files]):
+        return files
+    return None
+
+def write_manifest(filename, files):
+    with open(filename + MANIFEST_SUFFIX, 'w') as f:
+        for extracted in files:
+            f.write(extracted + '\n')
+
+
+class StreamExtractor:
+    """ File-like sink that decompresses an archive while it is written.
+    Call close() once all data is written; the extracted files are then
+    listed in self.files.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.outdir = os.path.dirname(os.path.abspath(filename))
+        self.kind, self.ext = archive_type(filename)
+        self.offset = 0 # Bytes consumed
+        self.aborted = False
+        self.files = []
+        self.outfile = None
+        self.tmpdir = None
+        decomp = decompressor(self.ext)
+        if self.kind == 'tar':
+            self.tmpdir = tempfile.mkdtemp(prefix='.extract_', dir=self.outdir)
+            cmd = ['tar', '-xv', '-C', self.tmpdir, '-f', '-']
+            if decomp:
+                cmd += ['--use-compress-program', decomp[0]]
+            stdout = self.listing = tempfile.TemporaryFile()
+        else:
+            cmd = decomp
+            self.outfile = filename[:-len(self.ext)-1]
+            stdout = open(self.outfile + '.part', 'wb')
+        logging.info('Streaming extraction: {}'.format(cmd))
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout,
+                                     cwd=self.outdir)
+        if self.outfile:
+            stdout.close()
+
+    def write(self, chunk):
+        self.proc.stdin.write(chunk)
+        self.offset += len(chunk)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        if self.proc.returncode != 0:
+            self.abort()
+            raise Exception('Extraction failed: {}'.format(self.filename))
+        if self.kind == 'tar':
+            self.listing.seek(0)
+            members = self.listing.read().splitlines()
+            self.listing.close()
+            for name in os.listdir(self.tmpdir): # Move the extracted tree into place
+                dst = os.path.join(self.outdir, name)
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                elif os.path.lexists(dst):
+                    os.remove(dst)
+                os.rename(os.path.join(self.tmpdir, name), dst)
+            os.rmdir(self.tmpdir)
+            self.files = [os.path.join(self.outdir, m) for m in members
+                          if not m.endswith('/')]
+        else:
+            os.rename(self.outfile + '.part', self.outfile)
+            self.files = [self.outfile]
+        write_manifest(self.filename, self.files)
+        logging.info('Extracted {}: {}'.format(self.filename, self.files))
+        return self.files
+
+    def abort(self):
+        self.aborted = True
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if self.outfile and os.path.exists(self.outfile + '.part'):
+            os.remove(self.outfile + '.part')
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def stream_extractor(filename):
+    """ Returns a StreamExtractor for FILENAME, or None if it cannot
+    be extracted from a stream """
+    kind, ext = archive_type(filename)
+    if kind in ('tar', 'gz', 'bz2'):
+        return StreamExtractor(filename)
+    return None
+
+def extract_file(filename):
+    """ Decompress files if necessary, returns list of extracted files """
+    extracted = read_manifest(filename)
+    if extracted:
+        return extracted
+    kind, ext = archive_type(filename)
+    if kind is None:
+        logging.debug("Could not extract %s" % filename)
+        return [filename]
+    if kind == 'other':
+        extracted_file = filename[:-len(ext)-1]
+        if os.path.exists(extracted_file): # Check extracted already
+            return [extracted_file]
+        logging.debug("Extracting %s" % filename)
+        p = subprocess.Popen(['unp', filename],
+                             cwd=os.path.dirname(filename), stderr=subprocess.STDOUT)
+        p.wait()
+        if os.path.exists(extracted_file):
+            return [extracted_file]
+        print "{} does not exist!".format(extracted_file)
+        raise Exception('Archive structure error')
+
+    logging.debug("Extracting %s" % filename)
+    sink = StreamExtractor(filename)
+    try:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sink.write(chunk)
+    except:
+        sink.abort()
+        raise
+    return sink.close()
@@ -0,0 +1,271 @@
+"""
+Insert size estimation of paired-end reads from SAM or BAM alignments.
+
+Read lengths and pair spans are counted in InsertHistograms, numpy arrays
+indexed by value with a sparse tail for outliers.  As in the original
+bin/getinsertsize.py, only reads that align without clipping or indels
+count, only pairs with both reads on the same contig have a span, and the
+span estimate ignores spans over three times the most common span.  Unlike
+it, secondary and supplementary alignments (flag 0x900) are skipped, so
+each read counts once, and records need the 11 mandatory SAM fields but
+no optional tags:
+
+  sizes = parse_file('aln.sam', processes=4)
+  sizes.result()['span'] # {'mean': 301.7, 'stdev': 12.4}
+
+Large SAM files are split at line boundaries into chunks that are parsed
+on a process pool and merged.  BAM files are read directly, inflating
+their blocks on a process pool (see bam).
+"""
+
+import logging
+import multiprocessing
+import os
+import re
+
+import numpy as np
+
+import bam
+
+FULL_MATCH = re.compile('^([0-9]+)M$')
+BATCH_SIZE = 65536
+CHUNK_SIZE = 64 * 2**20
+SPAN_BOUND = 3 # Spans over SPAN_BOUND times the most common span are ignored
+DENSE_LIMIT = 2**18 # Several times the longest mate-pair insert
+
+class InsertHistogram:
+    """ Counts of non-negative integers: a dense array for values below
+    DENSE_LIMIT and a sparse tail for the rare larger ones """
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64) # value -> reads or pairs
+        self.tail = {} # value -> count, for values of at least DENSE_LIMIT
+        self.pending = []
+
+    def add(self, value):
+        self.pending.append(value)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def add_spans(self, spans):
+        """ Counts every value in the integer array SPANS """
+        large = spans >= DENSE_LIMIT
+        if large.any():
+            values, counts = np.unique(spans[large], return_counts=True)
+            for v, c in zip(values.tolist(), counts.tolist()):
+                self.tail[v] = self.tail.get(v, 0) + c
+            spans = spans[~large]
+        self.add_counts(np.bincount(spans))
+
+    def add_counts(self, counts):
+        if len(counts) > len(self.counts):
+            counts = counts.astype(np.int64)
+            counts[:len(self.counts)] += self.counts
+            self.counts = counts
+        else:
+            self.counts[:len(counts)] += counts
+
+    def merge(self, other):
+        other.flush()
+        self.add_counts(other.counts)
+        for v, c in other.tail.items():
+            self.tail[v] = self.tail.get(v, 0) + c
+
+    def flush(self):
+        if self.pending:
+            self.add_spans(np.array(self.pending, dtype=np.int64))
+            self.pending = []
+
+    def total(self):
+        self.flush()
+        return int(self.counts.sum()) + sum(self.tail.values())
+
+    def distribution(self):
+        """ [value, count] of every value counted, in order """
+        self.flush()
+        values = np.flatnonzero(self.counts)
+        return ([[int(v), int(self.counts[v])] for v in values] +
+                [[v, self.tail[v]] for v in sorted(self.tail)])
+
+    def mode(self):
+        self.flush()
+        mode, count = 0, 0
+        if len(self.counts):
+            mode = int(self.counts.argmax())
+            count = int(self.counts[mode])
+        for v, c in sorted(self.tail.items()):
+            if c > count:
+                mode, count = v, c
+        return mode
+
+    def mean_stdev(self, bounded=True):
+        """ Mean and standard deviation of the values (up to SPAN_BOUND
+        times the most common value if BOUNDED), or None if fewer than
+        two were counted """
+        self.flush()
+        if self.total() < 2:
+            return None
+        counts = self.counts
+        tail = self.tail.items()
+        if bounded:
+            bound = SPAN_BOUND * self.mode()
+            counts = counts[:bound + 1]
+            tail = [(v, c) for v, c in tail if v <= bound]
+        values = np.concatenate([np.arange(len(counts)),
+                                 np.array([v for v, c in tail], dtype=np.int64)])
+        counts = np.concatenate([counts, np.array([c for v, c in tail], dtype=np.int64)])
+        n = counts.sum()
+        if n < 2:
+            return None
+        mean = (values * counts).sum() / float(n)
+        stdev = np.sqrt(((values - mean) ** 2 * counts).sum() / float(n - 1))
+        return float(mean), float(stdev)
+
+
+class InsertSizes:
+    """ Read length and pair span histograms of a set of alignments """
+    def __init__(self):
+        self.lengths = InsertHistogram()
+        self.spans = InsertHistogram()
+
+    def add_line(self, line):
+        self.add_record(sam_record(line))
+
+    def add_record(self, record):
+        if record is None:
+            return
+        length, span = record
+        self.lengths.add(length)
+        if span is not None:
+            self.spans.add(span)
+
+    def merge(self, other):
+        self.lengths.merge(other.lengths)
+        self.spans.merge(other.spans)
+
+    def flush(self):
+        self.lengths.flush()
+        self.spans.flush()
+
+    def result(self):
+        """ Summary of the alignments: read_length and span are
+        {'mean', 'stdev'} dicts, or None without enough reads """
+        def summary(estimate):
+            if estimate is None:
+                return None
+            return {'mean': estimate[0], 'stdev': estimate[1]}
+        return {'read_length': summary(self.lengths.mean_stdev(bounded=False)),
+                'span': summary(self.spans.mean_stdev()),
+                'reads': self.lengths.total(),
+                'pairs': self.spans.total(),
+                'span_distribution': self.spans.distribution()}
+
+
+def sam_record(line):
+    """ (read length, span) of SAM record LINE, with a span of None if the
+    pair does not count, or None if the read does not count """
+    if line.startswith('@'):
+        return None
+    field = line.split('\t', 10)
+    if len(field) < 11:
+        return None
+    try:
+        if int(field[1]) & 0x900: # Secondary or supplementary
+            return None
+        match = FULL_MATCH.match(field[5])
+        if match is None:
+            return None
+        length = int(match.group(1))
+        if field[6] != '=':
+            return length, None
+        span = int(field[8])
+    except ValueError:
+        return None
+    if span <= 0:
+        return length, None
+    return length, span
+
+def bam_record(aln):
+    """ sam_record() of the bam.Alignment ALN """
+    if aln.flag & 0x900:
+        return None
+    if len(aln.cigar) != 1 or aln.cigar[0][0] != 'M':
+        return None
+    length = aln.cigar[0][1]
+    if aln.ref_id < 0 or aln.next_ref_id != aln.ref_id or aln.tlen <= 0:
+        return length, None
+    return length, aln.tlen
+
+def sam_span(line):
+    """ Span of the pair of SAM record LINE, or None if it does not count """
+    record = sam_record(line)
+    if record is None:
+        return None
+    return record[1]
+
+def parse_sam(lines, sizes=None):
+    """ Counts the read lengths and pair spans of SAM LINES into SIZES """
+    if sizes is None:
+        sizes = InsertSizes()
+    for line in lines:
+        sizes.add_line(line)
+    sizes.flush()
+    return sizes
+
+def parse_file(filename, processes=1):
+    """ InsertSizes of the SAM or BAM file FILENAME """
+    if bam.is_bam(filename):
+        return parse_bam_file(filename, processes)
+    return parse_sam_file(filename, processes)
+
+def parse_bam_file(filename, processes=1, sizes=None):
+    """ Counts the read lengths and pair spans of the BAM file FILENAME,
+    inflated on PROCESSES processes, into SIZES """
+    if sizes is None:
+        sizes = InsertSizes()
+    for aln in bam.BamReader(filename, processes):
+        sizes.add_record(bam_record(aln))
+    sizes.flush()
+    return sizes
+
+def parse_sam_file(filename, processes=1, chunk_size=CHUNK_SIZE):
+    """ InsertSizes of the SAM file FILENAME, parsed in chunks of
+    CHUNK_SIZE bytes on PROCESSES processes """
+    size = os.path.getsize(filename)
+    if processes <= 1 or size <= chunk_size:
+        with open(filename) as f:
+            return parse_sam(f)
+    ranges = [(filename, start, min(start + chunk_size, size))
+              for start in xrange(0, size, chunk_size)]
+    logging.info('Parsing {} in {} chunks'.format(filename, len(ranges)))
+    pool = multiprocessing.Pool(processes)
+    try:
+        sizes = InsertSizes()
+        for lengths, spans in pool.imap_unordered(parse_range, ranges):
+            sizes.lengths.merge(lengths)
+            sizes.spans.merge(spans)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return sizes
+
+def parse_range(args):
+    """ Read length and span counts of the lines of a file that start
+    within a byte range """
+    filename, start, end = args
+    sizes = InsertSizes()
+    with open(filename) as f:
+        pos = start
+        if start > 0: # Skip the line in progress, it belongs to the previous range
+            f.seek(start - 1)
+            pos = start - 1 + len(f.readline())
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            sizes.add_line(line)
+    sizes.flush()
+    return sizes.lengths, sizes.spans
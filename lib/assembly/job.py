@@ -56,7 +56,9 @@ class ArastJob(dict):
         
 
     def export(self):
-        pass
+        """ Pipeline and module records as plain dicts, for the job document """
+        return [dict(pipeline, modules=[dict(m) for m in pipeline['modules']])
+                for pipeline in self['pipelines']]
 
     def import_quast(self, qreport):
         if self['reference']:
@@ -116,6 +116,13 @@ class MetadataConnection:
         else:
             logging.warning("Job %s not updated!" % job_id)
 
+    def get_checkpoints(self, job_id):
+        """ Stage checkpoints of a job, keyed by stage signature """
+        job = self.get_jobs().find_one({'_id' : job_id}, {'checkpoints' : 1})
+        if job is None:
+            return {}
+        return job.get('checkpoints', {})
+
     def list_jobs(self, user):
         r = []
         jobs = self.get_jobs()
@@ -22,32 +22,46 @@ my_pipe = ['ma', '?k=1,5,3', 'b']
 #my_pipe = ['a' , 'b ?k=1,10-11,20,30:40:2']
 test=['sga_preprocess', '?min_length=29,100,150','sga_ec', 'tagdust',
       'velvet ?hash_length=31:39:2 idba']
-def parse_pipe(pipe):
+class PipelineLimitError(Exception):
+    pass
+
+def split_modules(pipe):
     """
-    Parses modules and parameters into stages
-    Input: a flat (no quotes) list of modules and params
-      e.g. ['kiki', '?k=29-30', 'velvet']
-    Output: list of lists containing single modules and
-      parameters
-      e.g. [['kiki', '?k=29'], ['kiki', '?k=30'], ['velvet']]
+    Groups a flat list of modules and params by module
+    e.g. ['kiki', '?k=29-30', 'velvet'] -> [['kiki', '?k=29-30'], ['velvet']]
     """
     module = []
-    stages = []
+    modules = []
     for string in pipe:
         if not string.startswith('?'):
             if module:
-                stages.append(module) #flush
+                modules.append(module) #flush
                 module = [string]
             else:
                 module.append(string)
         else:
             module.append(string) #param
     if module:
-        stages.append(module)
-    stages = [expand_sweep(m) for m in stages]
-    return stages
+        modules.append(module)
+    return modules
+
+def parse_pipe(pipe):
+    """
+    Parses modules and parameters into stages
+    Input: a flat (no quotes) list of modules and params
+      e.g. ['kiki', '?k=29-30', 'velvet']
+    Output: list of lists containing single modules and
+      parameters
+      e.g. [['kiki', '?k=29'], ['kiki', '?k=30'], ['velvet']]
+    """
+    return [expand_sweep(m) for m in split_modules(pipe)]
 
-def parse_branches(pipe):
+def branch_stages(pipe):
+    """
+    Splits a pipe into stages, without expanding them
+    Output: list of (alternatives, count) per stage, where alternatives()
+      returns a fresh iterator over the stage's modules + params
+    """
     stages = []
     flat_pipe = []
     for i in range(len(pipe)):
@@ -55,59 +69,344 @@ def parse_branches(pipe):
             flat_pipe.append(pipe[i])
             try:
                 if len(pipe[i+1].split(' ')) != 1:
-                    stages += parse_pipe(flat_pipe)
+                    stages += [module_stage(m) for m in split_modules(flat_pipe)]
                     flat_pipe = []
             except:
-                stages += parse_pipe(flat_pipe)
+                stages += [module_stage(m) for m in split_modules(flat_pipe)]
                 flat_pipe = []
         else: # parenth
-            stages += [list(itertools.chain(*parse_pipe(pipe[i].split(' '))))]
-            
-    cart = [list(itertools.product(*stages))]
-    all_pipes = []
-    for pipe in cart[0]:
-        all_pipes.append(list(itertools.chain(*pipe)))
-    return all_pipes
-   
-def expand_sweep(module):
+            modules = split_modules(pipe[i].split(' '))
+            stages.append((lambda modules=modules: itertools.chain(
+                        *[iter_sweep(m) for m in modules]),
+                           sum([count_sweep(m) for m in modules])))
+    return stages
+
+def module_stage(module):
+    return (lambda: iter_sweep(module), count_sweep(module))
+
+def count_branches(pipe):
+    """ Number of pipelines PIPE expands to, without expanding it """
+    count = 1
+    for alternatives, n in branch_stages(pipe):
+        count *= n
+    return count
+
+def iter_branches(pipe, limit=None):
     """
-    [m, ?p=1-2, ?p=3-4] -> [m, p1, p3, m, p2, p3, m, p1, p4, m, p1, p4]
+    Generator over the pipelines PIPE expands to.
+    Raises PipelineLimitError if there are more than LIMIT.
     """
-    expanded = []
+    if limit is not None:
+        count = count_branches(pipe)
+        if count > limit:
+            raise PipelineLimitError(
+                'Pipeline expands to {} pipelines, limit is {}'.format(count, limit))
+    stages = [alternatives for alternatives, n in branch_stages(pipe)]
+    for branch in lazy_product(stages):
+        yield list(itertools.chain(*branch))
+
+def parse_branches(pipe, limit=None):
+    return list(iter_branches(pipe, limit))
+
+def lazy_product(factories):
+    """
+    Cartesian product of the iterators returned by FACTORIES, in the
+    order of itertools.product, without holding any of them in memory
+    """
+    if not factories:
+        yield ()
+        return
+    for head in factories[0]():
+        for tail in lazy_product(factories[1:]):
+            yield (head,) + tail
+
+def sweep_ranges(word):
+    """
+    ?p=1,3-4 -> ('p', [['1'], (3, 5, 1)])
+    Ranges are (start, stop, step) and are not expanded, so large ones
+    cost nothing to count
+    """
+    f = re.split('\?|=', word)[1:]
+    flag = f[0]
+    params = f[1]
+    ranges = []
+    for param in params.split(','):
+        s = re.split('-|:', param)
+        if len(s) != 1: #is range
+            delim = s[0].find('=')+1
+            if delim == 1:
+                break
+            srange = (int(s[0][delim:]),int(s[1]))
+            step_size = 1
+            if len(s) == 3:
+                step_size = int(s[2])
+            ranges.append((srange[0], srange[1]+1, step_size))
+        else:
+            ranges.append([s[0]])
+    return flag, ranges
+
+def iter_sweep_values(word):
+    """
+    ?p=1,3-4 -> ?p=1, ?p=3, ?p=4
+    """
+    flag, ranges = sweep_ranges(word)
+    for values in ranges:
+        if type(values) is tuple:
+            values = xrange(*values)
+        for x in values:
+            yield '?{}={}'.format(flag, x)
+
+def sweep_values(word):
+    return list(iter_sweep_values(word))
+
+def count_sweep_values(word):
+    flag, ranges = sweep_ranges(word)
+    count = 0
+    for values in ranges:
+        if type(values) is tuple:
+            start, stop, step = values
+            if step == 0:
+                raise ValueError('Sweep step cannot be zero: {}'.format(word))
+            count += max(0, (stop - start + step - (1 if step > 0 else -1)) // step)
+        else:
+            count += len(values)
+    return count
+
+def iter_sweep(module):
+    """
+    Generator over the parameter combinations of MODULE
+    [m, ?p=1-2, ?p=3-4] -> [m, p1, p3], [m, p1, p4], [m, p2, p3], [m, p2, p4]
+    """
+    factories = []
     has_range = False
     for word in module:
         if word.startswith('?'):
-            f = re.split('\?|=', word)[1:]
-            flag = f[0]
-            params = f[1]
-            sweep = []
-            for param in params.split(','):
-                s = re.split('-|:', param)
-                if len(s) != 1: #is range
-                    has_range = True
-                    delim = s[0].find('=')+1
-                    if delim == 1:
-                        break
-                    srange = (int(s[0][delim:]),int(s[1]))
-                    step_size = 1
-                    if len(s) == 3:
-                        step_size = int(s[2])
-                    sweep += ['?{}={}'.format(flag, x) 
-                             for x in range(
-                            srange[0], srange[1]+1, step_size)]
-                else:
-                    sweep.append('?{}={}'.format(flag, s[0]))
-                    has_range = True
-            expanded.append(sweep)                    
+            has_range = True
+            factories.append(lambda word=word: iter_sweep_values(word))
         else: #mod name
-            expanded.append([word])
-
+            factories.append(lambda word=word: iter([word]))
     if has_range:
-        cart = [list(itertools.product(*expanded))]
-        flat = list(itertools.chain(*cart))
-        return flat
-    else:
-        return [module]
+        return lazy_product(factories)
+    return iter([module])
+
+def count_sweep(module):
+    count = 1
+    for word in module:
+        if word.startswith('?'):
+            count *= count_sweep_values(word)
+    return count
+
+def expand_sweep(module):
+    """
+    [m, ?p=1-2, ?p=3-4] -> [m, p1, p3, m, p2, p3, m, p1, p4, m, p1, p4]
+    """
+    return list(iter_sweep(module))
+
+
+class StageNode:
+    """
+    One module run in the prefix tree of a job's pipelines.  Pipelines
+    that start with the same modules and parameters share nodes, so a
+    shared stage runs once and its outputs feed every branch below it.
+    """
+    def __init__(self, module=None, params=None, parent=None, number=0):
+        self.module = module
+        self.params = params or {}
+        self.parent = parent
+        self.number = number
+        self.children = []
+        self.pipelines = [] # Pipeline numbers running through this node
+        self.result = None
+        if parent is None:
+            self.depth = 0
+            self.key = ()
+        else:
+            self.depth = parent.depth + 1
+            self.key = parent.key + (stage_signature(module, self.params),)
+
+    def child(self, signature):
+        for c in self.children:
+            if c.key[-1] == signature:
+                return c
+        return None
+
+    def path(self):
+        """ Nodes from the first stage down to this one """
+        nodes = []
+        node = self
+        while node.parent is not None:
+            nodes.insert(0, node)
+            node = node.parent
+        return nodes
+
+def stage_signature(module, params):
+    """ Full module + parameter signature of a stage """
+    return (module.lower(),
+            tuple(sorted([(str(k), str(v)) for k, v in params.items()])))
+
+def build_stage_tree(pipelines, root=None):
+    """
+    Compiles expanded pipelines into a prefix tree of stages, or adds
+    them to the tree ROOT
+    Input: list of (number, modules, overrides)
+      e.g. [(1, ['trim_sort', 'velvet'], [{}, {'hash_length': '29'}]),
+            (2, ['trim_sort', 'velvet'], [{}, {'hash_length': '31'}])]
+    Output: root node and a dict of each pipeline's last node
+      e.g. root -> trim_sort -> [velvet ?hash_length=29, velvet ?hash_length=31]
+    """
+    if root is None:
+        root = StageNode()
+    leaves = {}
+    num_nodes = len(list(iter_stages(root)))
+    for number, modules, overrides in pipelines:
+        root.pipelines.append(number)
+        node = root
+        for module, params in zip(modules, overrides):
+            child = node.child(stage_signature(module, params))
+            if child is None:
+                num_nodes += 1
+                child = StageNode(module, params, node, num_nodes)
+                node.children.append(child)
+            child.pipelines.append(number)
+            node = child
+        leaves[number] = node
+    return root, leaves
+
+def iter_stages(node):
+    """ Depth-first iterator over the stages below NODE """
+    for child in node.children:
+        yield child
+        for n in iter_stages(child):
+            yield n
+
+
+class AdaptiveSweep:
+    """
+    Adaptive search over the numeric parameter ranges of expanded pipelines,
+    instead of running every combination.
+
+    Pipelines that differ only in numeric parameter values form a family
+    whose swept values are the axes of a grid.  The first round evaluates
+    a coarse grid of each family (COARSE values per axis).  Each later
+    round bisects the gaps next to the best scoring point along every
+    axis; points that scored worse are not refined further.  At most
+    BUDGET pipelines are run in total.
+
+    Usage:
+      search = AdaptiveSweep(all_pipes, budget)
+      pipes = search.next_round()
+      while pipes:
+          for p in pipes: search.report(p, score) # higher is better
+          pipes = search.next_round()
+    """
+    def __init__(self, pipes, budget, coarse=3):
+        self.budget = budget
+        self.coarse = coarse
+        self.scores = {} # pipe -> score, None if failed
+        self.pending = []
+        self.families = []
+        by_template = {}
+        for pipe in pipes:
+            template, values = sweep_template(pipe)
+            if template not in by_template:
+                by_template[template] = {'positions': [i for i, v in values],
+                                         'points': []}
+                self.families.append(by_template[template])
+            by_template[template]['points'].append((tuple(pipe), [v for i, v in values]))
+        for family in self.families:
+            points = family['points']
+            dims = len(family['positions'])
+            family['axes'] = [sorted(set([p[1][d] for p in points])) for d in range(dims)]
+            family['grid'] = {}
+            for pipe, values in points:
+                index = tuple([family['axes'][d].index(values[d]) for d in range(dims)])
+                family['grid'][index] = pipe
+        self.round = 0
+
+    def count(self):
+        return len(self.scores)
+
+    def next_round(self):
+        """ Returns the next pipelines to run, [] when the search is done """
+        candidates = []
+        for family in self.families:
+            if self.round == 0:
+                indices = self._coarse(family)
+            else:
+                indices = self._refine(family)
+            for index in indices:
+                pipe = family['grid'].get(index)
+                if pipe and pipe not in self.scores and pipe not in candidates:
+                    candidates.append(pipe)
+        self.round += 1
+        candidates = candidates[:max(0, self.budget - len(self.scores))]
+        for pipe in candidates:
+            self.scores[pipe] = None
+        return [list(pipe) for pipe in candidates]
+
+    def report(self, pipe, score):
+        self.scores[tuple(pipe)] = score
+
+    def best(self):
+        """ Highest scoring pipeline and its score """
+        scored = [(s, p) for p, s in self.scores.items() if s is not None]
+        if not scored:
+            return None, None
+        score, pipe = max(scored)
+        return list(pipe), score
+
+    def _coarse(self, family):
+        axes = family['axes']
+        per_axis = []
+        for values in axes:
+            n = len(values)
+            k = min(n, self.coarse)
+            if k <= 1:
+                per_axis.append([0])
+            else:
+                per_axis.append(sorted(set([int(round(i * (n - 1) / float(k - 1)))
+                                            for i in range(k)])))
+        return list(itertools.product(*per_axis))
+
+    def _refine(self, family):
+        evaluated = dict([(index, self.scores[pipe]) for index, pipe in family['grid'].items()
+                          if pipe in self.scores])
+        scored = [(s, i) for i, s in evaluated.items() if s is not None]
+        if not scored:
+            return []
+        best = max(scored)[1]
+        candidates = []
+        for d in range(len(family['axes'])):
+            seen = sorted(set([i[d] for i in evaluated.keys()]))
+            lower = [i for i in seen if i < best[d]]
+            upper = [i for i in seen if i > best[d]]
+            for neighbor in lower[-1:] + upper[:1]:
+                mid = (neighbor + best[d]) / 2
+                if mid == best[d]: # Adjacent, try the neighbor itself
+                    mid = neighbor
+                candidates.append(best[:d] + (mid,) + best[d+1:])
+        return candidates
+
+
+def sweep_template(pipe):
+    """
+    Splits an expanded pipeline into a template and its numeric parameters
+    e.g. ['velvet', '?hash_length=29'] ->
+           (('velvet', '?hash_length=#'), [(1, 29.0)])
+    """
+    template = []
+    values = []
+    for i, word in enumerate(pipe):
+        if word.startswith('?') and word.find('=') != -1:
+            flag, value = word[1:].split('=', 1)
+            try:
+                values.append((i, float(value)))
+                template.append('?{}=#'.format(flag))
+                continue
+            except ValueError:
+                pass
+        template.append(word)
+    return tuple(template), values
 
 
 #print parse_branches(my_pipe)
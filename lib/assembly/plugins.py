@@ -1,4 +1,5 @@
 import abc
+import errno
 import copy
 import logging 
 import itertools
@@ -11,14 +12,23 @@ import signal
 import subprocess
 import re
 import multiprocessing
+import random
+import select
 import signal
 from yapsy.PluginManager import PluginManager
-from threading  import Thread
-from Queue import Queue, Empty
+from threading import Thread
 
 # A-Rast modules
 import assembly
+import insertsize
+import readstats
 import pipe as phelper
+from scheduler import ResourceHints
+from tracing import Tracer
+
+KILL_CHECK_INTERVAL = 5 # Seconds between kill checks without a wakeup
+OUTPUT_CHUNK_SIZE = 65536
+BWA_INDEX_EXTENSIONS = ['.amb', '.ann', '.bwt', '.pac', '.sa']
 
 class BasePlugin(object):
     """ 
@@ -81,38 +91,13 @@ class BasePlugin(object):
         try:
             p = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, 
                                      stderr=subprocess.STDOUT, preexec_fn=os.setsid, **kwargs)
-
-            ## Module Logging Thread
-            q = Queue()
-            t = Thread(target=handle_output, args=(p.stdout, q))
-            t.daemon = True # thread dies with the program
-            t.start()
-
-            ## Poll for kill requests
-            while p.poll() is None:
-                if self.killed():
-                    os.killpg(p.pid, signal.SIGTERM)
-                    raise Exception('Terminated by user')
-                
-                ## Flush STDOUT to logs
-                while True:
-                    try:  line = q.get_nowait() # or q.get(timeout=.1)
-                    except Empty:
-                        break
-                    else: # got line
-                        logging.info(line)
-                        self.out_module.write(line)
-                time.sleep(5)
-            p.wait()
-
-            #Flush again
-            while True:
-                try:  line = q.get_nowait() # or q.get(timeout=.1)
-                except Empty:
-                    break
-                else: # got line
-                    logging.info(line)
-                    self.out_module.write(line)
+            self.pmanager.active_pids.add(p.pid)
+            try:
+                with self.pmanager.tracer.span(cmd_string.split(' ')[0], 'process',
+                                               cmd=cmd_string, pid=p.pid):
+                    self.supervise(p)
+            finally:
+                self.pmanager.active_pids.discard(p.pid)
 
         except subprocess.CalledProcessError as e:
             out = 'Process Failed.\nExit Code: {}\nOutput:{}\n'.format(
@@ -121,6 +106,74 @@ class BasePlugin(object):
         m_ftime = str(datetime.timedelta(seconds=int(m_elapsed_time)))
         self.out_report.write("Process time: {}\n\n".format(m_ftime))
 
+    def supervise(self, p):
+        """ Streams the output of process P to the module log until it
+        exits.  Kill requests are checked when the manager's kill_wakeup
+        fd is written, and at least every KILL_CHECK_INTERVAL seconds. """
+        out = p.stdout.fileno()
+        wakeup = self.pmanager.kill_wakeup
+        poller = select.poll()
+        poller.register(out, select.POLLIN)
+        if wakeup is not None:
+            poller.register(wakeup, select.POLLIN)
+        last_check = time.time()
+        while True:
+            check = False
+            events = poller.poll(KILL_CHECK_INTERVAL * 1000)
+            for fd, event in events:
+                if fd == wakeup:
+                    check = True
+                    try:
+                        os.read(wakeup, 4096)
+                    except OSError as e: # Drained by a sibling process
+                        if e.errno != errno.EAGAIN:
+                            raise
+                    continue
+                chunk = os.read(out, OUTPUT_CHUNK_SIZE)
+                if chunk:
+                    logging.info(chunk.rstrip())
+                    self.out_module.write(chunk)
+                else: # EOF
+                    poller.unregister(out)
+                    p.stdout.close()
+                    self.reap(p)
+                    return
+            if check or time.time() - last_check >= KILL_CHECK_INTERVAL:
+                last_check = time.time()
+                if self.killed():
+                    os.killpg(p.pid, signal.SIGTERM)
+                    self.reap(p)
+                    raise Exception('Terminated by user')
+            if not events and self.reap(p, os.WNOHANG): # Output held open by a descendant
+                p.stdout.close()
+                return
+
+    def reap(self, p, options=0):
+        """ Waits for process P and adds the resources used by it and the
+        descendants it waited for to the manager's rusage.
+        Returns False if P is still running (with OPTIONS os.WNOHANG). """
+        while True:
+            try:
+                pid, status, ru = os.wait4(p.pid, options)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if pid == 0:
+            return False
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        add_rusage(self.pmanager.rusage, {'user_time': ru.ru_utime,
+                                          'sys_time': ru.ru_stime,
+                                          'max_rss_mb': ru.ru_maxrss / 1024.0,
+                                          'block_in': ru.ru_inblock,
+                                          'block_out': ru.ru_oublock,
+                                          'voluntary_switches': ru.ru_nvcsw,
+                                          'involuntary_switches': ru.ru_nivcsw})
+        return True
+
     def killed(self):
         """ Check the kill queue to see if job should be killed """
         kl = self.pmanager.kill_list
@@ -174,9 +227,13 @@ class BasePlugin(object):
         self.threads = 1
         self.process_cores = multiprocessing.cpu_count()
         self.arast_threads = int(manager.threads)
-        self.process_threads_allowed = str(self.process_cores / self.arast_threads)
+        if manager.module_threads: # Assigned by the node scheduler
+            self.process_threads_allowed = str(manager.module_threads)
+        elif manager.thread_budget: # Share of a concurrently running job
+            self.process_threads_allowed = str(manager.thread_budget)
+        else:
+            self.process_threads_allowed = str(self.process_cores / self.arast_threads)
         self.job_data = job_data
-        self.tools = {'ins_from_sam': '../../bin/getinsertsize.py'}
         self.out_report = job_data['out_report'] #Job log file
         self.out_module = open(os.path.join(self.outpath, '{}.out'.format(self.name)), 'w')
         job_data['logfiles'].append(self.out_module.name)
@@ -256,13 +313,14 @@ class BasePlugin(object):
     def update_status(self):
         pass
 
-    def calculate_read_info(self, job_data=None):
+    def calculate_read_info(self, job_data=None, sample=False):
         """ 
-        Analyze subset of reads to infer:
+        Analyze reads to infer:
         - Max read length
-        - ...
+        - Read count
         Modifies each read library in JOB_DATA as well as returns global 
-        values.
+        values.  With SAMPLE, large FASTQ files are estimated from a sample
+        (see readstats).
         """
         if not job_data:
             job_data = self.job_data
@@ -271,15 +329,10 @@ class BasePlugin(object):
         for lib in job_data['initial_reads']:
             max_read_length = -1
             read_count = 0
-            readfiles = lib['files']
-            for r in readfiles:
-                f = open(r, 'r')
-                for line in f:
-                    read_count += 1
-                    if read_count % 4 == 2 and len(line) > max_read_length:
-                        max_read_length = len(line)
-                f.close()
-            read_count /= 4
+            for r in lib['files']:
+                stats = readstats.read_stats(r, sample=sample)
+                max_read_length = max(max_read_length, stats['max_length'])
+                read_count += stats['count']
             lib['max_read_length'] = max_read_length
             lib['count'] = read_count
             all_max_read_length.append(max_read_length)
@@ -287,42 +340,92 @@ class BasePlugin(object):
         return max(all_max_read_length), total_read_count
     
 
-    def estimate_insert_stdev(self, contig_file, reads, min_lines=4000):
-        """ Map READS to CONTIGS using bwa and return insert size """
-        logging.info('Estimating insert size')
-        min_reads = min_lines * 4
-        sub_reads = []
-        for r in reads:
-            sub_name = r + '.sub'
-            sub_file = open(sub_name, 'w')
-
-            ## getting subset of reads
-            with open(r) as readfile:
-                for line in itertools.islice(readfile, min_reads):
-                    sub_file.write(line)
-            sub_file.close()
-            sub_reads.append(sub_name)
-            
-        bwa_data = copy.deepcopy(self.job_data)
-        #bwa_data['processed_reads'][0]['files'] = sub_reads
-        bwa_data['initial_reads'][0]['files'] = sub_reads
-        bwa_data['contigs'] = [contig_file]
-        bwa_data['out_report'] = open(os.path.join(self.outpath, 'estimate_ins.log'), 'w')
-
-        #job_data['final_contigs'] = [contig_file]
-        samfiles, _, bwa_log = self.pmanager.run_module('bwa', bwa_data)
-        self.job_data['logfiles'].append(bwa_log)
-        samfile = samfiles[0]
-        if os.path.getsize(samfile) == 0:
+    def estimate_insert_stdev(self, contig_file, reads, min_pairs=4000):
+        """ Insert size and its standard deviation of READS, estimated by
+        estimate_insert_sizes() """
+        sizes = self.estimate_insert_sizes(contig_file, reads, min_pairs)
+        if sizes['span'] is None:
             logging.error('Error estimating insert length')
             raise Exception('estimate ins failed')
-        cmd_args = [self.tools['ins_from_sam'], samfile]
-        results = subprocess.check_output(cmd_args)
-        insert_size = int(float(re.split('\s|,', results)[9]))
-        stdev = int(float(re.split('\=|\s', results)[-2]))
+        insert_size, stdev = int(sizes['span']['mean']), int(sizes['span']['stdev'])
         logging.info('Estimated Insert Length: {}'.format(insert_size))
         return insert_size, stdev
 
+    def estimate_insert_sizes(self, contig_file, reads, min_pairs=4000):
+        """ Map a random sample of MIN_PAIRS read pairs of READS (mate files,
+        or one interleaved file) to CONTIG_FILE with bwa mem and return
+        the read length and pair span estimates of insertsize """
+        logging.info('Estimating insert size')
+        bwa = self.pmanager.get_executable('bwa')
+        if bwa is None:
+            raise Exception('estimate ins failed: bwa module is not available')
+        index = self.bwa_index(bwa, contig_file)
+        cmd_args = [bwa, 'mem', '-p', '-t', self.process_threads_allowed, index, '-']
+        cmd_string = ' '.join([os.path.basename(w) for w in cmd_args])
+        self.out_module.write('Command: {}\n'.format(cmd_string))
+        self.out_module.flush()
+        p = subprocess.Popen(cmd_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=self.out_module, preexec_fn=os.setsid)
+        self.pmanager.active_pids.add(p.pid)
+        writer = Thread(target=self.write_read_sample, args=(p.stdin, reads, min_pairs))
+        writer.daemon = True
+        writer.start()
+        try:
+            with self.pmanager.tracer.span('bwa', 'process', cmd=cmd_string, pid=p.pid):
+                sizes = insertsize.parse_sam(p.stdout).result()
+                p.stdout.close()
+                self.reap(p)
+        finally:
+            self.pmanager.active_pids.discard(p.pid)
+        writer.join()
+        if p.returncode != 0:
+            logging.error('Error estimating insert length')
+            raise Exception('estimate ins failed')
+        if sizes['span'] is not None:
+            self.out_module.write('Estimated insert size: {:.0f}, stdev {:.0f} ({} pairs)\n'.format(
+                    sizes['span']['mean'], sizes['span']['stdev'], sizes['pairs']))
+        return sizes
+
+    def write_read_sample(self, out, reads, pairs):
+        """ Writes PAIRS read pairs of READS, drawn uniformly from the
+        whole library, to OUT as interleaved records """
+        try:
+            stats = readstats.read_stats(reads[0])
+            lines = 4 if stats['format'] == 'fastq' else None # FASTA may be wrapped
+            rng = random.Random(0) # Same sample for the same reads
+            if len(reads) >= 2:
+                n = stats['count']
+                sample = sorted(rng.sample(xrange(n), min(pairs, n)))
+                for r1, r2 in itertools.izip(readstats.iter_records(reads[0], sample, lines),
+                                             readstats.iter_records(reads[1], sample, lines)):
+                    out.write(r1)
+                    out.write(r2)
+            else:
+                n = stats['count'] / 2
+                sample = sorted(rng.sample(xrange(n), min(pairs, n)))
+                records = itertools.chain(*[(2 * i, 2 * i + 1) for i in sample])
+                for r in readstats.iter_records(reads[0], records, lines):
+                    out.write(r)
+        except IOError: # Aligner exited
+            pass
+        finally:
+            try:
+                out.close()
+            except IOError:
+                pass
+
+    def bwa_index(self, bwa, contig_file):
+        """ Prefix of a bwa index of CONTIG_FILE, reusing an existing one """
+        own = os.path.join(self.outpath, os.path.basename(contig_file))
+        for prefix in [contig_file, own]:
+            index = [prefix + ext for ext in BWA_INDEX_EXTENSIONS]
+            if (all([os.path.exists(f) for f in index]) and
+                min([os.path.getmtime(f) for f in index]) >= os.path.getmtime(contig_file)):
+                logging.info('Reusing bwa index: {}'.format(prefix))
+                return prefix
+        self.arast_popen([bwa, 'index', '-a', 'is', '-p', own, contig_file], overrides=False)
+        return own
+
     
 class BaseAssembler(BasePlugin):
     """
@@ -607,6 +710,16 @@ class ModuleManager():
         self.threads = threads
         self.kill_list = kill_list
         self.job_list = job_list # Running jobs
+        self.thread_budget = None # Threads per module, if set
+        self.active_pids = set() # Module process groups
+        self.module_cache = None # cache.ModuleCache of module outputs
+        self.scheduler = None # scheduler.ResourceScheduler shared by the node
+        self.module_threads = None # Threads assigned to the running module
+        self.on_memory_wait = None # Called when a module waits for memory
+        self.max_pipelines = 1000 # Pipelines a job may expand to
+        self.kill_wakeup = None # Read end of a pipe written on kill requests
+        self.rusage = new_rusage() # Resources used by module processes since reset
+        self.tracer = Tracer() # Timeline of the running job
         self.pmanager = PluginManager()
         self.pmanager.setPluginPlaces(["plugins"])
         self.pmanager.collectPlugins()
@@ -663,15 +776,42 @@ class ModuleManager():
         if not self.has_plugin(module):
             raise Exception("No plugin named {}".format(module))
         plugin = self.pmanager.getPluginByName(module)
+        memoize = self.memoize(plugin, job_data)
+        job_data['params'] = [kv for kv in job_data['params'] if kv[0] != 'memoize']
+        if self.module_cache and memoize and not (tar or meta):
+            return self.run_memoized(plugin, job_data, all_data, reads)
+        return self.run_plugin(plugin, job_data, tar, all_data, reads, meta)
+
+    def run_plugin(self, plugin, job_data, tar=False, all_data=False, reads=False,
+                   meta=False):
         settings = plugin.details.items('Settings')
         plugin.plugin_object.update_settings(job_data)
-        if meta:
-            output = plugin.plugin_object(settings, job_data, self, meta=True)
-        else:
-            output = plugin.plugin_object(settings, job_data, self)
+        token = None
+        if self.scheduler and not self.module_threads: # Nested runs share threads
+            hints = ResourceHints(settings, self.scheduler.cores)
+            def on_wait(memory, committed):
+                if self.on_memory_wait:
+                    self.on_memory_wait(job_data, plugin.name, memory, committed)
+            wait_start = time.time()
+            token, self.module_threads = self.scheduler.acquire(
+                plugin.name, hints, input_size=self.input_size(job_data), on_wait=on_wait)
+            waited = time.time() - wait_start
+            if waited >= self.scheduler.poll_interval:
+                job_data['out_report'].write('{}: waited {} for memory\n'.format(
+                        plugin.name, datetime.timedelta(seconds=int(waited))))
+        try:
+            if meta:
+                output = plugin.plugin_object(settings, job_data, self, meta=True)
+            else:
+                output = plugin.plugin_object(settings, job_data, self)
+        finally:
+            if token:
+                self.scheduler.release(token)
+                self.module_threads = None
         log = plugin.plugin_object.out_module.name
         if tar:
-            tarfile = plugin.plugin_object.tar_output(job_data['job_id'])
+            with self.tracer.span(plugin.name, 'tar'):
+                tarfile = plugin.plugin_object.tar_output(job_data['job_id'])
             return output, tarfile, [], log
         if all_data:
             if not reads and plugin.plugin_object.OUTPUT == 'reads':
@@ -682,6 +822,85 @@ class ModuleManager():
             return output, data, log
         return output, [], log
 
+    def run_memoized(self, plugin, job_data, all_data=False, reads=False):
+        """
+        Returns the cached outputs of an earlier run of PLUGIN on the same
+        input data and settings, or runs and caches it.
+        """
+        cache = self.module_cache
+        key = cache.key(self.module_signature(plugin, job_data))
+        with cache.lock(key):
+            cached = cache.lookup(key)
+            if cached is None:
+                output, data, log = self.run_plugin(plugin, job_data, all_data=all_data,
+                                                    reads=reads)
+                if output:
+                    cache.put(key, plugin.plugin_object.outpath, output, log)
+                return output, data, log
+            outpath = plugin.plugin_object.create_directories(job_data)
+            output, log, files = cache.restore(key, cached, outpath)
+        logging.info('{}: reusing cached output {}'.format(plugin.name, key))
+        job_data['logfiles'].append(log)
+        job_data['out_report'].write('{}: reusing output of an earlier run ({})\n'.format(
+                plugin.name, key))
+        if not all_data or (not reads and plugin.plugin_object.OUTPUT == 'reads'):
+            files = []
+        return output, files, log
+
+    def input_size(self, job_data):
+        """ Bytes of read and contig data in JOB_DATA """
+        files = list(itertools.chain(*[lib['files'] for lib in job_data['reads']]))
+        files += job_data.get('contigs', [])
+        size = 0
+        for f in files:
+            try:
+                size += os.path.getsize(f)
+            except OSError:
+                pass
+        return size
+
+    def memoize(self, plugin, job_data):
+        """ Module outputs are cached for plugins that output reads, or
+        set 'memoize' in [Settings].  A '?memoize=False' parameter opts out. """
+        memoize = str(plugin.plugin_object.OUTPUT == 'reads')
+        for kv in plugin.details.items('Settings'):
+            if kv[0] == 'memoize':
+                memoize = kv[1]
+        for kv in job_data['params']:
+            if kv[0] == 'memoize':
+                memoize = kv[1]
+        return memoize.lower() in ('true', 'yes', '1')
+
+    def module_signature(self, plugin, job_data):
+        """ Everything a module run's output depends on: module, version,
+        effective settings and the content of its inputs """
+        cache = self.module_cache
+        libs = []
+        for lib in job_data['reads']:
+            libs.append({'type': lib.get('type'),
+                         'insert': lib.get('insert'),
+                         'stdev': lib.get('stdev'),
+                         'files': [cache.digest(f) for f in lib['files']]})
+        contigs = []
+        if plugin.plugin_object.INPUT.find('contigs') != -1:
+            contigs = [cache.digest(f) for f in job_data.get('contigs', [])]
+        return {'module': plugin.name,
+                'version': str(plugin.version),
+                'source': cache.digest(plugin.path + '.py'),
+                'settings': sorted(plugin.details.items('Settings')),
+                'params': sorted([(k, str(v)) for k, v in job_data['params']]),
+                'reads': libs,
+                'contigs': contigs}
+
+    def kill_active(self):
+        """ Terminate the process groups of running modules """
+        for pid in list(self.active_pids):
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.active_pids.clear()
+
     def output_type(self, module):
         return self.pmanager.getPluginByName(module).plugin_object.OUTPUT
 
@@ -701,16 +920,16 @@ class ModuleManager():
             return None
 
     def get_executable(self, module):
+        """ Configured executable of MODULE, made absolute as in
+        init_settings """
         try:
             plugin = self.pmanager.getPluginByName(module)
-            settings = plugin.details.items('Settings')
-            for kv in settings:
-                if kv[0] == 'short_name':
-                    sn = kv[1]
-                    break
-            return sn
+            executable = dict(plugin.details.items('Settings'))['executable']
         except:
             return None
+        if os.path.exists(os.path.abspath(executable)):
+            return os.path.abspath(executable)
+        return executable
 
 
     def has_plugin(self, plugin):
@@ -747,7 +966,7 @@ class ModuleManager():
         Parses inital pipe and separates branching bins
         Ex: ['sga', '?p=True', 'kiki ?k=31 velvet', 'sspace']
         """
-        stages = phelper.parse_branches(pipe)
+        stages = phelper.parse_branches(pipe, self.max_pipelines)
         return stages
 
     def parse_pipe(self, pipe):
@@ -779,8 +998,24 @@ class ModuleManager():
 
 
 ##### Helper Functions ######
-def handle_output(out, q):
-    for line in iter(out.readline, b''):
-        q.put(line)
-    out.close()
+
+def new_rusage():
+    """ CPU seconds, peak resident memory, blocks read and written and
+    context switches of module processes """
+    return {'user_time': 0.0,
+            'sys_time': 0.0,
+            'max_rss_mb': 0.0,
+            'block_in': 0,
+            'block_out': 0,
+            'voluntary_switches': 0,
+            'involuntary_switches': 0}
+
+def add_rusage(total, usage):
+    """ Adds USAGE to TOTAL, keeping the larger peak memory """
+    for k, v in usage.items():
+        if k == 'max_rss_mb':
+            total[k] = max(total.get(k, 0), v)
+        else:
+            total[k] = total.get(k, 0) + v
+    return total
 
@@ -21,7 +21,8 @@ class BwaAligner(BaseAligner, IPlugin):
         ## Align reads
         samfile = os.path.join(self.outpath,
                                os.path.basename(contig_file) + '.sam')
-        cmd_args = [self.executable, 'mem', '-t', '8', contig_file, reads[0]]
+        cmd_args = [self.executable, 'mem', '-t', self.process_threads_allowed,
+                    contig_file, reads[0]]
         if len(reads) == 2:
             cmd_args+=[reads[1], '>', samfile]
             
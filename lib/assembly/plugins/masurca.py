@@ -55,7 +55,7 @@ class MasurcaAssembler(BaseAssembler, IPlugin):
 
         ## Determine if Illumina (1) or longer (2)
         if self.use_linking_mates == 'auto':
-            max_read_length, _ = self.calculate_read_info()
+            max_read_length, _ = self.calculate_read_info(sample=True)
             if max_read_length > 300:
                 use_linking_mates = 0
             else:
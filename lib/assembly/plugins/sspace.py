@@ -43,7 +43,7 @@ class SspaceScaffolder(BaseScaffolder, IPlugin):
 
         ## K minimal links, based on A5
         if self.k == '-1':
-            max_read_length, read_count = self.calculate_read_info(job_data)
+            max_read_length, read_count = self.calculate_read_info(job_data, sample=True)
             coverage = max_read_length * read_count / genome_size
             expected_links = coverage * insert_size / max_read_length
             min_links = int(math.log(expected_links)/math.log(1.4)-11.5)
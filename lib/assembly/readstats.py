@@ -0,0 +1,393 @@
+"""
+Read counts and lengths of FASTQ and FASTA files.
+
+Files are scanned in large binary chunks, memory-mapped unless they are
+compressed, and numpy finds the newlines, so a scan runs at close to disk
+speed.  read_stats() is exact by default.  With sample=True, FASTQ files
+larger than the sample are estimated from evenly spaced blocks instead.
+read_profile() also measures GC content, quality encoding and the read
+length histogram.  Results are remembered per file for the life of the
+process.
+"""
+
+import bz2
+import gzip
+import logging
+import mmap
+import os
+
+import numpy as np
+
+CHUNK_SIZE = 16 * 2**20
+SAMPLE_BLOCKS = 64
+SAMPLE_BLOCK_SIZE = 2**20
+HISTOGRAM_BINS = 100
+
+NEWLINE = ord('\n')
+FASTQ_HEADER = ord('@')
+FASTQ_SEPARATOR = ord('+')
+FASTA_HEADER = ord('>')
+
+_cache = {} # (path, size, mtime, exact) -> stats
+
+def read_stats(filename, sample=False):
+    """
+    Returns a dict of the reads in FILENAME:
+      format      -- 'fastq' or 'fasta'
+      count       -- number of reads
+      bases       -- total length of the reads
+      max_length  -- length of the longest read
+      mean_length -- mean read length
+      exact       -- False if estimated from a sample
+    """
+    st = os.stat(filename)
+    path = os.path.realpath(filename)
+    key = (path, st.st_size, st.st_mtime)
+    if key + (True,) in _cache:
+        return dict(_cache[key + (True,)])
+    if sample and key + (False,) in _cache:
+        return dict(_cache[key + (False,)])
+    stats = None
+    if sample and not compressed(filename):
+        stats = sampled_stats(filename, st.st_size)
+    if stats is None:
+        stats = exact_stats(filename)
+    _cache[key + (stats['exact'],)] = stats
+    logging.info('Read stats of {}: {}'.format(filename, stats))
+    return dict(stats)
+
+def read_profile(filename):
+    """
+    Exact read_stats() of FILENAME, plus:
+      gc_content       -- fraction of G and C among A, C, G and T
+      qual_encoding    -- 'phred33', 'phred64' or None (FASTA or unknown)
+      length_histogram -- {'bin_width': W, 'counts': [...]}, read counts
+                          by length, in at most HISTOGRAM_BINS bins of W
+    """
+    cached = cached_stats(filename)
+    if cached and 'gc_content' in cached:
+        return cached
+    stats = exact_stats(filename, profile=True)
+    remember(filename, stats)
+    logging.info('Read profile of {}: {} reads, {} GC, {}'.format(
+            filename, stats['count'], stats['gc_content'], stats['qual_encoding']))
+    return dict(stats)
+
+def cached_stats(filename):
+    """ Exact stats of FILENAME computed earlier in this process, or None """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    stats = _cache.get((os.path.realpath(filename), st.st_size, st.st_mtime, True))
+    if stats is None:
+        return None
+    return dict(stats)
+
+def remember(filename, stats):
+    """ Use STATS, exact stats of FILENAME, for later calls """
+    st = os.stat(filename)
+    _cache[(os.path.realpath(filename), st.st_size, st.st_mtime, True)] = dict(stats)
+
+def compressed(filename):
+    return filename.endswith('.gz') or filename.endswith('.bz2')
+
+def exact_stats(filename, profile=False):
+    scanner = None
+    for chunk in iter_chunks(filename):
+        if scanner is None:
+            scanner = Scanner(detect_format(chunk), profile)
+        scanner.feed(chunk)
+    if scanner is None: # Empty file
+        scanner = Scanner('fastq', profile)
+    scanner.finish()
+    return scanner.stats()
+
+def iter_chunks(filename):
+    """ Byte arrays of consecutive chunks of FILENAME """
+    if filename.endswith('.gz'):
+        opener = gzip.open
+    elif filename.endswith('.bz2'):
+        opener = bz2.BZ2File
+    else:
+        opener = None
+    if opener:
+        f = opener(filename, 'rb')
+        try:
+            for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+                yield np.frombuffer(data, dtype=np.uint8)
+        finally:
+            f.close()
+        return
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            a = np.frombuffer(m, dtype=np.uint8)
+            for offset in xrange(0, len(a), CHUNK_SIZE):
+                yield a[offset:offset + CHUNK_SIZE]
+            del a
+        finally:
+            m.close()
+
+def iter_records(filename, indices, lines=4):
+    """
+    Yields the records of LINES lines each of FILENAME at the sorted
+    record INDICES, as strings, in one pass over the file.  With LINES
+    None, records are FASTA records of any number of lines.
+    """
+    if lines is None:
+        for record in iter_fasta_records(filename, indices):
+            yield record
+        return
+    indices = iter(indices)
+    wanted = next(indices, None)
+    carry = '' # Start of the record cut by the end of the last chunk
+    done = 0 # Records that ended in earlier chunks
+    line = 0 # Lines that ended in earlier chunks
+    for a in iter_chunks(filename):
+        if wanted is None:
+            return
+        nl = np.flatnonzero(a == NEWLINE)
+        ends = nl[(lines - 1 - line) % lines::lines] # Last newline of each record
+        line += len(nl)
+        while wanted is not None and wanted < done + len(ends):
+            i = wanted - done
+            if i == 0:
+                yield carry + a[:ends[0] + 1].tostring()
+            else:
+                yield a[ends[i - 1] + 1:ends[i] + 1].tostring()
+            wanted = next(indices, None)
+        if len(ends):
+            carry = a[ends[-1] + 1:].tostring()
+        else:
+            carry += a.tostring()
+        done += len(ends)
+    if wanted is not None and wanted == done and carry: # No final newline
+        yield carry + '\n'
+
+def iter_fasta_records(filename, indices):
+    indices = iter(indices)
+    wanted = next(indices, None)
+    carry = '' # Start of the record cut by the end of the last chunk
+    done = -1 # Records started in earlier chunks, less one
+    at_line_start = True
+    for a in iter_chunks(filename):
+        if wanted is None:
+            return
+        starts = np.flatnonzero(a == FASTA_HEADER)
+        if len(starts):
+            line_start = np.zeros(len(starts), dtype=bool)
+            inner = starts > 0
+            line_start[inner] = a[starts[inner] - 1] == NEWLINE
+            line_start[~inner] = at_line_start
+            starts = starts[line_start]
+        at_line_start = len(a) > 0 and a[-1] == NEWLINE
+        # Record done + k ends where the k-th header of this chunk starts
+        while wanted is not None and done <= wanted < done + len(starts):
+            k = wanted - done
+            if k == 0:
+                yield carry + a[:starts[0]].tostring()
+            else:
+                yield a[starts[k - 1]:starts[k]].tostring()
+            wanted = next(indices, None)
+        if len(starts):
+            carry = a[starts[-1]:].tostring()
+        else:
+            carry += a.tostring()
+        done += len(starts)
+    if wanted is not None and wanted == done and carry:
+        if not carry.endswith('\n'):
+            carry += '\n'
+        yield carry
+
+def detect_format(a):
+    for byte in a[:1024]:
+        if byte == FASTA_HEADER:
+            return 'fasta'
+        if byte == FASTQ_HEADER:
+            return 'fastq'
+    return 'fastq'
+
+
+class Scanner:
+    """ Accumulates read statistics from consecutive chunks of a file """
+    def __init__(self, fmt, profile=False):
+        self.format = fmt
+        self.profile = profile
+        self.carry = 0 # Length of the line cut by the end of the last chunk
+        self.carry_first = 0 # and its first byte
+        self.line = 0 # Index of the next line
+        self.record = None # Length so far of the open FASTA record
+        self.count = 0
+        self.bases = 0
+        self.max_length = 0
+        self.base_counts = np.zeros(256, dtype=np.int64)
+        self.qual_min = 255
+        self.qual_max = 0
+        self.length_counts = np.zeros(1, dtype=np.int64)
+
+    def feed(self, a):
+        newline = a == NEWLINE
+        nl = np.flatnonzero(newline)
+        if self.profile:
+            self.profile_bytes(a, nl, newline)
+        if not len(nl):
+            if len(a) and not self.carry:
+                self.carry_first = a[0]
+            self.carry += len(a)
+            return
+        starts = np.empty(len(nl), dtype=np.int64)
+        starts[0] = 0
+        starts[1:] = nl[:-1] + 1
+        lengths = nl - starts
+        first = a[starts]
+        if self.carry:
+            lengths[0] += self.carry
+            first[0] = self.carry_first
+        self.carry = len(a) - nl[-1] - 1
+        if self.carry:
+            self.carry_first = a[nl[-1] + 1]
+        self.lines(lengths, first)
+
+    def finish(self):
+        if self.carry: # No newline at the end of the file
+            self.lines(np.array([self.carry]), np.array([self.carry_first], dtype=np.uint8))
+            self.carry = 0
+        if self.record is not None:
+            self.reads(np.array([self.record]))
+            self.record = None
+
+    def profile_bytes(self, a, nl, newline):
+        """ Counts the bases and quality range in chunk A """
+        bounds = np.concatenate(([0], nl + 1, [len(a)]))
+        seg_lengths = np.diff(bounds) # Lines, or parts of lines, in A
+        if self.format == 'fastq':
+            index = (self.line + np.arange(len(seg_lengths))) % 4
+            seq = index == 1
+            qual = index == 3
+        else:
+            first = a[np.minimum(bounds[:-1], len(a) - 1)]
+            if self.carry:
+                first[0] = self.carry_first
+            seq = first != FASTA_HEADER
+            qual = None
+        self.base_counts += np.bincount(a[np.repeat(seq, seg_lengths) & ~newline],
+                                        minlength=256)
+        if qual is not None:
+            q = a[np.repeat(qual, seg_lengths) & ~newline]
+            if len(q):
+                self.qual_min = min(self.qual_min, int(q.min()))
+                self.qual_max = max(self.qual_max, int(q.max()))
+
+    def lines(self, lengths, first):
+        if self.format == 'fastq':
+            self.reads(lengths[(1 - self.line) % 4::4])
+            self.line += len(lengths)
+            return
+        header = first == FASTA_HEADER
+        seq_lengths = np.where(header, 0, lengths)
+        idx = np.flatnonzero(header)
+        if not len(idx):
+            if self.record is not None:
+                self.record += int(seq_lengths.sum())
+            return
+        sums = np.add.reduceat(seq_lengths, idx)
+        if self.record is not None:
+            self.reads(np.array([self.record + int(seq_lengths[:idx[0]].sum())]))
+        self.reads(sums[:-1])
+        self.record = int(sums[-1])
+
+    def reads(self, lengths):
+        if not len(lengths):
+            return
+        self.count += len(lengths)
+        self.bases += int(lengths.sum())
+        self.max_length = max(self.max_length, int(lengths.max()))
+        if self.profile:
+            counts = np.bincount(lengths)
+            if len(counts) > len(self.length_counts):
+                counts[:len(self.length_counts)] += self.length_counts
+                self.length_counts = counts
+            else:
+                self.length_counts[:len(counts)] += counts
+
+    def stats(self):
+        stats = {'format': self.format,
+                 'count': self.count,
+                 'bases': self.bases,
+                 'max_length': self.max_length,
+                 'mean_length': self.bases / float(self.count) if self.count else 0,
+                 'exact': True}
+        if self.profile:
+            c = self.base_counts
+            gc = int(c[ord('G')] + c[ord('C')] + c[ord('g')] + c[ord('c')])
+            acgt = gc + int(c[ord('A')] + c[ord('T')] + c[ord('a')] + c[ord('t')])
+            stats['gc_content'] = gc / float(acgt) if acgt else 0
+            stats['qual_encoding'] = None
+            if self.format == 'fastq' and self.qual_max:
+                if self.qual_min < 64:
+                    stats['qual_encoding'] = 'phred33'
+                elif self.qual_max > 74:
+                    stats['qual_encoding'] = 'phred64'
+            width = max(1, -(-len(self.length_counts) // HISTOGRAM_BINS))
+            counts = np.add.reduceat(self.length_counts,
+                                     np.arange(0, len(self.length_counts), width))
+            stats['length_histogram'] = {'bin_width': width,
+                                         'counts': [int(n) for n in counts]}
+        return stats
+
+
+def sampled_stats(filename, size, blocks=SAMPLE_BLOCKS, block_size=SAMPLE_BLOCK_SIZE):
+    """ Estimated stats of a FASTQ file from BLOCKS evenly spaced blocks,
+    or None if the file is FASTA or not larger than the sample """
+    if size <= blocks * block_size:
+        return None
+    with open(filename, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            a = np.frombuffer(m, dtype=np.uint8)
+            if detect_format(a[:block_size]) != 'fastq':
+                return None
+            seq_lengths = []
+            record_bytes = 0
+            for i in xrange(blocks):
+                start = i * (size - block_size) // (blocks - 1)
+                lengths, nbytes = sample_block(a[start:start + block_size])
+                seq_lengths.append(lengths)
+                record_bytes += nbytes
+            del a
+        finally:
+            m.close()
+    seq_lengths = np.concatenate(seq_lengths)
+    if not len(seq_lengths):
+        return None
+    count = int(round(size * len(seq_lengths) / float(record_bytes)))
+    mean_length = seq_lengths.mean()
+    return {'format': 'fastq',
+            'count': count,
+            'bases': int(round(count * mean_length)),
+            'max_length': int(seq_lengths.max()),
+            'mean_length': float(mean_length),
+            'exact': False}
+
+def sample_block(b):
+    """ Sequence lengths and total size in bytes of the whole FASTQ
+    records in block B """
+    nl = np.flatnonzero(b == NEWLINE)
+    if len(nl) < 2:
+        return np.array([], dtype=np.int64), 0
+    starts = nl[:-1] + 1
+    lengths = nl[1:] - starts
+    first = b[np.minimum(starts, len(b) - 1)]
+    # A record starts at an '@' line whose line after next is the '+' line
+    # (quality lines may start with '@' too)
+    candidates = np.flatnonzero((first[:-2] == FASTQ_HEADER) &
+                                (first[2:] == FASTQ_SEPARATOR))
+    if not len(candidates):
+        return np.array([], dtype=np.int64), 0
+    k = candidates[0]
+    n = (len(lengths) - k) // 4
+    records = lengths[k:k + 4 * n].reshape(n, 4)
+    return records[:, 1], int(records.sum()) + 4 * n
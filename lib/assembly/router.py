@@ -23,6 +23,7 @@ from traceback import format_exc
 
 # Import A-RAST libs
 import metadata as meta
+import pipe
 import shock
 from nexus import client as nexusclient
 import client as ar_client 
@@ -96,10 +97,29 @@ def check_valid_client(body):
     except:
         return True
 
+def max_pipelines():
+    if parser.has_option('assembly', 'max_pipelines'):
+        return int(parser.get('assembly', 'max_pipelines'))
+    return 1000
+
+def count_pipelines(pipelines):
+    """ Number of pipelines a job expands to, without expanding them """
+    if len(pipelines) > 0:
+        if type(pipelines[0]) is not list: #support legacy arast client
+            pipelines = [pipelines]
+    return sum([pipe.count_branches(p) for p in pipelines])
+
 def route_job(body):
     if not check_valid_client(body):
         return "Client too old, please upgrade"
     client_params = json.loads(body) #dict of params
+    try:
+        num_pipes = count_pipelines(client_params.get('pipeline', []))
+    except ValueError as e: # Bad sweep range
+        return "Invalid pipeline: {}".format(e)
+    max_pipes = max_pipelines()
+    if num_pipes > max_pipes:
+        return "Job expands to {} pipelines, limit is {}".format(num_pipes, max_pipes)
     routing_key = determine_routing_key (1, client_params)
     job_id = metadata.get_next_job_id(client_params['ARASTUSER'])
     if not client_params['data_id']:
@@ -355,6 +375,8 @@ class JobResource:
             return 'Report placeholder'
         elif resource == 'status':
             return self.status(job_id=job_id, **kwargs)
+        elif resource == 'resources':
+            return self.get_resources(userid, job_id)
         elif resource == 'kill':
             user = authenticate_request()
             return self.kill(job_id=job_id, userid=user)
@@ -432,6 +454,36 @@ class JobResource:
             raise cherrypy.HTTPError(500)
         return json.dumps(result_data)
 
+    def get_resources(self, userid=None, job_id=None):
+        """ GET /user/USER/job/JOB/resources
+        CPU time, peak memory, block I/O and context switches of each
+        pipeline and module, and of the assessment of the assemblies.
+        A pipeline's usage includes the stages it shares with earlier
+        pipelines (marked 'reused_from'); 'pipeline_rusage' counts each
+        stage once. """
+        if not job_id:
+            raise cherrypy.HTTPError(403)
+        doc = metadata.get_job(userid, job_id)
+        try:
+            pipelines = doc['pipelines']
+        except:
+            raise cherrypy.HTTPError(500)
+        resources = []
+        for pipeline in pipelines:
+            resources.append({'number': pipeline['number'],
+                              'name': pipeline.get('name'),
+                              'elapsed_time': pipeline.get('elapsed_time'),
+                              'rusage': pipeline.get('rusage'),
+                              'modules': [{'number': m['number'],
+                                           'module': m['module'],
+                                           'elapsed_time': m.get('elapsed_time'),
+                                           'rusage': m.get('rusage'),
+                                           'reused_from': m.get('reused_from')}
+                                          for m in pipeline['modules']]})
+        return json.dumps({'pipelines': resources,
+                           'pipeline_rusage': doc.get('pipeline_rusage'),
+                           'analysis_rusage': doc.get('analysis_rusage')})
+
 class StaticResource:
 
     def __init__(self, static_root):
@@ -579,7 +631,7 @@ class SystemResource:
     def get_connections(self):
         """Returns a list of deduped connection IPs"""
 
-        conns = json.loads(requests.get('http://{}:{}/api/connections'.format(
+        conns = json.loads(shock.http_session().get('http://{}:{}/api/connections'.format(
                     self.rmq_host, self.rmq_admin_port), 
                                         auth=(self.rmq_admin_user, self.rmq_admin_pass)).text)
         ## Dedupe
@@ -592,13 +644,13 @@ class SystemResource:
         return json.dumps(con_json)
 
     def close_connection(self, host):
-        conns = json.loads(requests.get('http://{}:{}/api/connections'.format(
+        conns = json.loads(shock.http_session().get('http://{}:{}/api/connections'.format(
                     self.rmq_host, self.rmq_admin_port), 
                                         auth=(self.rmq_admin_user, self.rmq_admin_pass)).text)
         shutdown_success = False
         for c in conns:
             if c['peer_host'] == host:
-                res = requests.delete('http://{}:{}/api/connections/{}'.format(
+                res = shock.http_session().delete('http://{}:{}/api/connections/{}'.format(
                 self.rmq_host, self.rmq_admin_port, c['name']), 
                                         auth=(self.rmq_admin_user, self.rmq_admin_pass)).text
                 shutdown_success = True
@@ -0,0 +1,120 @@
+"""
+Node-wide allocation of cores to running modules.
+
+A single ResourceScheduler is shared by all workers on a node (and by the
+forked stage branches of their jobs).  Each module run asks for threads
+when it starts and gets a share of the node's cores that depends on what
+else is running and on the resource hints in its plugin's [Settings]:
+
+  min_threads -- threads the module needs to be worth running (default 1)
+  max_threads -- threads the module can use (default: all cores)
+  io_heavy    -- module mostly waits on disk; its threads are counted as
+                 half a core each (default False)
+  mem_base    -- peak memory in MB, independent of input (default 0)
+  mem_factor  -- peak memory in MB per MB of input data (default 0)
+
+Modules with a memory estimate are only started while the estimates of
+running modules plus their own fit within the node's memory limit, and
+while that much memory is actually available.  Otherwise they wait.
+"""
+
+import errno
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+
+class ResourceHints:
+    def __init__(self, settings, cores):
+        settings = dict(settings)
+        self.min_threads = int(settings.get('min_threads', 1))
+        self.max_threads = int(settings.get('max_threads', cores))
+        self.io_heavy = settings.get('io_heavy', 'False').lower() in ('true', 'yes', '1')
+        self.mem_base = float(settings.get('mem_base', 0))
+        self.mem_factor = float(settings.get('mem_factor', 0))
+
+    def memory(self, input_size):
+        """ Estimated peak memory in MB for INPUT_SIZE bytes of input """
+        return self.mem_base + self.mem_factor * input_size / float(2**20)
+
+class ResourceScheduler:
+    def __init__(self, cores, allocations, memory_limit=None, poll_interval=10):
+        self.cores = cores
+        self.allocations = allocations # Shared dict: token -> allocation
+        self.memory_limit = memory_limit or 0.9 * meminfo()['MemTotal'] # MB
+        self.poll_interval = poll_interval
+        self.lock = multiprocessing.Lock()
+
+    def acquire(self, module, hints, input_size=0, on_wait=None):
+        """ Returns (token, threads) for a run of MODULE with HINTS on
+        INPUT_SIZE bytes of data.
+        An idle node gives the module all the cores it can use; a busy
+        one gives it a fair share, never less than hints.min_threads.
+        Blocks until the module's estimated memory can be admitted,
+        calling ON_WAIT(memory, committed) when it first has to wait. """
+        memory = hints.memory(input_size)
+        waiting = False
+        while True:
+            with self.lock:
+                self._reap()
+                committed = sum([a['memory'] for a in self.allocations.values()])
+                if self._admit(memory, committed):
+                    load = sum([a['load'] for a in self.allocations.values()])
+                    free = self.cores - load
+                    share = self.cores / float(len(self.allocations) + 1)
+                    threads = int(max(free, share))
+                    threads = max(hints.min_threads, min(hints.max_threads, threads), 1)
+                    token = str(uuid.uuid4())
+                    self.allocations[token] = {'module': module,
+                                               'pid': os.getpid(),
+                                               'threads': threads,
+                                               'load': threads * (0.5 if hints.io_heavy else 1),
+                                               'memory': memory,
+                                               'start': time.time()}
+                    break
+            if not waiting:
+                waiting = True
+                logging.info('Scheduler: {} waiting for {:.0f} MB ({:.0f} of {:.0f} MB committed)'.format(
+                        module, memory, committed, self.memory_limit))
+                if on_wait:
+                    on_wait(memory, committed)
+            time.sleep(self.poll_interval)
+        logging.info('Scheduler: {} gets {} threads, {:.0f} MB ({:.1f} of {} cores in use)'.format(
+                module, threads, memory, load, self.cores))
+        return token, threads
+
+    def _admit(self, memory, committed):
+        if memory <= 0 or committed <= 0: # Never hold back the only consumer
+            return True
+        return (committed + memory <= self.memory_limit and
+                memory <= meminfo()['MemAvailable'])
+
+    def release(self, token):
+        with self.lock:
+            try:
+                del self.allocations[token]
+            except KeyError:
+                pass
+
+    def _reap(self):
+        """ Drop allocations of processes that died without releasing """
+        for token, a in self.allocations.items():
+            try:
+                os.kill(a['pid'], 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    logging.warning('Scheduler: reclaiming {} threads of {}'.format(
+                            a['threads'], a['module']))
+                    del self.allocations[token]
+
+def meminfo():
+    """ Node memory figures from /proc/meminfo, in MB """
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            fields = line.split()
+            info[fields[0].rstrip(':')] = int(fields[1]) / 1024.0
+    if 'MemAvailable' not in info: # Kernels before 3.14
+        info['MemAvailable'] = info['MemFree'] + info.get('Cached', 0)
+    return info
@@ -2,6 +2,7 @@
 """ Module for shock """
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
 import subprocess
@@ -9,6 +10,58 @@ import StringIO
 import time
 import tempfile
 import sys
+import hashlib
+import threading
+import math
+from multiprocessing.pool import ThreadPool
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+PARTIAL_SUFFIX = '.part'
+UPLOAD_PART_SIZE = 64 * 1024 * 1024 # Larger files are uploaded in parts
+UPLOAD_THREADS = 4
+UPLOAD_RETRIES = 5
+HTTP_TIMEOUT = (10, 300) # (connect, read) seconds
+HTTP_POOL_SIZE = 20
+
+class PooledSession(requests.Session):
+    """ Keep-alive session with a default timeout and, if RETRIES, retry
+    policy """
+    def __init__(self, retries=True):
+        requests.Session.__init__(self)
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                              pool_maxsize=HTTP_POOL_SIZE,
+                              max_retries=retry_policy() if retries else 0)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        return requests.Session.request(self, method, url, **kwargs)
+
+def retry_policy():
+    """ Retry idempotent requests with exponential backoff """
+    try:
+        from requests.packages.urllib3.util.retry import Retry
+    except ImportError:
+        return 3
+    return Retry(total=5, backoff_factor=0.5,
+                 status_forcelist=(500, 502, 503, 504),
+                 method_whitelist=frozenset(['GET', 'HEAD', 'PUT', 'DELETE']))
+
+_sessions = threading.local()
+def http_session(retries=True):
+    """ Returns the session of the calling thread.  Sessions are not
+    shared across threads, as requests.Session is not thread-safe, or
+    across fork().  Callers that retry failed requests themselves pass
+    RETRIES=False so that retries do not multiply. """
+    pid = os.getpid()
+    if getattr(_sessions, 'pid', None) != pid:
+        _sessions.pid = pid
+        _sessions.by_policy = {}
+    if retries not in _sessions.by_policy:
+        _sessions.by_policy[retries] = PooledSession(retries)
+    return _sessions.by_policy[retries]
 
 def download(url, node_id, outdir):
     logging.info("Downloading id: %s" % node_id)
@@ -37,9 +90,9 @@ def download(url, node_id, outdir):
 def post(url, files, user, password):
 	r = None
 	if user and password:
-            r = requests.post(url, auth=(user, password), files=files)
+            r = http_session().post(url, auth=(user, password), files=files)
 	else:
-            r = requests.post(url, files=files)
+            r = http_session().post(url, files=files)
 
         res = json.loads(r.text)
         logging.info(r.text)
@@ -49,7 +102,7 @@ def post(url, files, user, password):
 def get(url, user='assembly', password='service1234'):
     
     r = None
-    r = requests.get(url, auth=(user, password), timeout=20)       
+    r = http_session().get(url, auth=(user, password), timeout=20)
 
     return r
 
@@ -100,12 +153,68 @@ def parse_handle(sn_handle):
             return False
     return False
 
+def feed_sink(sink, data):
+    """ Passes DATA on to SINK.  If the extractor fails (eg. exits on bad
+    data) the sink is aborted and the download carries on without it, so
+    the file can still be extracted once it is complete. """
+    try:
+        sink.write(data)
+    except (IOError, OSError) as e:
+        logging.warning('Streaming extraction stopped ({}), continuing download'.format(e))
+        sink.abort()
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def remove_oversized(partial, size):
+    """ Discard a partial download longer than the SIZE of the data,
+    which cannot be resumed """
+    if size is not None and os.path.exists(partial) and os.path.getsize(partial) > size:
+        logging.warning('Discarding oversized partial download: {}'.format(partial))
+        os.remove(partial)
+
+class ChecksumError(Exception):
+    pass
+
+class TransferError(IOError):
+    """ A transfer that broke off or failed on the server side """
+    pass
+
+def transient(e):
+    """ True if the request that raised E may succeed when retried:
+    connection failures, timeouts, broken transfers and server errors,
+    but not client errors such as 401, 403 or 404 """
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                      requests.exceptions.ChunkedEncodingError, TransferError)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500
+    return False
+
+def check_md5(node, filename, md5):
+    """ Raise if MD5 does not match the checksum recorded on Shock NODE """
+    try:
+        expected = node['file']['checksum']['md5']
+    except (KeyError, TypeError):
+        logging.warning('No checksum on node {}, skipping verification'.format(node['id']))
+        return
+    if expected and expected != md5:
+        raise ChecksumError('Checksum mismatch for {}: expected {}, got {}'.format(
+                filename, expected, md5))
+    logging.info('Checksum verified: {}'.format(filename))
+
 class Shock:
     def __init__(self, shockurl, user, token):
         self.shockurl = shockurl
         self.user = user
         self.token = token
         self.attrs = {'user': user}
+        self.part_size = UPLOAD_PART_SIZE
+        self.upload_threads = UPLOAD_THREADS
 
     def upload_reads(self, filename, curl=False):
         if curl:
@@ -128,11 +237,15 @@ class Shock:
         return self._post_file(filename, filetype=ftype)
 
 
-    def curl_download_file(self, node_id, outdir=None):
-        cmd = ['curl', 
-               '-X', 'GET', '{}/node/{}'.format(self.shockurl, node_id)]
-        r = subprocess.check_output(cmd)
-        filename = json.loads(r)['data']['file']['name']
+    def get_node(self, node_id):
+        """ Returns the data record of Shock node NODE_ID """
+        r = http_session().get('{}/node/{}'.format(self.shockurl, node_id))
+        return json.loads(r.content)['data']
+
+    def curl_download_file(self, node_id, outdir=None, verify=True):
+        """ Download using curl.  Partial files are resumed with a Range request. """
+        node = self.get_node(node_id)
+        filename = node['file']['name'].split('/')[-1]
         if outdir:
             try:
                 os.makedirs(outdir)
@@ -143,22 +256,42 @@ class Shock:
         else:
             outdir = os.getcwd()
         d_url = '{}/node/{}?download'.format(self.shockurl, node_id)
-        cmd = ['curl', 
-               '-o', filename, d_url]
-
-        p = subprocess.Popen(cmd, cwd=outdir)
-        p.wait()
-
         downloaded = os.path.join(outdir, filename)
-        if os.path.exists(downloaded):
-            print "File downloaded: {}".format(downloaded)
-            return downloaded
-        else:
-            raise Exception ('Data does not exist')
-
-    def download_file(self, node_id, outdir=None):
-        r = requests.get('{}/node/{}'.format(self.shockurl, node_id))
-        filename = json.loads(r.content)['data']['file']['name'].split('/')[-1]
+        partial = downloaded + PARTIAL_SUFFIX
+        remove_oversized(partial, node['file'].get('size'))
+        cmd = ['curl', '-s', '-f', '--retry', str(DOWNLOAD_RETRIES),
+               '-C', '-', '-o', partial, d_url]
+
+        for restart in range(2): # Once more from byte 0 after a checksum mismatch
+            p = subprocess.Popen(cmd, cwd=outdir)
+            p.wait()
+            if not os.path.exists(partial):
+                raise Exception ('Data does not exist')
+            if not verify:
+                break
+            try:
+                check_md5(node, partial, file_md5(partial))
+                break
+            except ChecksumError:
+                os.remove(partial)
+                if restart:
+                    raise
+                logging.warning('Corrupt download of {}, restarting'.format(node_id))
+        os.rename(partial, downloaded)
+        print "File downloaded: {}".format(downloaded)
+        return downloaded
+
+    def download_file(self, node_id, outdir=None, resume=True, verify=True, sink=None):
+        """ Stream node NODE_ID to OUTDIR.
+        Data is written to a partial file which is resumed with HTTP Range
+        requests after a transient failure (client errors such as 404 are
+        raised at once), and its MD5 is computed while writing and
+        checked against the node's checksum before the file is renamed into
+        place.  If given, SINK (see extract.StreamExtractor) is fed the data
+        as it arrives and closed once the download is verified.
+        """
+        node = self.get_node(node_id)
+        filename = node['file']['name'].split('/')[-1]
         if outdir:
             try:
                 os.makedirs(outdir)
@@ -169,19 +302,49 @@ class Shock:
 
         d_url = '{}/node/{}?download'.format(self.shockurl, node_id)
         downloaded = os.path.join(outdir, filename)
-        r = requests.get(d_url, stream=True)
-        with open(downloaded, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024): 
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-                    f.flush()
-
-        if os.path.exists(downloaded):
-            print "File downloaded: {}".format(downloaded)
-            return downloaded
-        else:
-            raise Exception ('Data does not exist')
+        partial = downloaded + PARTIAL_SUFFIX
+        size = node['file'].get('size')
+        if not resume and os.path.exists(partial):
+            os.remove(partial)
+        remove_oversized(partial, size)
 
+        try:
+            for restart in range(2): # Once more from byte 0 after a checksum mismatch
+                for attempt in range(DOWNLOAD_RETRIES + 1):
+                    try:
+                        md5 = self._fetch_range(d_url, partial, size, sink)
+                        break
+                    except (requests.exceptions.RequestException, IOError) as e:
+                        if attempt == DOWNLOAD_RETRIES or not transient(e):
+                            raise
+                        logging.warning('Download of {} interrupted ({}), resuming'.format(
+                                node_id, e))
+                        time.sleep(2 ** attempt)
+                if not verify:
+                    break
+                try:
+                    check_md5(node, partial, md5)
+                    break
+                except ChecksumError:
+                    os.remove(partial)
+                    if restart:
+                        raise
+                    logging.warning('Corrupt download of {}, restarting'.format(node_id))
+                    if sink and not sink.aborted: # Was fed the corrupt data
+                        sink.abort()
+        except:
+            if sink:
+                sink.abort()
+            raise
+        os.rename(partial, downloaded)
+        print "File downloaded: {}".format(downloaded)
+        if sink and not sink.aborted:
+            try:
+                sink.close()
+            except:
+                logging.exception('Streaming extraction failed: {}'.format(downloaded))
+                sink.abort()
+        return downloaded
 
     def create_attr_file(self, attrs, outname):
         """ Writes to attr OUTFILE from dict of attrs """ 
@@ -198,8 +361,56 @@ class Shock:
         """ Create in mem filehandle """
         return StringIO.StringIO(json.dumps(attrs))
 
+    def _fetch_range(self, url, partial, size=None, sink=None):
+        """ Appends the remainder of URL to PARTIAL, returns md5 hexdigest.
+        Bytes not yet consumed by SINK are passed on to it. """
+        md5 = hashlib.md5()
+        offset = 0
+        if os.path.exists(partial):
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    md5.update(chunk)
+                    if sink and not sink.aborted and offset + len(chunk) > sink.offset:
+                        feed_sink(sink, chunk[sink.offset - offset:])
+                    offset += len(chunk)
+        if size is not None and offset == size:
+            return md5.hexdigest()
+
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        r = http_session(retries=False).get(url, headers=headers, stream=True, timeout=60)
+        if offset and r.status_code == 416: # Partial file is longer than the data
+            logging.warning('Range not satisfiable, discarding {}'.format(partial))
+            r.close()
+            os.remove(partial)
+            if sink and not sink.aborted:
+                sink.abort()
+            return self._fetch_range(url, partial, size)
+        r.raise_for_status()
+        if offset and r.status_code != 206: # Range ignored, start over
+            logging.info('Server ignored Range request, restarting {}'.format(partial))
+            md5 = hashlib.md5()
+            mode = 'wb'
+            if sink and not sink.aborted: # Cannot rewind the stream
+                sink.abort()
+        else:
+            mode = 'ab'
+        with open(partial, mode) as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk: # filter out keep-alive new chunks
+                    f.write(chunk)
+                    md5.update(chunk)
+                    if sink and not sink.aborted:
+                        feed_sink(sink, chunk)
+        if size is not None and os.path.getsize(partial) < size:
+            raise TransferError('Incomplete transfer: {}'.format(partial))
+        return md5.hexdigest()
+
     def _post_file(self, filename, filetype=''):
         """ Upload using requests """
+        if os.path.getsize(filename) > self.part_size:
+            return self._post_file_parts(filename, filetype=filetype)
         tmp_attr = dict(self.attrs)
         tmp_attr['filetype'] = filetype
         attr_fd = self._create_attr_mem(tmp_attr)
@@ -209,7 +420,7 @@ class Shock:
             with open(filename) as f:
                 files = {'upload': f, 
                          'attributes': attr_fd}
-                r = requests.post('{}/node/'.format(self.shockurl), files=files)
+                r = http_session().post('{}/node/'.format(self.shockurl), files=files)
 
         except:
             print "ERROR: python-requests error, try with --curl flag"
@@ -227,6 +438,66 @@ class Shock:
             print >> sys.stderr, "Upload error"
 	return res
 
+    def _post_file_parts(self, filename, filetype=''):
+        """ Upload FILENAME as a multipart Shock node.
+        The node is created with the number of parts, then the parts are
+        PUT in parallel, each retried on failure.  Shock assembles the file
+        once the last part arrives.
+        """
+        tmp_attr = dict(self.attrs)
+        tmp_attr['filetype'] = filetype
+        attr_fd = self._create_attr_mem(tmp_attr)
+        num_parts = int(math.ceil(os.path.getsize(filename) / float(self.part_size)))
+        r = http_session().post('{}/node/'.format(self.shockurl),
+                          files={'attributes': attr_fd},
+                          data={'parts': num_parts,
+                                'file_name': os.path.basename(filename)})
+        attr_fd.close()
+        res = json.loads(r.text)
+        if res['status'] != 200:
+            print >> sys.stderr, "Upload error: {}".format(res['status'])
+            return res
+        node_id = res['data']['id']
+        logging.info('Uploading {} in {} parts to node {}'.format(
+                filename, num_parts, node_id))
+
+        pool = ThreadPool(min(self.upload_threads, num_parts))
+        try:
+            pool.map(lambda part: self._put_part(node_id, filename, part),
+                     range(1, num_parts + 1))
+        finally:
+            pool.close()
+            pool.join()
+
+        res = json.loads(http_session().get('{}/node/{}'.format(self.shockurl, node_id)).text)
+        print >> sys.stderr, "Upload complete: {}".format(filename)
+        return res
+
+    def _put_part(self, node_id, filename, part):
+        """ Upload part number PART (1-based) of FILENAME """
+        for attempt in range(UPLOAD_RETRIES + 1):
+            try:
+                with open(filename, 'rb') as f:
+                    f.seek((part - 1) * self.part_size)
+                    data = f.read(self.part_size)
+                r = http_session(retries=False).put(
+                    '{}/node/{}'.format(self.shockurl, node_id),
+                    files={str(part): (os.path.basename(filename), data)})
+                r.raise_for_status()
+                status = json.loads(r.text)['status']
+                if status >= 500:
+                    raise TransferError('Shock status {}'.format(status))
+                if status != 200:
+                    raise IOError('Shock status {}'.format(status))
+                logging.debug('Uploaded part {} of {}'.format(part, filename))
+                return
+            except (requests.exceptions.RequestException, IOError) as e:
+                if attempt == UPLOAD_RETRIES or not transient(e):
+                    raise
+                logging.warning('Part {} of {} failed ({}), retrying'.format(
+                        part, filename, e))
+                time.sleep(2 ** attempt)
+
     def _curl_post_file(self, filename, filetype=''):
         tmp_attr = dict(self.attrs)
         tmp_attr['filetype'] = filetype
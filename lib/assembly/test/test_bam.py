@@ -0,0 +1,134 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import bam
+import insertsize
+
+REFERENCES = [('c1', 1000), ('c2', 500)]
+# (name, flag, ref_id, cigar, next_ref_id, tlen)
+ALIGNMENTS = [('p1', 99, 0, [('M', 100)], 0, 300),
+              ('p1', 147, 0, [('M', 100)], 0, -300),
+              ('p2', 99, 0, [('M', 100)], 0, 310),
+              ('p3', 99, 0, [('M', 90)], 0, 290),
+              ('p4', 99, 0, [('M', 50), ('S', 50)], 0, 300),
+              ('p5', 99, 0, [('M', 100)], 1, 0),
+              ('p6', 355, 0, [('M', 100)], 0, 300),
+              ('p7', 4, -1, [], -1, 0)]
+
+def bgzf_block(data):
+    """ BGZF block holding DATA """
+    deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+    body = deflate.compress(data) + deflate.flush()
+    header = struct.pack('<4BI2BH', 0x1f, 0x8b, 8, 4, 0, 0, 255, 6)
+    extra = struct.pack('<2sHH', 'BC', 2, len(header) + 6 + len(body) + 8 - 1)
+    return (header + extra + body +
+            struct.pack('<iI', zlib.crc32(data), len(data)))
+
+def bam_data(references, alignments):
+    text = '@HD\tVN:1.0\n'
+    data = ['BAM\1', struct.pack('<i', len(text)), text, struct.pack('<i', len(references))]
+    for name, length in references:
+        data.append(struct.pack('<i', len(name) + 1) + name + '\0' + struct.pack('<i', length))
+    for name, flag, ref_id, cigar, next_ref_id, tlen in alignments:
+        seq_len = sum([n for op, n in cigar if op in 'MIS=X'])
+        record = (struct.pack('<iiBBHHHiiii', ref_id, 0, len(name) + 1, 60, 0, len(cigar),
+                              flag, seq_len, next_ref_id, 0, tlen) +
+                  name + '\0' +
+                  ''.join([struct.pack('<I', n << 4 | bam.CIGAR_OPS.index(op))
+                           for op, n in cigar]) +
+                  '\x11' * ((seq_len + 1) // 2) + 'I' * seq_len)
+        data.append(struct.pack('<i', len(record)) + record)
+    return ''.join(data)
+
+def sam_lines(references, alignments):
+    lines = ['@SQ\tSN:{}\tLN:{}\n'.format(name, length) for name, length in references]
+    for name, flag, ref_id, cigar, next_ref_id, tlen in alignments:
+        rname = REFERENCES[ref_id][0] if ref_id >= 0 else '*'
+        if next_ref_id < 0:
+            rnext = '*'
+        elif next_ref_id == ref_id:
+            rnext = '='
+        else:
+            rnext = REFERENCES[next_ref_id][0]
+        cigar = ''.join(['{}{}'.format(n, op) for op, n in cigar]) or '*'
+        lines.append('\t'.join([name, str(flag), rname, '1', '60', cigar, rnext, '1',
+                                str(tlen), '*', '*']) + '\n')
+    return lines
+
+
+class BamTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_bam(self, block_size=100):
+        """ BAM file of ALIGNMENTS, with records split across blocks """
+        data = bam_data(REFERENCES, ALIGNMENTS * 10)
+        path = os.path.join(self.dir, 'aln.bam')
+        with open(path, 'wb') as f:
+            for start in range(0, len(data), block_size):
+                f.write(bgzf_block(data[start:start + block_size]))
+            f.write(bgzf_block('')) # EOF marker
+        return path, data
+
+    def test_blocks(self):
+        path, data = self.write_bam()
+        with open(path, 'rb') as f:
+            blocks = list(bam.iter_blocks(f))
+            self.assertEqual(len(blocks), (len(data) + 99) // 100 + 1)
+            self.assertEqual(blocks[0][0], 0)
+            self.assertEqual(sum([size for offset, size in blocks]), os.path.getsize(path))
+            inflated = []
+            for offset, size in blocks:
+                f.seek(offset)
+                inflated.append(bam.inflate_block(f.read(size)))
+        self.assertEqual(''.join(inflated), data)
+
+    def test_is_bam(self):
+        path, data = self.write_bam()
+        self.assertTrue(bam.is_bam(path))
+        sam = os.path.join(self.dir, 'aln.sam')
+        with open(sam, 'w') as f:
+            f.writelines(sam_lines(REFERENCES, ALIGNMENTS))
+        self.assertFalse(bam.is_bam(sam))
+
+    def test_corrupt_block(self):
+        block = bgzf_block('x' * 100)
+        self.assertRaises(bam.BGZFError, bam.inflate_block, block[:20] + block[-8:])
+
+    def test_truncated(self):
+        path, data = self.write_bam()
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 50)
+        self.assertRaises(bam.BGZFError, list, bam.BamReader(path))
+
+    def test_records(self):
+        path, data = self.write_bam()
+        for processes, batch_blocks in [(1, 256), (1, 1), (2, 3)]:
+            reader = bam.BamReader(path, processes, batch_blocks)
+            alignments = list(reader)
+            self.assertEqual(reader.references, REFERENCES)
+            self.assertEqual(len(alignments), len(ALIGNMENTS) * 10)
+            for aln, (name, flag, ref_id, cigar, next_ref_id, tlen) in zip(alignments,
+                                                                           ALIGNMENTS * 10):
+                self.assertEqual(aln, bam.Alignment(ref_id, flag, next_ref_id, tlen,
+                                                    tuple(cigar)))
+
+    def test_same_as_sam(self):
+        path, data = self.write_bam()
+        expected = insertsize.parse_sam(sam_lines(REFERENCES, ALIGNMENTS * 10)).result()
+        self.assertEqual(expected['pairs'], 30)
+        self.assertEqual(insertsize.parse_file(path).result(), expected)
+        self.assertEqual(insertsize.parse_bam_file(path, processes=2).result(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
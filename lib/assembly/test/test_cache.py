@@ -0,0 +1,192 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import cache
+
+
+class FakeShockClient:
+    """ Shock client serving NODES, {node id: (filename, data)} """
+    def __init__(self, nodes, delay=0):
+        self.nodes = nodes
+        self.delay = delay
+        self.downloads = []
+        self.lock = threading.Lock()
+
+    def get_node(self, node_id):
+        name, data = self.nodes[node_id]
+        return {'id': node_id,
+                'file': {'name': name, 'checksum': {'md5': hashlib.md5(data).hexdigest()}}}
+
+    def download_file(self, node_id, outdir=None, sink=None):
+        with self.lock:
+            self.downloads.append(node_id)
+        time.sleep(self.delay)
+        name, data = self.nodes[node_id]
+        cache.makedirs(outdir)
+        path = os.path.join(outdir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+
+class ShockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = cache.ShockCache(os.path.join(self.dir, 'cache'), 250)
+        self.sclient = FakeShockClient({'n1': ('r1.fq', 'A' * 100),
+                                        'n2': ('r2.fq', 'C' * 100),
+                                        'n3': ('r3.fq', 'G' * 100),
+                                        'copy': ('copy.fq', 'A' * 100)})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def outdir(self, name):
+        path = os.path.join(self.dir, name)
+        cache.makedirs(path)
+        return path
+
+    def fetch(self, node_id, job='job'):
+        return self.cache.fetch(self.sclient, node_id, self.outdir(job))
+
+    def cached(self):
+        return sorted([meta['shock_id'] for t, d, meta in self.cache.entries()])
+
+    def test_miss_then_hit(self):
+        first = self.fetch('n1', 'job1')
+        second = self.fetch('n1', 'job2')
+        self.assertEqual(self.sclient.downloads, ['n1'])
+        self.assertEqual([first, second], [os.path.join(self.dir, 'job1', 'r1.fq'),
+                                           os.path.join(self.dir, 'job2', 'r1.fq')])
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino) # Hardlinked
+        self.assertEqual(self.cache.prefetch(self.sclient, 'n1'),
+                         os.path.join(self.cache.cachepath, 'n1', 'r1.fq'))
+
+    def test_single_flight(self):
+        self.sclient.delay = 0.2
+        results = []
+        def fetch(job):
+            results.append(self.fetch('n1', job))
+        threads = [threading.Thread(target=fetch, args=('job{}'.format(i),)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.sclient.downloads, ['n1'])
+        self.assertEqual(len(results), 4)
+        for path in results:
+            with open(path) as f:
+                self.assertEqual(f.read(), 'A' * 100)
+
+    def test_checksum_hit(self):
+        self.fetch('n1')
+        path = self.fetch('copy')
+        self.assertEqual(self.sclient.downloads, ['n1'])
+        self.assertEqual(path, os.path.join(self.dir, 'job', 'copy.fq'))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'A' * 100)
+        self.assertEqual(self.cached(), ['n1'])
+
+    def test_least_recently_used_evicted(self):
+        self.fetch('n1')
+        os.utime(os.path.join(self.cache.cachepath, 'n1'), (100, 100))
+        self.fetch('n2')
+        os.utime(os.path.join(self.cache.cachepath, 'n2'), (200, 200))
+        self.fetch('n1') # Used again
+        self.fetch('n3')
+        self.assertEqual(self.cached(), ['n1', 'n3'])
+        # The checksum of an evicted entry no longer matches
+        self.fetch('n2')
+        self.assertEqual(self.sclient.downloads, ['n1', 'n2', 'n3', 'n2'])
+
+    def test_entry_in_use_kept(self):
+        self.fetch('n1')
+        self.fetch('n2')
+        lock = cache.EntryLock(os.path.join(self.cache.cachepath, 'n1'))
+        lock.acquire()
+        try:
+            for d in ['n1', 'n2']:
+                os.utime(os.path.join(self.cache.cachepath, d), (100, 100))
+            self.fetch('n3')
+        finally:
+            lock.release()
+        self.assertEqual(self.cached(), ['n1', 'n3'])
+
+    def test_lock(self):
+        entry = os.path.join(self.dir, 'entry')
+        held = cache.EntryLock(entry)
+        held.acquire()
+        self.assertFalse(cache.EntryLock(entry, blocking=False).acquire())
+        held.release()
+        other = cache.EntryLock(entry, blocking=False)
+        self.assertTrue(other.acquire())
+        other.release()
+
+
+class ModuleCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = cache.ModuleCache(os.path.join(self.dir, 'modules'), 10**6)
+        self.outpath = os.path.join(self.dir, 'run1')
+        os.makedirs(os.path.join(self.outpath, 'asm'))
+        for name, data in [('asm/contigs.fa', '>c1\nACGT\n'), ('velvet.log', 'done\n')]:
+            with open(os.path.join(self.outpath, name), 'w') as f:
+                f.write(data)
+        self.key = self.cache.key({'module': 'velvet', 'settings': {'k': 29}})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_key(self):
+        self.assertEqual(self.cache.key({'a': 1, 'b': [2]}), self.cache.key({'b': [2], 'a': 1}))
+        self.assertNotEqual(self.cache.key({'a': 1}), self.cache.key({'a': 2}))
+
+    def test_put_restore(self):
+        contigs = os.path.join(self.outpath, 'asm', 'contigs.fa')
+        self.assertEqual(self.cache.lookup(self.key), None)
+        self.assertTrue(self.cache.put(self.key, self.outpath, ([contigs], ['scaffolds']),
+                                       os.path.join(self.outpath, 'velvet.log')))
+        shutil.rmtree(self.outpath)
+        meta = self.cache.lookup(self.key)
+        self.assertEqual(sorted(meta['files']), ['asm/contigs.fa', 'velvet.log'])
+        outdir = os.path.join(self.dir, 'run2')
+        output, log, files = self.cache.restore(self.key, meta, outdir)
+        restored = os.path.join(outdir, 'asm', 'contigs.fa')
+        self.assertEqual(output, ([restored], ['scaffolds']))
+        self.assertEqual(log, os.path.join(outdir, 'velvet.log'))
+        self.assertEqual(sorted(files), [restored, log])
+        with open(restored) as f:
+            self.assertEqual(f.read(), '>c1\nACGT\n')
+
+    def test_outside_output_not_cached(self):
+        elsewhere = os.path.join(self.dir, 'reads.fq')
+        open(elsewhere, 'w').close()
+        self.assertFalse(self.cache.put(self.key, self.outpath, [elsewhere],
+                                        os.path.join(self.outpath, 'velvet.log')))
+        os.symlink(elsewhere, os.path.join(self.outpath, 'reads.fq'))
+        self.assertFalse(self.cache.put(self.key, self.outpath, [],
+                                        os.path.join(self.outpath, 'velvet.log')))
+        self.assertEqual(self.cache.lookup(self.key), None)
+
+    def test_digest_by_inode(self):
+        contigs = os.path.join(self.outpath, 'asm', 'contigs.fa')
+        md5 = hashlib.md5('>c1\nACGT\n').hexdigest()
+        self.assertEqual(self.cache.digest(contigs), md5)
+        linked = cache.link_file(contigs, os.path.join(self.dir, 'job', 'contigs.fa'))
+        file_md5 = cache.file_md5
+        cache.file_md5 = None # Not read again
+        try:
+            self.assertEqual(self.cache.digest(linked), md5)
+        finally:
+            cache.file_md5 = file_md5
+
+
+if __name__ == '__main__':
+    unittest.main()
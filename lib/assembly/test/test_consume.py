@@ -0,0 +1,354 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import consume
+import pipe
+import readstats
+from job import ArastJob
+from tracing import Tracer
+
+
+def exit_child(code):
+    os._exit(code)
+
+def put_result(queue, number):
+    queue.put((number, 'result'))
+
+
+class Stage:
+    module = 'velvet'
+
+
+class FakeModules:
+    """ Module manager whose assemblers write one contig, longest for
+    k=41, and whose other modules pass their input on.  Module 'fail'
+    raises, 'crash' exits its process. """
+    thread_budget = None
+    scheduler = None
+    max_pipelines = 1000
+    module_cache = None
+
+    def __init__(self):
+        self.runs = [] # (module, params)
+
+    def parse_input(self, p):
+        return pipe.parse_branches(p)
+
+    def parse_pipe(self, p):
+        modules, overrides = [], []
+        for word in p:
+            if word.startswith('?'):
+                k, v = word[1:].split('=')
+                overrides[-1][k] = v
+            else:
+                modules.append(word)
+                overrides.append({})
+        return modules, overrides
+
+    def get_short_name(self, module):
+        return None
+
+    def output_type(self, module):
+        return 'reads' if module == 'trim' else 'contigs'
+
+    def run_module(self, module, job_data, all_data=True, reads=False, tar=False, meta=False):
+        outdir = tempfile.mkdtemp(dir=os.path.join(job_data['datapath'], str(job_data['job_id'])))
+        log = os.path.join(outdir, 'log')
+        open(log, 'w').close()
+        if module == 'quast':
+            report = os.path.join(outdir, 'report.tar.gz')
+            open(report, 'w').close()
+            return None, report, [], log
+        self.runs.append((module, dict(job_data['params'])))
+        if module == 'fail':
+            raise Exception('bad input')
+        if module == 'crash':
+            os._exit(3)
+        consume.add_rusage(self.rusage, {'user_time': 1.0})
+        if module == 'trim':
+            return [{'files': ['trimmed.fq'], 'type': 'paired'}], [], log
+        contigs = os.path.join(outdir, 'contigs.fa')
+        if job_data['contigs']:
+            shutil.copy(job_data['contigs'][0], contigs)
+        else:
+            length = 1000 - (int(dict(job_data['params'])['k']) - 41) ** 2
+            with open(contigs, 'w') as f:
+                f.write('>c1\n' + 'A' * length + '\n')
+        return [contigs], [contigs], log
+
+
+class FakeMetadata:
+    def __init__(self):
+        self.checkpoints = {}
+        self.data_doc = {'_id': 'data'}
+
+    def update_job(self, uid, field, value):
+        if field.startswith('checkpoints.'):
+            self.checkpoints[field.split('.', 1)[1]] = json.loads(json.dumps(value))
+        elif uid == self.data_doc['_id']:
+            self.data_doc[field] = value
+
+    def get_doc_by_data_id(self, data_id, user):
+        return self.data_doc
+
+    def get_checkpoints(self, uid):
+        return dict(self.checkpoints)
+
+
+class ConsumerTest(unittest.TestCase):
+    """ Runs pipelines of FakeModules on a consumer without a server """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, '7'))
+        self.consumer = types.InstanceType(consume.ArastConsumer)
+        self.consumer.tracer = Tracer()
+        self.consumer.pmanager = FakeModules()
+        self.consumer.metadata = FakeMetadata()
+        self.consumer.out_report = open(os.devnull, 'w')
+        self.consumer.pipeline_concurrency = 1
+        self.consumer.pipeline_cores = 4
+        self.consumer.sweep_budget = 10
+        self.consumer.fork_guard = consume.ForkGuard()
+        self.consumer.prefetch_thread = None
+        self.job_data = ArastJob({'job_id': 7, 'uid': 'u', 'datapath': self.dir,
+                                  'raw_reads': [{'files': ['reads.fq']}],
+                                  'out_report': self.consumer.out_report,
+                                  'logfiles': [], 'reference': []})
+
+    def tearDown(self):
+        self.consumer.out_report.close()
+        shutil.rmtree(self.dir)
+
+    def runs(self):
+        return [(module, params.get('k')) for module, params in self.consumer.pmanager.runs]
+
+    def tree(self, *pipes):
+        """ Stage tree of PIPES, and the last stage of each """
+        plans = []
+        for pipeline_num, p in enumerate(pipes, 1):
+            modules, overrides = self.consumer.pmanager.parse_pipe(p)
+            plans.append((pipeline_num, modules, overrides))
+        return pipe.build_stage_tree(plans)
+
+    def statuses(self, root):
+        return [(n.module, n.params.get('k'), n.result['status'])
+                for n in pipe.iter_stages(root)]
+
+
+class StageTreeRunTest(ConsumerTest):
+    def test_shared_stage_runs_once(self):
+        root, leaves = self.tree(['trim', 'velvet', '?k=31'], ['trim', 'velvet', '?k=41'])
+        self.consumer.run_stage_tree(root, self.job_data)
+        self.assertEqual(self.runs(), [('trim', None), ('velvet', '31'), ('velvet', '41')])
+        self.consumer.run_stage_tree(root, self.job_data)
+        self.assertEqual(len(self.runs()), 3) # Nothing left to run
+
+    def test_failure_skips_subtree(self):
+        root, leaves = self.tree(['fail', 'velvet', '?k=31'], ['trim', 'velvet', '?k=31'])
+        done = []
+        self.consumer.run_stage_tree(root, self.job_data,
+                                     on_node_done=lambda node: done.append(node.module))
+        self.assertEqual(self.runs(), [('fail', None), ('trim', None), ('velvet', '31')])
+        self.assertEqual(leaves[1].parent.result['exception'], 'fail:\nbad input')
+        self.assertEqual(leaves[1].result['status'], 'skipped')
+        self.assertEqual(leaves[2].result['status'], 'complete')
+        self.assertEqual(sorted(done), ['fail', 'trim', 'velvet', 'velvet'])
+
+    def test_forked_branches(self):
+        self.consumer.pipeline_concurrency = 2
+        self.consumer.connect_metadata = FakeMetadata
+        self.addCleanup(setattr, consume, 'STAGE_POLL_INTERVAL', consume.STAGE_POLL_INTERVAL)
+        consume.STAGE_POLL_INTERVAL = 0.1
+        root, leaves = self.tree(['trim', 'velvet', '?k=31'], ['trim', 'velvet', '?k=41'],
+                                 ['fail', 'velvet', '?k=31'], ['crash', 'velvet', '?k=31'])
+        self.consumer.run_stage_tree(root, self.job_data)
+        self.assertEqual(sorted(self.statuses(root)),
+                         [('crash', None, 'failed'), ('fail', None, 'failed'),
+                          ('trim', None, 'complete'),
+                          ('velvet', '31', 'complete'), ('velvet', '31', 'skipped'),
+                          ('velvet', '31', 'skipped'), ('velvet', '41', 'complete')])
+        with open(leaves[2].result['contigs'][0]) as f:
+            self.assertEqual(f.read(), '>c1\n' + 'A' * 1000 + '\n')
+        self.assertEqual(leaves[4].parent.result['exception'],
+                         'crash:\nStage process exited with code 3')
+        self.assertEqual(self.consumer.pmanager.thread_budget, None)
+
+
+class CheckpointTest(ConsumerTest):
+    pipes = [['trim', 'velvet', '?k=31'], ['trim', 'velvet', '?k=41']]
+
+    def run_tree(self):
+        """ Run PIPES as a redelivered job would, on a new stage tree """
+        root, leaves = self.tree(*self.pipes)
+        self.consumer.run_stage_tree(root, self.job_data)
+        return root, leaves
+
+    def test_resume(self):
+        first, leaves = self.run_tree()
+        self.assertEqual(len(self.consumer.metadata.checkpoints), 3)
+        root, resumed = self.run_tree()
+        self.assertEqual(len(self.runs()), 3) # Nothing ran again
+        for n in pipe.iter_stages(root):
+            self.assertTrue(n.result['restored'])
+        self.assertEqual(resumed[1].result['contigs'], leaves[1].result['contigs'])
+        self.assertEqual(resumed[1].result['status'], 'complete')
+
+    def test_stale_files(self):
+        root, leaves = self.run_tree()
+        with open(leaves[2].result['contigs'][0], 'a') as f:
+            f.write('>c2\nA\n')
+        self.run_tree()
+        self.assertEqual(self.runs(), [('trim', None), ('velvet', '31'), ('velvet', '41'),
+                                       ('velvet', '41')])
+
+    def test_failure_not_saved(self):
+        self.pipes = [['fail', 'velvet', '?k=31']]
+        self.run_tree()
+        self.run_tree()
+        self.assertEqual(self.runs(), [('fail', None), ('fail', None)])
+        self.assertEqual(self.consumer.metadata.checkpoints, {})
+
+    def test_other_params(self):
+        self.run_tree()
+        self.pipes = [['trim', 'velvet', '?k=51']]
+        self.run_tree()
+        self.assertEqual(self.runs()[3:], [('velvet', '51')])
+
+
+class ReadStatsIndexTest(ConsumerTest):
+    def setUp(self):
+        ConsumerTest.setUp(self)
+        self.reads = os.path.join(self.dir, 'reads.fq')
+        with open(self.reads, 'w') as f:
+            f.write('@r1\nACGT\n+\nIIII\n@r2\nGG\n+\nII\n')
+        self.libs = [{'files': [self.reads]}]
+        self.params = {'data_id': 3, 'ARASTUSER': 'alice'}
+        readstats._cache.clear()
+
+    def index(self):
+        return self.consumer.index_read_stats(self.params, self.dir, self.libs)
+
+    def not_read(self, filename):
+        self.fail('{} read again'.format(filename))
+
+    def test_index(self):
+        stats = self.index()[self.reads]
+        self.assertEqual((stats['count'], stats['bases'], stats['file'], stats['size']),
+                         (2, 6, 'reads.fq', os.path.getsize(self.reads)))
+        self.assertEqual(self.consumer.metadata.data_doc['read_stats'], [stats])
+        with open(os.path.join(self.dir, consume.READ_STATS_FILE)) as f:
+            self.assertEqual(json.load(f), [stats])
+
+    def test_reused(self):
+        stats = self.index()
+        self.addCleanup(setattr, readstats, 'read_profile', readstats.read_profile)
+        readstats.read_profile = self.not_read
+        readstats._cache.clear()
+        self.assertEqual(self.index(), stats) # From the sidecar file
+        self.assertEqual(readstats.read_stats(self.reads)['count'], 2)
+        os.remove(os.path.join(self.dir, consume.READ_STATS_FILE))
+        self.assertEqual(self.index(), stats) # From the data document
+        self.assertTrue(os.path.exists(os.path.join(self.dir, consume.READ_STATS_FILE)))
+
+    def test_changed_file(self):
+        self.index()
+        with open(self.reads, 'a') as f:
+            f.write('@r3\nA\n+\nI\n')
+        self.assertEqual(self.index()[self.reads]['count'], 3)
+
+
+class RusageTest(ConsumerTest):
+    def test_shared_stage_counted_once(self):
+        self.consumer.run_pipeline([['trim', 'velvet ?k=31:41:10']], self.job_data)
+        self.assertEqual(self.runs(), [('trim', None), ('velvet', '31'), ('velvet', '41')])
+        first, second = [self.job_data.get_pipeline(n) for n in (1, 2)]
+        self.assertEqual(first['rusage']['user_time'], 2)
+        self.assertEqual(second['rusage']['user_time'], 2)
+        self.assertEqual(first.get_module(1).get('reused_from'), None)
+        self.assertEqual(second.get_module(1)['reused_from'], 1)
+        self.assertEqual(second.get_module(2).get('reused_from'), None)
+        self.assertEqual(self.job_data['pipeline_rusage']['user_time'], 3)
+
+
+class AdaptiveSweepRunTest(ConsumerTest):
+    def test_leaf_run_in_earlier_round(self):
+        # velvet ?k=31 runs in the first round as the first stage of
+        # the sspace pipeline, and is itself a pipeline of the second
+        self.consumer.run_pipeline([['velvet ?k=21:61:10'], ['velvet ?k=31', 'sspace']],
+                                   self.job_data, sweep='adaptive')
+        self.assertEqual(self.runs().count(('velvet', '31')), 1)
+        self.assertEqual(len(self.job_data['pipelines']), 6)
+
+
+class WaitStageTest(unittest.TestCase):
+    def setUp(self):
+        self.interval = consume.STAGE_POLL_INTERVAL
+        consume.STAGE_POLL_INTERVAL = 0.1
+
+    def tearDown(self):
+        consume.STAGE_POLL_INTERVAL = self.interval
+
+    def start(self, target, *args):
+        p = multiprocessing.Process(target=target, args=args)
+        p.start()
+        return p
+
+    def test_dead_child_fails(self):
+        queue = multiprocessing.Queue()
+        running = {1: (Stage(), self.start(exit_child, 9)),
+                   2: (Stage(), self.start(put_result, queue, 2))}
+        results = {}
+        while running:
+            number, result = consume.ArastConsumer.wait_stage.im_func(None, queue, running)
+            running.pop(number)[1].join()
+            results[number] = result
+        self.assertEqual(results[2], 'result')
+        self.assertEqual(results[1]['status'], 'failed')
+        self.assertEqual(results[1]['exception'],
+                         'velvet:\nStage process exited with code 9')
+
+
+class ForkGuardTest(unittest.TestCase):
+    def test_fork_waits_for_work(self):
+        guard = consume.ForkGuard()
+        events = []
+        started = threading.Event()
+        def work():
+            with guard.busy():
+                started.set()
+                time.sleep(0.2)
+                events.append('work')
+        t = threading.Thread(target=work)
+        t.start()
+        started.wait()
+        with guard.forking():
+            events.append('fork')
+        t.join()
+        self.assertEqual(events, ['work', 'fork'])
+
+    def test_work_waits_for_fork(self):
+        guard = consume.ForkGuard()
+        events = []
+        def work():
+            with guard.busy():
+                events.append('work')
+        with guard.forking():
+            t = threading.Thread(target=work)
+            t.start()
+            time.sleep(0.2)
+            events.append('fork')
+        t.join()
+        self.assertEqual(events, ['fork', 'work'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import cache
+import disk
+
+
+class SizedEvictor(disk.DiskEvictor):
+    """ Evictor on a disk of CAPACITY bytes that holds only the data path """
+    capacity = 10000
+
+    def free_space(self):
+        used = sum([disk.dir_size(os.path.join(self.datapath, d))
+                    for d in os.listdir(self.datapath)])
+        return self.capacity - used - sum(self.reserved.values())
+
+
+class DiskEvictorTest(unittest.TestCase):
+    def setUp(self):
+        self.datapath = tempfile.mkdtemp()
+        self.job_list = []
+        self.pinned = []
+
+    def tearDown(self):
+        shutil.rmtree(self.datapath)
+
+    def evictor(self, min_free_space, **kwargs):
+        return SizedEvictor(self.datapath, min_free_space, self.job_list, self.pinned,
+                            **kwargs)
+
+    def make(self, path, size=1000, last_used=0):
+        path = os.path.join(self.datapath, path)
+        os.makedirs(os.path.join(path, 'raw'))
+        with open(os.path.join(path, 'raw', 'reads.fq'), 'w') as f:
+            f.write('A' * size)
+        os.utime(path, (last_used, last_used))
+        return path
+
+    def remaining(self):
+        return sorted([os.path.join(user, data_id)
+                       for user in os.listdir(self.datapath)
+                       if os.path.isdir(os.path.join(self.datapath, user))
+                       for data_id in os.listdir(os.path.join(self.datapath, user))])
+
+    def test_enough_space(self):
+        self.make('alice/1')
+        self.assertTrue(self.evictor(1000).make_space(1000))
+        self.assertEqual(self.remaining(), ['alice/1'])
+
+    def test_least_recently_used_first(self):
+        self.make('alice/1', last_used=100)
+        self.make('bob/1', last_used=200)
+        self.make('alice/2', last_used=300)
+        self.assertTrue(self.evictor(7000).make_space(1500))
+        self.assertEqual(self.remaining(), ['alice/2'])
+        self.assertEqual(sorted(self.evictor(0).load_index().keys()), ['alice/2'])
+
+    def test_touch(self):
+        self.make('alice/1', last_used=100)
+        self.make('bob/1', last_used=200)
+        evictor = self.evictor(8500)
+        evictor.save_index(evictor.update_index())
+        evictor.touch(os.path.join(self.datapath, 'alice/1'))
+        self.assertTrue(evictor.make_space(0))
+        self.assertEqual(self.remaining(), ['alice/1'])
+
+    def test_in_use_kept(self):
+        self.make('alice/1', last_used=100)
+        running = self.make('bob/1', last_used=200)
+        pinned = self.make('carol/1', last_used=300)
+        self.make('alice/2', last_used=400)
+        self.job_list.append({'datapath': running})
+        evictor = self.evictor(9000)
+        evictor.pin(pinned)
+        self.assertFalse(evictor.make_space(0))
+        self.assertEqual(self.remaining(), ['bob/1', 'carol/1'])
+        evictor.unpin(pinned)
+        self.assertTrue(evictor.make_space(0))
+        self.assertEqual(self.remaining(), ['bob/1'])
+
+    def test_reserved(self):
+        self.make('alice/1', last_used=100)
+        self.make('bob/1', last_used=200)
+        evictor = self.evictor(7000)
+        self.assertTrue(evictor.make_space(0))
+        self.assertEqual(len(self.remaining()), 2)
+        target = os.path.join(self.datapath, 'carol', '1')
+        evictor.pin(target, reserve=2500)
+        self.assertEqual(evictor.free_space(), 5500)
+        self.assertTrue(evictor.make_space(0))
+        self.assertEqual(self.remaining(), [])
+        evictor.unpin(target)
+        self.assertEqual(evictor.reserved, {})
+
+    def test_cache_paths_excluded(self):
+        store = cache.ShockCache(os.path.join(self.datapath, 'shared', 'cache'), 10**9)
+        default = cache.ShockCache(os.path.join(self.datapath, '_cache'), 10**9)
+        for c in [store, default]:
+            with open(os.path.join(c.cachepath, 'other.fq'), 'w') as f:
+                f.write('A' * 1000) # Not an entry, never evicted
+        self.make('shared/1', last_used=100)
+        self.make('alice/1', last_used=200)
+        evictor = self.evictor(10000, stores=[store, default])
+        self.assertFalse(evictor.make_space(0))
+        self.assertEqual(self.remaining(), ['_cache/md5', '_cache/other.fq', 'shared/cache'])
+        self.assertTrue(os.path.exists(os.path.join(store.cachepath, 'other.fq')))
+
+    def test_key(self):
+        evictor = self.evictor(0)
+        self.assertEqual(evictor._key(os.path.join(self.datapath, 'alice', '1')), 'alice/1')
+        self.assertEqual(evictor._key(os.path.join(self.datapath, 'alice')), None)
+        self.assertEqual(evictor._key('/elsewhere/alice/1'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
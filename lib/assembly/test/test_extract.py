@@ -0,0 +1,141 @@
+import bz2
+import gzip
+import os
+import shutil
+import StringIO
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import extract
+
+READS = ''.join(['@r{}\nACGTACGT\n+\nIIIIIIII\n'.format(i) for i in range(5000)])
+
+
+class ExtractTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def gz(self, name, data):
+        path = os.path.join(self.dir, name)
+        f = gzip.open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def tarball(self, name, members, mode='w:gz'):
+        path = os.path.join(self.dir, name)
+        tar = tarfile.open(path, mode)
+        for member, data in members:
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            tar.addfile(info, StringIO.StringIO(data))
+        tar.close()
+        return path
+
+    def stream(self, path, size=None):
+        """ Feed the first SIZE bytes of PATH to a StreamExtractor """
+        sink = extract.stream_extractor(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        data = data[:size]
+        for start in range(0, len(data), 1000):
+            sink.write(data[start:start + 1000])
+        return sink
+
+    def listing(self):
+        return sorted([os.path.relpath(os.path.join(root, name), self.dir)
+                       for root, dirs, names in os.walk(self.dir) for name in names])
+
+    def test_archive_type(self):
+        self.assertEqual(extract.archive_type('reads.tar.gz'), ('tar', 'tar.gz'))
+        self.assertEqual(extract.archive_type('reads.tgz'), ('tar', 'tgz'))
+        self.assertEqual(extract.archive_type('reads.fq.bz2'), ('bz2', 'bz2'))
+        self.assertEqual(extract.archive_type('reads.zip'), ('other', 'zip'))
+        self.assertEqual(extract.archive_type('reads.fq'), (None, None))
+        self.assertEqual(extract.stream_extractor('reads.zip'), None)
+
+    def test_stream_gz(self):
+        path = self.gz('reads.fq.gz', READS)
+        sink = self.stream(path)
+        self.assertEqual(sink.offset, os.path.getsize(path))
+        out = os.path.join(self.dir, 'reads.fq')
+        self.assertEqual(sink.close(), [out])
+        with open(out) as f:
+            self.assertEqual(f.read(), READS)
+        self.assertEqual(extract.read_manifest(path), [out])
+        self.assertEqual(extract.extract_file(path), [out])
+
+    def test_stream_tar(self):
+        path = self.tarball('reads.tar.gz', [('lib/r1.fq', READS), ('lib/r2.fq', READS[:100])])
+        files = self.stream(path).close()
+        self.assertEqual(sorted(files), [os.path.join(self.dir, 'lib', 'r1.fq'),
+                                         os.path.join(self.dir, 'lib', 'r2.fq')])
+        with open(files[0]) as f:
+            self.assertTrue(f.read() in (READS, READS[:100]))
+        self.assertEqual(self.listing(), ['lib/r1.fq', 'lib/r2.fq', 'reads.tar.gz',
+                                          'reads.tar.gz.extracted'])
+
+    def wait_for_output(self, count):
+        """ Wait until the extractor has written some output """
+        for i in range(500):
+            if len(self.listing()) > count:
+                return
+            time.sleep(0.01)
+        self.fail('No output extracted')
+
+    def test_abort_leaves_nothing(self):
+        path = self.tarball('reads.tar', [('r1.fq', READS), ('r2.fq', READS)], 'w')
+        sink = self.stream(path, os.path.getsize(path) // 2)
+        self.wait_for_output(1)
+        sink.abort()
+        self.assertEqual(sorted(os.listdir(self.dir)), ['reads.tar'])
+        path = self.gz('reads.fq.gz', READS)
+        self.stream(path, os.path.getsize(path) // 2).abort()
+        self.assertEqual(sorted(os.listdir(self.dir)), ['reads.fq.gz', 'reads.tar'])
+
+    def test_fallback_after_abort(self):
+        path = self.tarball('reads.tar.gz', [('r1.fq', READS)])
+        self.stream(path, os.path.getsize(path) // 2).abort()
+        self.assertEqual(extract.extract_file(path), [os.path.join(self.dir, 'r1.fq')])
+        with open(os.path.join(self.dir, 'r1.fq')) as f:
+            self.assertEqual(f.read(), READS)
+
+    def test_corrupt(self):
+        path = os.path.join(self.dir, 'reads.tar.gz')
+        with open(path, 'wb') as f:
+            f.write('not an archive' * 100)
+        sink = self.stream(path)
+        self.assertRaises(Exception, sink.close)
+        self.assertTrue(sink.aborted)
+        self.assertEqual(self.listing(), ['reads.tar.gz'])
+
+    def test_replaces_previous_output(self):
+        path = self.tarball('reads.tar.gz', [('lib/r1.fq', READS)])
+        os.makedirs(os.path.join(self.dir, 'lib'))
+        with open(os.path.join(self.dir, 'lib', 'stale.fq'), 'w') as f:
+            f.write('partial')
+        extract.extract_file(path)
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'lib')), ['r1.fq'])
+
+    def test_bz2(self):
+        path = os.path.join(self.dir, 'reads.fq.bz2')
+        with open(path, 'wb') as f:
+            f.write(bz2.compress(READS))
+        out = extract.extract_file(path)
+        with open(out[0]) as f:
+            self.assertEqual(f.read(), READS)
+
+    def test_plain_file(self):
+        path = os.path.join(self.dir, 'reads.fq')
+        self.assertEqual(extract.extract_file(path), [path])
+
+
+if __name__ == '__main__':
+    unittest.main()
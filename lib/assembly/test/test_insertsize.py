@@ -0,0 +1,126 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import insertsize
+
+def sam_line(name, flag, cigar, mate, tlen):
+    return '\t'.join([name, str(flag), 'c1', '1', '60', cigar, mate, '100',
+                      str(tlen), 'ACGT', 'IIII']) + '\n'
+
+SAM = ['@HD\tVN:1.0\n',
+       '@SQ\tSN:c1\tLN:1000\n',
+       sam_line('p1', 99, '100M', '=', 300),
+       sam_line('p1', 147, '100M', '=', -300),
+       sam_line('p2', 99, '100M', '=', 300),
+       sam_line('p3', 99, '100M', '=', 310),
+       sam_line('p4', 99, '100M', '=', 290),
+       sam_line('p5', 99, '90M', '=', 5000), # Over SPAN_BOUND times the mode
+       sam_line('p6', 99, '50M50S', '=', 300), # Clipped
+       sam_line('p7', 99, '100M', 'c2', 0), # Mate on another contig
+       sam_line('p8', 355, '100M', '=', 300), # Secondary
+       sam_line('p9', 99, '100M', '*', 0)]
+
+
+class InsertHistogramTest(unittest.TestCase):
+    def test_counts(self):
+        h = insertsize.InsertHistogram()
+        for v in [3, 5, 5, 7]:
+            h.add(v)
+        self.assertEqual(h.total(), 4)
+        self.assertEqual(h.mode(), 5)
+        self.assertEqual(h.distribution(), [[3, 1], [5, 2], [7, 1]])
+        mean, stdev = h.mean_stdev(bounded=False)
+        self.assertEqual(mean, 5)
+        self.assertAlmostEqual(stdev, np.std([3, 5, 5, 7], ddof=1))
+
+    def test_too_few(self):
+        h = insertsize.InsertHistogram()
+        self.assertEqual(h.mean_stdev(), None)
+        h.add(5)
+        self.assertEqual(h.mean_stdev(), None)
+
+    def test_outliers_stay_sparse(self):
+        h = insertsize.InsertHistogram()
+        for v in [300, 300, 310, 2**40]:
+            h.add(v)
+        h.flush()
+        self.assertTrue(len(h.counts) < insertsize.DENSE_LIMIT)
+        self.assertEqual(h.tail, {2**40: 1})
+        self.assertEqual(h.distribution()[-1], [2**40, 1])
+        self.assertAlmostEqual(h.mean_stdev()[0], 910 / 3.0)
+        self.assertTrue(h.mean_stdev(bounded=False)[0] > 2**37)
+
+    def test_tail_mode(self):
+        h = insertsize.InsertHistogram()
+        for v in [300, 2**20, 2**20]:
+            h.add(v)
+        self.assertEqual(h.mode(), 2**20)
+
+    def test_merge(self):
+        a = insertsize.InsertHistogram()
+        b = insertsize.InsertHistogram()
+        for v in [1, 2, 2**30]:
+            a.add(v)
+        for v in [2, 3, 4, 2**30]:
+            b.add(v)
+        a.merge(b)
+        self.assertEqual(a.distribution(), [[1, 1], [2, 2], [3, 1], [4, 1], [2**30, 2]])
+
+
+class InsertSizesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sam_record(self):
+        self.assertEqual(insertsize.sam_record(SAM[0]), None)
+        self.assertEqual(insertsize.sam_record(SAM[2]), (100, 300))
+        self.assertEqual(insertsize.sam_record(SAM[3]), (100, None))
+        self.assertEqual(insertsize.sam_record(SAM[8]), None)
+        self.assertEqual(insertsize.sam_record(SAM[9]), (100, None))
+        self.assertEqual(insertsize.sam_record(SAM[10]), None)
+        self.assertEqual(insertsize.sam_span(SAM[2]), 300)
+
+    def test_sam_filtering(self):
+        # Unlike the original getinsertsize.py: optional tags are not
+        # needed, and secondary and supplementary alignments do not count
+        line = sam_line('p1', 99, '100M', '=', 300)
+        self.assertEqual(insertsize.sam_record(line), (100, 300))
+        self.assertEqual(insertsize.sam_record(line.rstrip('\n') + '\tNM:i:0\n'), (100, 300))
+        self.assertEqual(insertsize.sam_record(line.rsplit('\t', 1)[0] + '\n'), None)
+        self.assertEqual(insertsize.sam_record(sam_line('p1', 99 | 0x100, '100M', '=', 300)),
+                         None)
+        self.assertEqual(insertsize.sam_record(sam_line('p1', 99 | 0x800, '100M', '=', 300)),
+                         None)
+
+    def test_parse_sam(self):
+        result = insertsize.parse_sam(SAM).result()
+        self.assertEqual(result['reads'], 8)
+        self.assertEqual(result['pairs'], 5)
+        self.assertEqual(result['span']['mean'], 300)
+        self.assertAlmostEqual(result['span']['stdev'], np.std([300, 300, 310, 290], ddof=1))
+        self.assertAlmostEqual(result['read_length']['mean'], 790 / 8.0)
+        self.assertEqual(result['span_distribution'],
+                         [[290, 1], [300, 2], [310, 1], [5000, 1]])
+
+    def test_chunks(self):
+        path = os.path.join(self.dir, 'aln.sam')
+        with open(path, 'w') as f:
+            f.writelines(SAM * 20)
+        expected = insertsize.parse_sam(SAM * 20).result()
+        self.assertEqual(insertsize.parse_file(path).result(), expected)
+        for chunk_size in [1, 50, 333]:
+            sizes = insertsize.parse_sam_file(path, processes=2, chunk_size=chunk_size)
+            self.assertEqual(sizes.result(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
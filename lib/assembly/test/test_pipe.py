@@ -0,0 +1,112 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import pipe
+
+
+class SweepTest(unittest.TestCase):
+    def test_sweep_values(self):
+        self.assertEqual(pipe.sweep_values('?k=1,3-4'), ['?k=1', '?k=3', '?k=4'])
+        self.assertEqual(pipe.sweep_values('?k=21:27:2'),
+                         ['?k=21', '?k=23', '?k=25', '?k=27'])
+        self.assertEqual(pipe.sweep_values('?mode=fast'), ['?mode=fast'])
+
+    def test_count_matches_expansion(self):
+        for word in ['?k=1', '?k=1,3-4', '?k=21:27:2', '?k=21:28:2', '?k=5-5',
+                     '?k=1,10-11,20,30:40:2']:
+            self.assertEqual(pipe.count_sweep_values(word), len(pipe.sweep_values(word)))
+
+    def test_count_does_not_expand(self):
+        self.assertEqual(pipe.count_sweep_values('?k=1:30000000'), 30000000)
+        self.assertEqual(pipe.count_branches(['velvet', '?k=1:30000000', '?cov=1-10']),
+                         300000000)
+
+    def test_zero_step(self):
+        self.assertRaises(ValueError, pipe.count_sweep_values, '?k=1:10:0')
+
+    def test_iter_sweep_is_lazy(self):
+        sweep = pipe.iter_sweep(['velvet', '?k=1:30000000'])
+        self.assertEqual(next(sweep), ('velvet', '?k=1'))
+        self.assertEqual(next(sweep), ('velvet', '?k=2'))
+
+    def test_parse_pipe(self):
+        self.assertEqual(pipe.parse_pipe(['kiki', '?k=29-30', 'velvet']),
+                         [[('kiki', '?k=29'), ('kiki', '?k=30')], [['velvet']]])
+
+    def test_parse_branches(self):
+        branches = pipe.parse_branches(['trim_sort', 'kiki ?k=29-30 velvet'])
+        self.assertEqual(branches, [['trim_sort', 'kiki', '?k=29'],
+                                    ['trim_sort', 'kiki', '?k=30'],
+                                    ['trim_sort', 'velvet']])
+        self.assertEqual(pipe.count_branches(['trim_sort', 'kiki ?k=29-30 velvet']), 3)
+
+    def test_branch_limit(self):
+        self.assertRaises(pipe.PipelineLimitError, pipe.parse_branches,
+                          ['velvet', '?k=1-100'], 10)
+
+
+class StageTreeTest(unittest.TestCase):
+    def test_shared_prefix(self):
+        root, leaves = pipe.build_stage_tree(
+            [(1, ['trim_sort', 'velvet'], [{}, {'hash_length': '29'}]),
+             (2, ['trim_sort', 'velvet'], [{}, {'hash_length': '31'}]),
+             (3, ['Trim_Sort', 'kiki'], [{}, {}])])
+        self.assertEqual(len(root.children), 1)
+        trim = root.children[0]
+        self.assertEqual(trim.pipelines, [1, 2, 3])
+        self.assertEqual([c.module for c in trim.children], ['velvet', 'velvet', 'kiki'])
+        self.assertEqual(len(list(pipe.iter_stages(root))), 4)
+        self.assertEqual([n.module for n in leaves[2].path()], ['trim_sort', 'velvet'])
+        self.assertEqual(leaves[2].params, {'hash_length': '31'})
+
+    def test_add_to_tree(self):
+        root, leaves = pipe.build_stage_tree([(1, ['trim_sort', 'velvet'], [{}, {}])])
+        root, more = pipe.build_stage_tree([(2, ['trim_sort', 'kiki'], [{}, {}])], root)
+        self.assertTrue(more[2].parent is leaves[1].parent)
+        numbers = [n.number for n in pipe.iter_stages(root)]
+        self.assertEqual(sorted(numbers), [1, 2, 3])
+
+
+class AdaptiveSweepTest(unittest.TestCase):
+    def setUp(self):
+        self.pipes = pipe.parse_branches(['velvet', '?hash_length=21:61:2'])
+
+    def run_search(self, search, score, pipes=None):
+        if pipes is None:
+            pipes = search.next_round()
+        while pipes:
+            for p in pipes:
+                search.report(p, score(p))
+            pipes = search.next_round()
+
+    def test_finds_peak(self):
+        def score(p):
+            return -abs(int(p[1].split('=')[1]) - 45)
+        search = pipe.AdaptiveSweep(self.pipes, budget=len(self.pipes))
+        coarse = search.next_round()
+        self.assertEqual([p[1] for p in coarse],
+                         ['?hash_length=21', '?hash_length=41', '?hash_length=61'])
+        self.run_search(search, score, coarse)
+        self.assertEqual(search.best(), (['velvet', '?hash_length=45'], 0))
+        self.assertTrue(search.count() < len(self.pipes))
+
+    def test_budget(self):
+        search = pipe.AdaptiveSweep(self.pipes, budget=4)
+        self.run_search(search, lambda p: 0)
+        self.assertEqual(search.count(), 4)
+
+    def test_failures(self):
+        search = pipe.AdaptiveSweep(self.pipes, budget=10)
+        self.run_search(search, lambda p: None)
+        self.assertEqual(search.best(), (None, None))
+        self.assertEqual(search.count(), 3)
+
+    def test_sweep_template(self):
+        self.assertEqual(pipe.sweep_template(['velvet', '?hash_length=29', '?mode=fast']),
+                         (('velvet', '?hash_length=#', '?mode=fast'), [(1, 29.0)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
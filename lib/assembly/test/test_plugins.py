@@ -0,0 +1,56 @@
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import plugins
+
+
+class Sink(StringIO.StringIO):
+    def close(self):
+        self.data = self.getvalue()
+        StringIO.StringIO.close(self)
+
+
+class ReadSampleTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fastq(self, name, names):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            for n in names:
+                f.write('@{}\nACGT\n+\nIIII\n'.format(n))
+        return path
+
+    def sample(self, reads, pairs):
+        out = Sink()
+        plugins.BasePlugin.write_read_sample.im_func(None, out, reads, pairs)
+        return [line[1:] for line in out.data.splitlines()[::4]]
+
+    def test_mate_files(self):
+        reads = [self.fastq('r1.fq', ['p{}/1'.format(i) for i in range(10)]),
+                 self.fastq('r2.fq', ['p{}/2'.format(i) for i in range(10)])]
+        names = self.sample(reads, 3)
+        self.assertEqual(len(names), 6) # MIN_PAIRS pairs, not lines
+        for r1, r2 in zip(names[::2], names[1::2]):
+            self.assertEqual((r1[:-2], r1[-2:], r2[-2:]), (r2[:-2], '/1', '/2'))
+        self.assertEqual(self.sample(reads, 3), names)
+        self.assertEqual(len(self.sample(reads, 20)), 20)
+
+    def test_interleaved(self):
+        reads = [self.fastq('r.fq', ['p{}/{}'.format(i / 2, i % 2 + 1) for i in range(10)])]
+        names = self.sample(reads, 3)
+        self.assertEqual(len(names), 6)
+        for r1, r2 in zip(names[::2], names[1::2]):
+            self.assertEqual((r1[:-2], r1[-2:], r2[-2:]), (r2[:-2], '/1', '/2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import readstats
+
+FASTQ = ('@r1\nACGT\n+\nIIII\n'
+         '@r2\nGGCCAT\n+\n@@@@#5\n' # Quality starting with the header byte
+         '@r3\nAC\n+\nII\n')
+FASTQ_64 = '@r1\nACGT\n+\nhhhh\n@r2\nAC\n+\nJJ\n'
+FASTA = '>c1\nACGT\nAC\n>c2\nGGGGCCCC\n>c3\n\n>c4\nA'
+
+
+class ReadStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        readstats._cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        readstats.CHUNK_SIZE = 16 * 2**20
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        if name.endswith('.gz'):
+            f = gzip.open(path, 'wb')
+        else:
+            f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_fastq(self):
+        stats = readstats.read_stats(self.write('r.fq', FASTQ))
+        self.assertEqual((stats['format'], stats['count'], stats['bases'], stats['max_length']),
+                         ('fastq', 3, 12, 6))
+        self.assertEqual(stats['mean_length'], 4)
+        self.assertTrue(stats['exact'])
+
+    def test_fasta(self):
+        stats = readstats.read_stats(self.write('r.fa', FASTA))
+        self.assertEqual((stats['format'], stats['count'], stats['bases'], stats['max_length']),
+                         ('fasta', 4, 15, 8))
+
+    def test_chunk_boundaries(self):
+        expected = [readstats.read_stats(self.write('r.fq', FASTQ)),
+                    readstats.read_stats(self.write('r.fa', FASTA))]
+        for size in [1, 2, 3, 5, 7, 16]:
+            readstats.CHUNK_SIZE = size
+            readstats._cache.clear()
+            self.assertEqual([readstats.read_stats(os.path.join(self.dir, 'r.fq')),
+                              readstats.read_stats(os.path.join(self.dir, 'r.fa'))],
+                             expected)
+
+    def test_compressed(self):
+        plain = readstats.read_stats(self.write('r.fq', FASTQ))
+        self.assertEqual(readstats.read_stats(self.write('r.fq.gz', FASTQ)), plain)
+
+    def test_empty(self):
+        self.assertEqual(readstats.read_stats(self.write('e.fq', ''))['count'], 0)
+
+    def test_encoding(self):
+        self.assertEqual(readstats.read_profile(self.write('r.fq', FASTQ))['qual_encoding'],
+                         'phred33')
+        self.assertEqual(readstats.read_profile(self.write('r64.fq', FASTQ_64))['qual_encoding'],
+                         'phred64')
+        self.assertEqual(readstats.read_profile(self.write('r.fa', FASTA))['qual_encoding'],
+                         None)
+
+    def test_profile(self):
+        profile = readstats.read_profile(self.write('r.fq', FASTQ))
+        self.assertEqual(profile['gc_content'], 7 / 12.0)
+        self.assertEqual(profile['length_histogram'],
+                         {'bin_width': 1, 'counts': [0, 0, 1, 0, 1, 0, 1]})
+
+    def test_profile_chunk_boundaries(self):
+        expected = [readstats.read_profile(self.write('r.fq', FASTQ)),
+                    readstats.read_profile(self.write('r.fa', FASTA))]
+        for size in [1, 2, 3, 5, 7, 16]:
+            readstats.CHUNK_SIZE = size
+            readstats._cache.clear()
+            self.assertEqual([readstats.read_profile(os.path.join(self.dir, 'r.fq')),
+                              readstats.read_profile(os.path.join(self.dir, 'r.fa'))],
+                             expected)
+
+    def test_remember(self):
+        path = self.write('r.fq', FASTQ)
+        self.assertEqual(readstats.cached_stats(path), None)
+        profile = readstats.read_profile(path)
+        self.assertEqual(readstats.cached_stats(path), profile)
+        self.assertEqual(readstats.read_stats(path), profile)
+        readstats._cache.clear()
+        readstats.remember(path, dict(profile, count=99))
+        self.assertEqual(readstats.read_stats(path)['count'], 99)
+        self.assertEqual(readstats.read_profile(path)['count'], 99)
+        with open(path, 'a') as f:
+            f.write('@r4\nA\n+\nI\n')
+        self.assertEqual(readstats.read_stats(path)['count'], 4) # Changed file
+
+    def test_sampled(self):
+        data = ''.join(['@r{}\n{}\n+\n{}\n'.format(i, 'A' * 50, 'I' * 50) for i in range(1000)])
+        stats = readstats.sampled_stats(self.write('r.fq', data), len(data),
+                                        blocks=8, block_size=1000)
+        self.assertFalse(stats['exact'])
+        self.assertEqual(stats['max_length'], 50)
+        self.assertTrue(abs(stats['count'] - 1000) < 50)
+
+    def test_iter_records(self):
+        path = self.write('r.fq', FASTQ)
+        records = FASTQ.splitlines(True)
+        for size in [1, 5, 1000]:
+            readstats.CHUNK_SIZE = size
+            self.assertEqual(list(readstats.iter_records(path, [0, 2])),
+                             [''.join(records[0:4]), ''.join(records[8:12])])
+
+    def test_iter_fasta_records(self):
+        path = self.write('r.fa', FASTA)
+        for size in [1, 5, 1000]:
+            readstats.CHUNK_SIZE = size
+            self.assertEqual(list(readstats.iter_records(path, [0, 1, 3], lines=None)),
+                             ['>c1\nACGT\nAC\n', '>c2\nGGGGCCCC\n', '>c4\nA\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
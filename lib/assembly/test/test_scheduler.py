@@ -0,0 +1,99 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import scheduler
+
+
+class ResourceHintsTest(unittest.TestCase):
+    def test_defaults(self):
+        hints = scheduler.ResourceHints([], 8)
+        self.assertEqual((hints.min_threads, hints.max_threads, hints.io_heavy), (1, 8, False))
+        self.assertEqual(hints.memory(2**30), 0)
+
+    def test_settings(self):
+        hints = scheduler.ResourceHints([('min_threads', '2'), ('max_threads', '4'),
+                                         ('io_heavy', 'True'), ('mem_base', '100'),
+                                         ('mem_factor', '2')], 8)
+        self.assertEqual((hints.min_threads, hints.max_threads, hints.io_heavy), (2, 4, True))
+        self.assertEqual(hints.memory(50 * 2**20), 200)
+
+
+class ResourceSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.allocations = {}
+        self.scheduler = scheduler.ResourceScheduler(8, self.allocations,
+                                                     memory_limit=1000, poll_interval=0)
+        self.hints = scheduler.ResourceHints([], 8)
+
+    def test_idle_node_gets_all_cores(self):
+        token, threads = self.scheduler.acquire('velvet', self.hints)
+        self.assertEqual(threads, 8)
+        self.assertEqual(self.allocations[token]['load'], 8)
+
+    def test_busy_node_shares_cores(self):
+        self.scheduler.acquire('velvet', self.hints)
+        token, threads = self.scheduler.acquire('kiki', self.hints)
+        self.assertEqual(threads, 4) # Fair share of two
+        minimum = scheduler.ResourceHints([('min_threads', '6')], 8)
+        token, threads = self.scheduler.acquire('spades', minimum)
+        self.assertEqual(threads, 6)
+
+    def test_max_threads(self):
+        hints = scheduler.ResourceHints([('max_threads', '2')], 8)
+        token, threads = self.scheduler.acquire('velvet', hints)
+        self.assertEqual(threads, 2)
+        token, threads = self.scheduler.acquire('kiki', self.hints)
+        self.assertEqual(threads, 6)
+
+    def test_io_heavy_load(self):
+        hints = scheduler.ResourceHints([('io_heavy', 'yes')], 8)
+        token, threads = self.scheduler.acquire('trim_sort', hints)
+        self.assertEqual(self.allocations[token]['load'], 4)
+
+    def test_release(self):
+        token, threads = self.scheduler.acquire('velvet', self.hints)
+        self.scheduler.release(token)
+        self.scheduler.release(token)
+        self.assertEqual(self.allocations, {})
+
+    def test_admit(self):
+        self.assertTrue(self.scheduler._admit(2000, 0)) # Only consumer
+        self.assertTrue(self.scheduler._admit(0, 900))
+        self.assertFalse(self.scheduler._admit(200, 900))
+
+    def test_wait_for_memory(self):
+        self.allocations['big'] = {'module': 'spades', 'pid': os.getpid(), 'threads': 8,
+                                   'load': 8, 'memory': 900, 'start': 0}
+        waits = []
+        def on_wait(memory, committed):
+            waits.append((memory, committed))
+            self.scheduler.release('big')
+        hints = scheduler.ResourceHints([('mem_base', '200')], 8)
+        token, threads = self.scheduler.acquire('velvet', hints, on_wait=on_wait)
+        self.assertEqual(waits, [(200, 900)])
+        self.assertEqual(self.allocations.keys(), [token])
+        self.assertEqual(self.allocations[token]['memory'], 200)
+
+    def test_reap(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.allocations['dead'] = {'module': 'velvet', 'pid': pid, 'threads': 8,
+                                    'load': 8, 'memory': 0, 'start': 0}
+        token, threads = self.scheduler.acquire('kiki', self.hints)
+        self.assertEqual(threads, 8)
+        self.assertFalse('dead' in self.allocations)
+
+
+class MeminfoTest(unittest.TestCase):
+    def test_meminfo(self):
+        info = scheduler.meminfo()
+        self.assertTrue(info['MemTotal'] > 0)
+        self.assertTrue('MemAvailable' in info)
+
+
+if __name__ == '__main__':
+    unittest.main()
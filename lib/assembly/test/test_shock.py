@@ -0,0 +1,255 @@
+import BaseHTTPServer
+import cgi
+import hashlib
+import json
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import shock
+
+DATA = ''.join([chr(i % 251) for i in range(100000)])
+
+
+class FakeShock(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Shock server holding nodes in memory.  Each request to a node
+    takes the next fault of self.faults[node_id], if any:
+      'cut'     -- send half of the remaining data, then close
+      'corrupt' -- send the data with a byte changed
+      'norange' -- ignore the Range header
+      404, 500  -- fail with that status """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeShockHandler)
+        self.nodes = {} # id -> {'name', 'data', 'parts'}
+        self.faults = {}
+        self.log = [] # (method, node id, Range header)
+        self.lock = threading.Lock()
+
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def add_node(self, node_id, data, name='reads.fq'):
+        self.nodes[node_id] = {'name': name, 'data': data, 'parts': None}
+
+    def fault(self, node_id):
+        with self.lock:
+            faults = self.faults.get(node_id)
+            if faults:
+                return faults.pop(0)
+        return None
+
+
+class FakeShockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def node_id(self):
+        return self.path.split('?')[0].split('/')[2]
+
+    def send_json(self, status, data=None):
+        body = json.dumps({'status': status, 'data': data})
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def node_record(self, node_id):
+        node = self.server.nodes[node_id]
+        return {'id': node_id,
+                'file': {'name': node['name'], 'size': len(node['data']),
+                         'checksum': {'md5': hashlib.md5(node['data']).hexdigest()}}}
+
+    def do_GET(self):
+        node_id = self.node_id()
+        if not self.path.endswith('?download'):
+            return self.send_json(200, self.node_record(node_id))
+        self.server.log.append(('GET', node_id, self.headers.get('Range')))
+        fault = self.server.fault(node_id)
+        if fault in (404, 500):
+            return self.send_json(fault)
+        data = self.server.nodes[node_id]['data']
+        offset = 0
+        if self.headers.get('Range') and fault != 'norange':
+            offset = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if offset >= len(data):
+                return self.send_json(416)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    offset, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[offset:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if fault == 'cut':
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = 1
+            return
+        if fault == 'corrupt':
+            body = chr(ord(body[0]) ^ 1) + body[1:]
+        self.wfile.write(body)
+
+    def form(self):
+        return cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': self.command,
+                                         'CONTENT_TYPE': self.headers['Content-Type']})
+
+    def do_POST(self):
+        form = self.form()
+        node_id = 'node{}'.format(len(self.server.nodes) + 1)
+        if 'parts' in form:
+            self.server.add_node(node_id, '', form.getfirst('file_name'))
+            self.server.nodes[node_id]['parts'] = [None] * int(form.getfirst('parts'))
+        else:
+            self.server.add_node(node_id, form['upload'].value, form['upload'].filename)
+        self.send_json(200, self.node_record(node_id))
+
+    def do_PUT(self):
+        node_id = self.node_id()
+        form = self.form()
+        self.server.log.append(('PUT', node_id, None))
+        fault = self.server.fault(node_id)
+        if fault in (404, 500):
+            return self.send_json(fault)
+        node = self.server.nodes[node_id]
+        for key in form.keys():
+            node['parts'][int(key) - 1] = form[key].value
+        if None not in node['parts']:
+            node['data'] = ''.join(node['parts'])
+        self.send_json(200, self.node_record(node_id))
+
+
+class ShockTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = FakeShock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.server.add_node('n1', DATA)
+        self.shock = shock.Shock(self.server.url(), 'user', 'token')
+        self.sleep = shock.time.sleep
+        shock.time.sleep = lambda seconds: None # No backoff
+
+    def tearDown(self):
+        shock.time.sleep = self.sleep
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def downloads(self):
+        return [entry for entry in self.server.log if entry[0] == 'GET']
+
+    def download(self, **kwargs):
+        path = self.shock.download_file('n1', self.dir, **kwargs)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertFalse(os.path.exists(path + shock.PARTIAL_SUFFIX))
+        return path
+
+    def test_download(self):
+        self.assertEqual(self.download(), os.path.join(self.dir, 'reads.fq'))
+        self.assertEqual(self.downloads(), [('GET', 'n1', None)])
+
+    def test_resume(self):
+        self.server.faults['n1'] = ['cut', 'cut']
+        self.download()
+        self.assertEqual(self.downloads(), [('GET', 'n1', None),
+                                            ('GET', 'n1', 'bytes=50000-'),
+                                            ('GET', 'n1', 'bytes=75000-')])
+
+    def test_resume_partial_file(self):
+        with open(os.path.join(self.dir, 'reads.fq.part'), 'wb') as f:
+            f.write(DATA[:1000])
+        self.download()
+        self.assertEqual(self.downloads(), [('GET', 'n1', 'bytes=1000-')])
+
+    def test_range_ignored(self):
+        self.server.faults['n1'] = ['cut', 'norange']
+        self.download()
+        self.assertEqual(len(self.downloads()), 2)
+
+    def test_oversized_partial(self):
+        with open(os.path.join(self.dir, 'reads.fq.part'), 'wb') as f:
+            f.write(DATA + 'extra')
+        self.download()
+        self.assertEqual(self.downloads(), [('GET', 'n1', None)])
+
+    def test_checksum_restart(self):
+        self.server.faults['n1'] = ['corrupt']
+        self.download()
+        self.assertEqual(self.downloads(), [('GET', 'n1', None), ('GET', 'n1', None)])
+
+    def test_checksum_failure(self):
+        self.server.faults['n1'] = ['corrupt', 'corrupt']
+        self.assertRaises(shock.ChecksumError, self.shock.download_file, 'n1', self.dir)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'reads.fq')))
+
+    def test_server_error_retried(self):
+        self.server.faults['n1'] = [500]
+        self.download()
+        self.assertEqual(len(self.downloads()), 2)
+
+    def test_client_error_not_retried(self):
+        self.server.faults['n1'] = [404]
+        self.assertRaises(shock.requests.exceptions.HTTPError,
+                          self.shock.download_file, 'n1', self.dir)
+        self.assertEqual(len(self.downloads()), 1)
+
+    def test_upload(self):
+        path = os.path.join(self.dir, 'small.fq')
+        with open(path, 'wb') as f:
+            f.write(DATA[:1000])
+        res = self.shock.upload_reads(path)
+        self.assertEqual(self.server.nodes[res['data']['id']]['data'], DATA[:1000])
+
+    def test_upload_parts(self):
+        path = os.path.join(self.dir, 'big.fq')
+        with open(path, 'wb') as f:
+            f.write(DATA)
+        self.shock.part_size = 30000
+        self.server.faults['node2'] = [500]
+        res = self.shock.upload_reads(path)
+        node = self.server.nodes[res['data']['id']]
+        self.assertEqual(res['data']['id'], 'node2')
+        self.assertEqual(len(node['parts']), 4)
+        self.assertEqual(node['data'], DATA)
+        self.assertEqual(len([e for e in self.server.log if e[0] == 'PUT']), 5)
+
+    def test_upload_part_client_error(self):
+        path = os.path.join(self.dir, 'big.fq')
+        with open(path, 'wb') as f:
+            f.write(DATA)
+        self.shock.part_size = 60000
+        self.shock.upload_threads = 1
+        self.server.faults['node2'] = [404]
+        self.assertRaises(shock.requests.exceptions.HTTPError, self.shock.upload_reads, path)
+        # The failed part is not retried; the other part is still sent
+        self.assertEqual(len([e for e in self.server.log if e[0] == 'PUT']), 2)
+
+
+class TransientTest(unittest.TestCase):
+    def test_transient(self):
+        exceptions = shock.requests.exceptions
+        self.assertTrue(shock.transient(exceptions.ConnectionError()))
+        self.assertTrue(shock.transient(exceptions.ReadTimeout()))
+        self.assertTrue(shock.transient(exceptions.ChunkedEncodingError()))
+        self.assertTrue(shock.transient(shock.TransferError('Incomplete transfer')))
+        self.assertFalse(shock.transient(IOError('No space left on device')))
+        for status, retry in [(500, True), (503, True), (401, False), (404, False)]:
+            response = shock.requests.models.Response()
+            response.status_code = status
+            self.assertEqual(shock.transient(exceptions.HTTPError(response=response)), retry)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from tracing import Tracer
+
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'trace.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def export(self, tracer):
+        with open(tracer.export(os.path.join(self.dir, 'trace.json'))) as f:
+            return json.load(f)
+
+    def test_span(self):
+        tracer = Tracer(self.log, 'Job 7')
+        with tracer.span('velvet', 'module', pipelines=[1, 2]):
+            pass
+        tracer.complete('Pipeline 1', 'pipeline', 10.0, 12.5)
+        trace = self.export(tracer)
+        self.assertEqual(trace['displayTimeUnit'], 'ms')
+        span, pipeline, name = trace['traceEvents']
+        self.assertEqual((span['name'], span['cat'], span['ph'], span['pid'], span['args']),
+                         ('velvet', 'module', 'X', os.getpid(), {'pipelines': [1, 2]}))
+        self.assertEqual((pipeline['ts'], pipeline['dur']), (10000000, 2500000))
+        self.assertEqual(name, {'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                                'args': {'name': 'Job 7'}})
+
+    def test_span_on_error(self):
+        tracer = Tracer(self.log)
+        try:
+            with tracer.span('velvet', 'module'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.export(tracer)['traceEvents'][0]['name'], 'velvet')
+
+    def test_forked_and_threads(self):
+        tracer = Tracer(self.log)
+        threads = [threading.Thread(target=tracer.complete, args=('upload', 'upload', 0, 1))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        pid = os.fork()
+        if pid == 0:
+            tracer.complete('velvet', 'module', 0, 1)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        with open(self.log, 'a') as f:
+            f.write('{"name": "cut sh') # Killed mid-write
+        events = self.export(tracer)['traceEvents']
+        self.assertEqual(len([e for e in events if e['name'] == 'upload']), 4)
+        names = dict([(e['pid'], e['args']['name']) for e in events if e['ph'] == 'M'])
+        self.assertEqual(names, {os.getpid(): 'Worker',
+                                 pid: 'Stage process {}'.format(pid)})
+
+    def test_no_log(self):
+        tracer = Tracer()
+        with tracer.span('velvet', 'module'):
+            pass
+        tracer.close(remove=True)
+
+    def test_close(self):
+        tracer = Tracer(self.log)
+        tracer.complete('velvet', 'module', 0, 1)
+        tracer.close(remove=True)
+        self.assertFalse(os.path.exists(self.log))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Timelines of jobs in the Chrome trace-event format.
+
+A Tracer appends one JSON event per line to a log, each with a single
+write, so the forked stage processes and upload threads of a job can share
+it.  export() converts the log into a trace file that chrome://tracing and
+Perfetto can load:
+
+  tracer = Tracer(logfile)
+  with tracer.span('velvet', 'module', pipelines=[1, 2]):
+      ...
+  tracer.export('job_trace.json')
+
+A Tracer without a log records nothing.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+class Tracer:
+    def __init__(self, path=None, name=None):
+        self.path = path
+        self.name = name # Shown for the process that created the tracer
+        self.pid = os.getpid()
+        self.fd = None
+        if path:
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        """ Records the time spent in the with block """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.complete(name, cat, start, time.time(), **args)
+
+    def complete(self, name, cat, start, end, **args):
+        """ Records a span that ran from START to END (time.time() values) """
+        if self.fd is None:
+            return
+        event = {'name': name,
+                 'cat': cat,
+                 'ph': 'X',
+                 'ts': int(start * 1e6),
+                 'dur': int(max(0, end - start) * 1e6),
+                 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident,
+                 'args': args}
+        try:
+            os.write(self.fd, json.dumps(event, default=str) + '\n')
+        except OSError as e:
+            logging.warning('Trace event not recorded: {}'.format(e))
+
+    def export(self, outfile):
+        """ Writes the events logged so far to OUTFILE as a trace """
+        events = []
+        pids = set()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError: # Cut short by a killed process
+                    continue
+                events.append(event)
+                pids.add(event['pid'])
+        for pid in sorted(pids):
+            if pid == self.pid:
+                name = self.name or 'Worker'
+            else:
+                name = 'Stage process {}'.format(pid)
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                           'args': {'name': name}})
+        with open(outfile, 'w') as out:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out)
+        return outfile
+
+    def close(self, remove=False):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if remove and self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
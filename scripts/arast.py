@@ -43,6 +43,8 @@ p_run.add_argument("-a", "--assemblers", action="store", dest="assemblers", narg
 p_run.add_argument("-p", "--pipeline", action="append", dest="pipeline", nargs='*', help="invoke a pipeline. None will invoke automatic mode")
 p_run.add_argument("-m", "--message", action="store", dest="message", help="Attach a description to job")
 p_run.add_argument("-q", "--queue", action="store", dest="queue", help=argparse.SUPPRESS)
+p_run.add_argument("--sweep", action="store", dest="sweep", choices=['full', 'adaptive'], help="run every parameter combination (full) or search ranges adaptively by N50")
+p_run.add_argument("--sweep-budget", action="store", dest="sweep_budget", type=int, help="maximum number of pipelines run by an adaptive sweep")
 data_group.add_argument("--data", action="store", dest="data_id", help="Reuse uploaded data")
 p_run.add_argument("--pair", action="append", dest="pair", nargs='*', help="Specify a paired-end library and parameters")
 p_run.add_argument("--single", action="append", dest="single", nargs='*', help="Specify a single end file and parameters")
@@ -244,7 +246,8 @@ def main():
                 f_set = client.FileSet(f_type, f_infos, **f_set_args)
                 adata.add_set(f_set)
 
-        arast_msg = {k:options[k] for k in ['pipeline', 'data_id', 'message', 'queue', 'version']
+        arast_msg = {k:options[k] for k in ['pipeline', 'data_id', 'message', 'queue', 'version',
+                                            'sweep', 'sweep_budget']
                      if k in options}
         arast_msg['assembly_data'] = adata
         arast_msg['client'] = 'CLI'